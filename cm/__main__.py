@@ -14,17 +14,49 @@
 # limitations under the License.
 
 """Entrypoint of the package"""
+import argparse
 import asyncio
+import logging
 
-from cm.main import consume_events, run_rest
+from cm.main import (
+    relay_sample_changes,
+    replay_dead_letters,
+    run_rest_and_consume_events,
+)
 
 
 def run():
-    """run the rest API"""
+    """run the rest API and consume events"""
     loop = asyncio.get_event_loop()
-    task_api = loop.create_task(run_rest())
-    task_consume = loop.create_task(consume_events())
-    loop.run_until_complete(asyncio.gather(task_api, task_consume))
+    loop.run_until_complete(run_rest_and_consume_events())
+
+
+def replay_dlq():
+    """replay the events of the dead-letter topic to their original topics"""
+    parser = argparse.ArgumentParser(
+        description="Replay the events of the dead-letter topic."
+    )
+    parser.add_argument(
+        "--max-events",
+        type=int,
+        default=None,
+        help="stop after this many dead letters (default: all)",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    result = loop.run_until_complete(replay_dead_letters(max_events=args.max_events))
+    logging.info(
+        "Replayed %i event(s), skipped %i malformed dead letter(s).",
+        result.replayed,
+        result.skipped,
+    )
+
+
+def relay_changes():
+    """publish sample updates observed on the change stream of the database"""
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(relay_sample_changes())
 
 
 if __name__ == "__main__":
@@ -14,13 +14,29 @@
 # limitations under the License.
 #
 
-"""Contains the inbound kafka translator"""
+"""Contains the inbound kafka translators"""
+import logging
+from collections.abc import AsyncIterator, Sequence
+from contextlib import asynccontextmanager
+from typing import Optional
+
 from hexkit.custom_types import Ascii, JsonObject
 from hexkit.protocols.eventsub import EventSubscriberProtocol
-from pydantic import BaseSettings, Field
+from hexkit.providers.akafka import KafkaConfig, KafkaEventSubscriber
+from pydantic import BaseSettings, Field, ValidationError
 
+from cm.adapters.inbound.dead_letters import DeadLetterQueue
+from cm.adapters.inbound.dedup import EventDeduplicator, identify_by_offset
+from cm.adapters.inbound.kafka_consumer import (
+    ConsumedEvent,
+    DecodingConsumer,
+    EventBatchSubscriberProtocol,
+)
+from cm.adapters.outbound.akafka import EventPubTranslatorConfig
+from cm.adapters.outbound.cache import SampleCacheConfig
 from cm.core import models
 from cm.ports.inbound.data_repository import DataRepositoryPort
+from cm.ports.inbound.sample_cache import SampleCachePort
 
 
 class EventSubTranslatorConfig(BaseSettings):
@@ -38,14 +54,39 @@ class EventSubTranslatorConfig(BaseSettings):
     )
 
 
-class EventSubTranslator(EventSubscriberProtocol):
-    """A translator that can consume Sample Update events"""
+class UnexpectedEventTypeError(RuntimeError):
+    """Raised when an event of a type that can't be handled is received"""
+
+    def __init__(self, *, types: set[str]):
+        super().__init__(f"Received unexpected event type(s): {types}")
+
+
+# errors that will not go away by processing the event again:
+PERMANENT_ERRORS = (
+    ValidationError,
+    DataRepositoryPort.SampleNotFoundError,
+    UnexpectedEventTypeError,
+)
+
+
+class EventSubTranslator(EventBatchSubscriberProtocol):
+    """A translator that can consume Sample Update events, one at a time or in
+    batches. If a dead-letter queue is given, failing events are retried and then
+    sent to the dead-letter topic instead of stopping the consumer. If a
+    deduplicator is given, events that were already processed are skipped."""
 
     def __init__(
-        self, *, config: EventSubTranslatorConfig, data_repository: DataRepositoryPort
+        self,
+        *,
+        config: EventSubTranslatorConfig,
+        data_repository: DataRepositoryPort,
+        dead_letters: Optional[DeadLetterQueue] = None,
+        deduplicator: Optional[EventDeduplicator] = None,
     ):
         self._config = config
         self._data_repository = data_repository
+        self._dead_letters = dead_letters
+        self._deduplicator = deduplicator
 
         self.topics_of_interest = [
             config.update_sample_event_topic,
@@ -61,12 +102,195 @@ class EventSubTranslator(EventSubscriberProtocol):
             updates=sample_updates, is_external=False
         )
 
+    async def _handle(self, *, payload: JsonObject, type_: Ascii) -> None:
+        """Applies the update of a single event"""
+        if type_ != self._config.update_sample_event_type:
+            raise UnexpectedEventTypeError(types={type_})
+        sample_updates = models.SampleUpdate(**payload)
+        await self._update_sample(sample_updates=sample_updates)
+
+    async def _consume_validated(
+        self, *, payload: JsonObject, type_: Ascii, topic: Ascii
+    ) -> None:
+        """Consumes an event whose position in the topic is unknown, so it can't be
+        deduplicated"""
+        await self._process(payload=payload, type_=type_, topic=topic)
+
+    async def consume_event(self, event: ConsumedEvent) -> None:
+        """Consumes an event, unless it was already processed, as identified by its
+        offset"""
+        if self._deduplicator is None:
+            await self._process(
+                payload=event.payload, type_=event.type_, topic=event.topic
+            )
+            return
+
+        identity = identify_by_offset(event)
+        if (await self._deduplicator.seen([identity]))[0]:
+            return
+        await self._process(payload=event.payload, type_=event.type_, topic=event.topic)
+        await self._deduplicator.remember([identity])
+
+    async def _process(
+        self, *, payload: JsonObject, type_: Ascii, topic: Ascii
+    ) -> None:
+        """Processes an event, with retries if a dead-letter queue is given"""
+        if self._dead_letters is None:
+            await self._handle(payload=payload, type_=type_)
+            return
+
+        await self._dead_letters.process(
+            lambda: self._handle(payload=payload, type_=type_),
+            topic=topic,
+            type_=type_,
+            payload=payload,
+            permanent_errors=PERMANENT_ERRORS,
+        )
+
+    async def _consume_one_by_one(self, events: Sequence[ConsumedEvent]) -> None:
+        """Consumes the events of a batch individually, so that each one is retried
+        and dead-lettered on its own"""
+        for event in events:
+            await self._process(
+                payload=event.payload, type_=event.type_, topic=event.topic
+            )
+
+    async def consume_batch(self, events: Sequence[ConsumedEvent]) -> None:
+        """Processes the events of the batch that were not processed before, as
+        identified by their offsets"""
+        if self._deduplicator is None:
+            await self._process_batch(events)
+            return
+
+        identities = [identify_by_offset(event) for event in events]
+        seen = await self._deduplicator.seen(identities)
+        new_events = [event for event, skip in zip(events, seen) if not skip]
+        if new_events:
+            await self._process_batch(new_events)
+        await self._deduplicator.remember(
+            [identity for identity, skip in zip(identities, seen) if not skip]
+        )
+
+    async def _process_batch(self, events: Sequence[ConsumedEvent]) -> None:
+        """Applies all sample updates of the batch with one bulk write and publishes
+        the resulting events together. Of multiple updates to the same sample, the
+        last one wins. Updates of samples that were modified concurrently are
+        processed again one by one, which retries version conflicts. Updates that
+        can't be applied at all are sent to the dead-letter topic, or logged and
+        skipped if there is none. If the bulk write fails, the events are processed
+        one by one."""
+        unexpected = {event.type_ for event in events} - {
+            self._config.update_sample_event_type
+        }
+        if unexpected and self._dead_letters is None:
+            raise UnexpectedEventTypeError(types=unexpected)
+        if unexpected:
+            await self._consume_one_by_one(events)
+            return
+
+        try:
+            results = await self._data_repository.update_samples(
+                updates=[event.payload for event in events], is_external=False
+            )
+        except Exception:  # pylint: disable=broad-except
+            if self._dead_letters is None:
+                raise
+            logging.exception("Failed to apply a batch of sample updates.")
+            await self._consume_one_by_one(events)
+            return
+
+        conflicting = []
+        for result, event in zip(results, events):
+            if result.status == models.BatchItemStatus.UPDATED:
+                continue
+            if result.status == models.BatchItemStatus.CONFLICT:
+                conflicting.append(event)
+                continue
+            if self._dead_letters is not None and self._dead_letters.enabled:
+                await self._dead_letters.publish(
+                    topic=event.topic,
+                    type_=event.type_,
+                    payload=event.payload,
+                    error_type=result.status.value,
+                    error=result.error or result.status.value,
+                )
+            else:
+                logging.warning(
+                    "Skipped sample update (%s): %s - %i - %i (topic-partition-offset)",
+                    result.error or result.status.value,
+                    event.topic,
+                    event.partition,
+                    event.offset,
+                )
+        # version conflicts are transient, so they are not dead-lettered right away:
+        await self._consume_one_by_one(conflicting)
+
+
+class SampleCacheInvalidationTranslator(EventSubscriberProtocol):
+    """A translator that evicts samples from the cache when any instance of the
+    service, including this one, publishes that they were updated"""
+
+    def __init__(
+        self, *, config: EventPubTranslatorConfig, sample_cache: SampleCachePort
+    ):
+        self._config = config
+        self._sample_cache = sample_cache
+
+        self.topics_of_interest = [config.sample_updated_event_topic]
+        self.types_of_interest = [config.sample_updated_event_type]
+
     async def _consume_validated(  # pylint: disable=unused-argument
         self, *, payload: JsonObject, type_: Ascii, topic: Ascii
     ) -> None:
         """Consumes an event"""
-        if type_ == self._config.update_sample_event_type:
-            sample_updates = models.SampleUpdate(**payload)
-            await self._update_sample(sample_updates=sample_updates)
+        if type_ == self._config.sample_updated_event_type:
+            self._sample_cache.evict(sample_id=str(payload["sample_id"]))
         else:
             raise RuntimeError(f"Received unexpected event type: {type_}")
+
+
+class LatestOffsetConsumer(DecodingConsumer):
+    """A Kafka consumer that reads all partitions of its topics from their end,
+    without joining a consumer group. Nothing is committed, so no state is left on
+    the broker when the consumer stops."""
+
+    def __init__(self, *topics, **kwargs):
+        super().__init__(
+            *topics,
+            **{
+                **kwargs,
+                "group_id": None,
+                "enable_auto_commit": False,
+                "auto_offset_reset": "latest",
+            },
+        )
+
+
+class SampleCacheSubscriber:
+    """Constructor compatible with the hexkit.inject.AsyncContextConstructable type.
+    Used to construct the subscriber that keeps the sample cache coherent.
+
+    Every instance of the service has to see all sample updates, so instead of
+    sharing a consumer group, each one consumes all partitions without a group. As
+    the cache starts empty, past events are skipped.
+    """
+
+    @staticmethod
+    @asynccontextmanager
+    async def construct(
+        *,
+        config: KafkaConfig,
+        cache_config: SampleCacheConfig,
+        translator: SampleCacheInvalidationTranslator,
+    ) -> AsyncIterator[Optional[KafkaEventSubscriber]]:
+        """Yields None if the cache is disabled"""
+        if cache_config.sample_cache_max_entries == 0:
+            yield None
+            return
+
+        async with KafkaEventSubscriber.construct(
+            config=config,
+            translator=translator,
+            kafka_consumer_cls=LatestOffsetConsumer,
+        ) as subscriber:
+            yield subscriber
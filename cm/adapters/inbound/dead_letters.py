@@ -0,0 +1,306 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Dead-letter handling for events that could not be processed: bounded retries,
+publishing to a dead-letter topic, and replaying dead letters in bulk"""
+
+import asyncio
+import logging
+from collections.abc import AsyncIterator, Awaitable, Sequence
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Any, Callable, NamedTuple, Optional
+
+from aiokafka import AIOKafkaConsumer
+from hexkit.custom_types import Ascii, JsonObject
+from hexkit.protocols.eventpub import EventPublisherProtocol
+from hexkit.providers.akafka import KafkaConfig
+from hexkit.providers.akafka.provider import EventTypeNotFoundError, get_event_type
+from pydantic import BaseModel, BaseSettings, Field
+
+from cm.adapters.inbound.kafka_consumer import (
+    decode_record_value,
+    event_label,
+    make_manual_commit_consumer,
+)
+from cm.adapters.serialization import to_jsonable
+from cm.core.metrics import MetricsCollector
+
+UNKNOWN_KEY = "unknown"
+
+
+class DeadLetterConfig(BaseSettings):
+    """Config for retrying events that fail and for the dead-letter topic"""
+
+    event_dead_letter_topic: Optional[str] = Field(
+        None,
+        description=(
+            "Name of the topic that events are published to if they can't be"
+            + " processed. If not set, the consumer stops on such events instead."
+        ),
+        example="sample_events_dlq",
+    )
+    event_max_attempts: int = Field(
+        3,
+        ge=1,
+        description=(
+            "Maximum number of times an event is processed before it is considered"
+            + " failed. Invalid events are not retried."
+        ),
+        example=3,
+    )
+    event_retry_backoff_ms: int = Field(
+        100,
+        ge=0,
+        description=(
+            "Number of milliseconds to wait before the first retry of an event. The"
+            + " wait doubles with each further retry."
+        ),
+        example=100,
+    )
+
+
+class DeadLetter(BaseModel):
+    """An event that could not be processed, along with why it failed"""
+
+    original_topic: str
+    original_type: str
+    original_key: str
+    payload: dict[str, Any]
+    error_type: str
+    error: str
+    attempts: int
+    failed_at: datetime
+
+
+class DeadLetterQueue:
+    """Processes events with bounded retries and publishes those that still fail to
+    the dead-letter topic"""
+
+    def __init__(
+        self,
+        *,
+        config: DeadLetterConfig,
+        provider: EventPublisherProtocol,
+        metrics: Optional[MetricsCollector] = None,
+    ):
+        self._config = config
+        self._provider = provider
+        self._metrics = metrics or MetricsCollector()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether failed events are published to a dead-letter topic"""
+        return self._config.event_dead_letter_topic is not None
+
+    async def process(
+        self,
+        handler: Callable[[], Awaitable[None]],
+        *,
+        topic: Ascii,
+        type_: Ascii,
+        payload: JsonObject,
+        permanent_errors: tuple[type[Exception], ...] = (),
+    ) -> None:
+        """Run the handler of an event until it succeeds or the attempts are
+        exhausted. Errors of the given permanent types are not retried. An event
+        that fails is published to the dead-letter topic if one is configured,
+        otherwise the error is raised."""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                await handler()
+                return
+            except permanent_errors as error:
+                failure = error
+            except Exception as error:  # pylint: disable=broad-except
+                failure = error
+                if attempt < self._config.event_max_attempts:
+                    self._metrics.increment("event_retries")
+                    delay = self._config.event_retry_backoff_ms * 2 ** (attempt - 1)
+                    await asyncio.sleep(delay / 1000)
+                    continue
+
+            if not self.enabled:
+                raise failure
+            await self.publish(
+                topic=topic,
+                type_=type_,
+                payload=payload,
+                error_type=type(failure).__name__,
+                error=str(failure),
+                attempts=attempt,
+            )
+            return
+
+    async def publish(  # pylint: disable=too-many-arguments
+        self,
+        *,
+        topic: Ascii,
+        type_: Ascii,
+        payload: JsonObject,
+        error_type: str,
+        error: str,
+        attempts: int = 1,
+    ) -> None:
+        """Publish a failed event to the dead-letter topic"""
+        if self._config.event_dead_letter_topic is None:
+            raise RuntimeError("No dead-letter topic configured.")
+
+        key = str(payload.get("sample_id") or UNKNOWN_KEY)
+        dead_letter = DeadLetter(
+            original_topic=topic,
+            original_type=type_,
+            original_key=key,
+            payload=dict(payload),
+            error_type=error_type,
+            error=error,
+            attempts=attempts,
+            failed_at=datetime.now(timezone.utc),
+        )
+        await self._provider.publish(
+            payload=to_jsonable(dead_letter),
+            type_=type_,
+            key=key,
+            topic=self._config.event_dead_letter_topic,
+        )
+        self._metrics.increment("events_dead_lettered")
+        logging.warning(
+            "Sent %s event for key %s to the dead-letter topic after %i attempt(s):"
+            " %s: %s",
+            type_,
+            key,
+            attempts,
+            error_type,
+            error,
+        )
+
+
+class ReplayResult(NamedTuple):
+    """The number of dead letters that were replayed, and of those that were skipped
+    because they were malformed"""
+
+    replayed: int
+    skipped: int
+
+
+class DeadLetterReplayer:
+    """Publishes dead letters back to the topics they originally came from. Records
+    of the dead-letter topic that are not valid dead letters are logged and skipped."""
+
+    def __init__(
+        self,
+        *,
+        consumer: Any,
+        provider: EventPublisherProtocol,
+        idle_timeout_ms: int,
+        metrics: Optional[MetricsCollector] = None,
+    ):
+        self._consumer = consumer
+        self._provider = provider
+        self._idle_timeout_ms = idle_timeout_ms
+        self._metrics = metrics or MetricsCollector()
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls,
+        *,
+        config: KafkaConfig,
+        dead_letter_config: DeadLetterConfig,
+        provider: EventPublisherProtocol,
+        idle_timeout_ms: int = 1000,
+        kafka_consumer_cls: Any = AIOKafkaConsumer,
+    ) -> AsyncIterator["DeadLetterReplayer"]:
+        """Set up a consumer for the dead-letter topic in its own consumer group,
+        so that replaying doesn't interfere with the consumption of the original
+        topics"""
+        if dead_letter_config.event_dead_letter_topic is None:
+            raise RuntimeError("No dead-letter topic configured.")
+
+        replay_config = config.copy(
+            update={"service_name": f"{config.service_name}-dead-letter-replay"}
+        )
+        # the values are decoded by the replayer, so that malformed ones can be
+        # counted:
+        consumer = make_manual_commit_consumer(
+            config=replay_config,
+            topics=[dead_letter_config.event_dead_letter_topic],
+            kafka_consumer_cls=kafka_consumer_cls,
+        )
+        await consumer.start()
+        try:
+            yield cls(
+                consumer=consumer, provider=provider, idle_timeout_ms=idle_timeout_ms
+            )
+        finally:
+            await consumer.stop()
+
+    def _dead_letter_of(self, record: Any) -> Optional[DeadLetter]:
+        """Decode the dead letter of a record, or return None if the record has no
+        type header or its value is not a supported encoding of a dead letter"""
+        try:
+            get_event_type(record)
+            return DeadLetter(**decode_record_value(record))
+        except (EventTypeNotFoundError, TypeError, ValueError) as error:
+            logging.warning(
+                "Skipped a malformed dead letter: %s: %s", event_label(record), error
+            )
+            self._metrics.increment("dead_letters_skipped")
+            return None
+
+    async def _republish(self, records: Sequence[Any]) -> int:
+        """Publish the original events of the valid dead letters concurrently and
+        return their number"""
+        dead_letters = [
+            dead_letter
+            for dead_letter in map(self._dead_letter_of, records)
+            if dead_letter is not None
+        ]
+        await asyncio.gather(
+            *(
+                self._provider.publish(
+                    payload=dead_letter.payload,
+                    type_=dead_letter.original_type,
+                    key=dead_letter.original_key,
+                    topic=dead_letter.original_topic,
+                )
+                for dead_letter in dead_letters
+            )
+        )
+        return len(dead_letters)
+
+    async def run(self, *, max_events: Optional[int] = None) -> ReplayResult:
+        """Replay dead letters until no more arrive within the idle timeout or the
+        maximum number of records was consumed. Offsets are committed after each
+        bulk of records, so an interrupted replay resumes where it stopped, and
+        malformed records are not consumed again."""
+        replayed = skipped = 0
+        while max_events is None or replayed + skipped < max_events:
+            polled = await self._consumer.getmany(
+                timeout_ms=self._idle_timeout_ms,
+                max_records=(
+                    None if max_events is None else max_events - replayed - skipped
+                ),
+            )
+            records = [record for batch in polled.values() for record in batch]
+            if not records:
+                break
+            republished = await self._republish(records)
+            await self._consumer.commit()
+            replayed += republished
+            skipped += len(records) - republished
+        return ReplayResult(replayed=replayed, skipped=skipped)
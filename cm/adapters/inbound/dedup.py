@@ -0,0 +1,148 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Skipping events that were already processed, such as redeliveries after a
+consumer group rebalance"""
+
+from collections import OrderedDict
+from collections.abc import Sequence
+from typing import NamedTuple, Optional
+
+from pydantic import BaseSettings, Field
+
+from cm.adapters.inbound.kafka_consumer import ConsumedEvent
+from cm.adapters.outbound.dao import SampleDaoFactory
+from cm.core.metrics import MetricsCollector
+from cm.ports.outbound.processed_events import ProcessedEventStorePort
+
+
+class EventDeduplicationConfig(BaseSettings):
+    """Config for skipping events that were already processed"""
+
+    event_dedup_window_size: int = Field(
+        0,
+        ge=0,
+        description=(
+            "Number of recently processed events to remember, so that redelivered"
+            + " events are skipped. Events are identified by their topic, partition"
+            + " and offset. Set to 0 to disable."
+        ),
+        example=10000,
+    )
+    event_dedup_persistent: bool = Field(
+        False,
+        description=(
+            "Whether to also remember processed events in the database, so that"
+            + " redeliveries are detected across restarts and instances"
+        ),
+        example=False,
+    )
+    event_dedup_ttl_seconds: int = Field(
+        86400,
+        ge=1,
+        description="Number of seconds processed events are remembered in the database",
+        example=86400,
+    )
+
+
+class EventIdentity(NamedTuple):
+    """Identifies an event by a key and a fingerprint of its content. An event is a
+    duplicate if the last event processed with the same key had the same
+    fingerprint."""
+
+    key: str
+    fingerprint: str
+
+
+def identify_by_offset(event: ConsumedEvent) -> EventIdentity:
+    """Identify an event by its position in the topic"""
+    return EventIdentity(
+        key=f"{event.topic}/{event.partition}/{event.offset}", fingerprint=""
+    )
+
+
+class EventDeduplicator:
+    """Remembers the identities of recently processed events in a bounded window,
+    and optionally in a persistent store"""
+
+    def __init__(
+        self,
+        *,
+        window_size: int,
+        store: Optional[ProcessedEventStorePort] = None,
+        metrics: Optional[MetricsCollector] = None,
+    ):
+        self._window_size = window_size
+        self._window: OrderedDict[str, str] = OrderedDict()
+        self._store = store
+        self._metrics = metrics or MetricsCollector()
+
+    @classmethod
+    async def construct(
+        cls,
+        *,
+        config: EventDeduplicationConfig,
+        dao_factory: SampleDaoFactory,
+        metrics: MetricsCollector,
+    ) -> Optional["EventDeduplicator"]:
+        """Returns None if deduplication is disabled"""
+        if not config.event_dedup_window_size:
+            return None
+
+        store = (
+            await dao_factory.get_processed_event_store(
+                name="processed_events", ttl_seconds=config.event_dedup_ttl_seconds
+            )
+            if config.event_dedup_persistent
+            else None
+        )
+        return cls(
+            window_size=config.event_dedup_window_size, store=store, metrics=metrics
+        )
+
+    def _remember_locally(self, key: str, fingerprint: str) -> None:
+        """Add the identity to the window, evicting the least recently used"""
+        self._window[key] = fingerprint
+        self._window.move_to_end(key)
+        while len(self._window) > self._window_size:
+            self._window.popitem(last=False)
+
+    async def seen(self, identities: Sequence[EventIdentity]) -> list[bool]:
+        """Tell for each event whether it was already processed. The persistent
+        store, if any, is only queried for the keys missing from the window."""
+        fingerprints = {
+            identity.key: self._window[identity.key]
+            for identity in identities
+            if identity.key in self._window
+        }
+        missing = {identity.key for identity in identities} - fingerprints.keys()
+        if missing and self._store is not None:
+            fingerprints.update(await self._store.get_many(missing))
+
+        seen = [
+            fingerprints.get(identity.key) == identity.fingerprint
+            for identity in identities
+        ]
+        self._metrics.increment("events_deduplicated", sum(seen))
+        return seen
+
+    async def remember(self, identities: Sequence[EventIdentity]) -> None:
+        """Remember that the events were processed"""
+        for identity in identities:
+            self._remember_locally(identity.key, identity.fingerprint)
+        if identities and self._store is not None:
+            await self._store.put_many(
+                {identity.key: identity.fingerprint for identity in identities}
+            )
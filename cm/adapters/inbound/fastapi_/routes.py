@@ -26,7 +26,7 @@ world sees and what the API sees is that the API sees the data repository, which
 in whole objects. The API will take the result of a call to the data repository and
 return either the whole result or a subset of the result. An example is in get_sample,
 where the data repository returns a complete Sample object, but the API returns
-everything except for the access_token and sample_id fields. The data repository doesn't
+everything except for the access_token_hash field. The data repository doesn't
 care about what the API wants or needs, and the API doesn't care about what the data
 repository does at night.
 
@@ -37,23 +37,72 @@ container.py, is responsible for configuration and provision of objects like the
 data_repository and DAO.
 """
 
+import secrets
+from typing import Any, Optional, Union
+
 from dependency_injector.wiring import Provide, inject
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Body, Depends, Query
 from fastapi.exceptions import HTTPException
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 
+from cm.adapters.serialization import FastJSONResponse
 from cm.container import Container
 from cm.core import models
+from cm.core.metrics import MetricsCollector, MetricsConfig
 from cm.ports.inbound.data_repository import DataRepositoryPort
 
 MSG_NOT_FOUND = "Specified resource was not found."
 MSG_UNAUTHORIZED = "Unauthorized access requested"
+MSG_SESSION_TOKENS_DISABLED = "Session tokens are not enabled."
+MSG_METRICS_DISABLED = "Metrics are not enabled."
+MSG_UPDATE_CONFLICT = "The resource is being modified concurrently, please retry."
+MSG_PUBLISHING_BACKLOG = (
+    "The update was stored, but the service is overloaded and could not announce it."
+)
+MSG_UNKNOWN_FIELDS = "Unknown fields requested: {}"
+MSG_NO_FIELDS = "No fields requested, omit the parameter to request all fields."
+MAX_BATCH_SIZE = 1000
+
+# the fields of samples that can be requested from GET /samples/{sample_id}:
+SAMPLE_FIELDS = (
+    frozenset(models.Sample.__fields__)
+    - models.SAMPLE_AUTH_FIELDS
+    - models.SAMPLE_INTERNAL_FIELDS
+)
 
 # This APIRouter instance will be referenced/included by 'app' in main.py
 sample_router = APIRouter()
 
 # To instruct FastAPI how to authenticate requests that need it
 bearer_scheme = HTTPBearer()
+optional_bearer_scheme = HTTPBearer(auto_error=False)
+
+
+def parse_fields(fields: Optional[str]) -> Optional[set[str]]:
+    """Parse the comma-separated field names of a projection, or return None if
+    all fields are requested. Raises a 422 error if no names or names that are not
+    fields are given."""
+    if fields is None:
+        return None
+    requested = {name.strip() for name in fields.split(",") if name.strip()}
+    if not requested:
+        raise HTTPException(status_code=422, detail=MSG_NO_FIELDS)
+    unknown = requested - SAMPLE_FIELDS
+    if unknown:
+        raise HTTPException(
+            status_code=422,
+            detail=MSG_UNKNOWN_FIELDS.format(", ".join(sorted(unknown))),
+        )
+    return requested
+
+
+def sample_response(
+    sample: models.Sample, *, excluded: frozenset[str]
+) -> dict[str, Any]:
+    """Return the field values of the sample without the excluded fields"""
+    return {
+        name: value for name, value in sample.__dict__.items() if name not in excluded
+    }
 
 
 # GET /sample
@@ -61,21 +110,37 @@ bearer_scheme = HTTPBearer()
     "/samples/{sample_id}",
     status_code=200,
     summary="Retrieve a existing sample",
-    response_model=dict,
+    response_model=Union[models.SampleResponse, models.SampleProjection],
+    response_class=FastJSONResponse,
 )
 @inject
 async def get_sample(
     sample_id: str,
+    fields: Optional[str] = Query(
+        None,
+        description=(
+            "Comma-separated names of the fields to return, besides the sample_id."
+            + " All fields are returned if omitted."
+        ),
+        example="status,test_result",
+    ),
     data_repository: DataRepositoryPort = Depends(Provide[Container.data_repository]),
     authorization: HTTPAuthorizationCredentials = Depends(bearer_scheme),
-) -> models.Sample:
+) -> FastJSONResponse:
     """
     Retrieve information for a test sample matching the access token.
     """
 
     access_token = authorization.credentials
+    requested = parse_fields(fields)
 
     try:
+        if requested is not None:
+            return FastJSONResponse(
+                await data_repository.retrieve_sample_fields(
+                    sample_id=sample_id, access_token=access_token, fields=requested
+                )
+            )
         sample = await data_repository.retrieve_sample(
             sample_id=sample_id, access_token=access_token
         )
@@ -84,7 +149,48 @@ async def get_sample(
         raise HTTPException(status_code=404, detail=MSG_NOT_FOUND) from err
     except DataRepositoryPort.UnauthorizedRequestError as err:
         raise HTTPException(status_code=403, detail=MSG_UNAUTHORIZED) from err
-    return sample
+    return FastJSONResponse(
+        sample_response(
+            sample,
+            excluded=models.SAMPLE_AUTH_FIELDS | models.SAMPLE_INTERNAL_FIELDS,
+        )
+    )
+
+
+# POST /samples/{sample_id}/session
+@sample_router.post(
+    "/samples/{sample_id}/session",
+    status_code=201,
+    summary="Exchange an access token for a short-lived session token",
+    response_model=models.SessionToken,
+    response_class=FastJSONResponse,
+)
+@inject
+async def post_session_token(
+    sample_id: str,
+    data_repository: DataRepositoryPort = Depends(Provide[Container.data_repository]),
+    authorization: HTTPAuthorizationCredentials = Depends(bearer_scheme),
+) -> FastJSONResponse:
+    """
+    Verifies the access token once and returns a session token, which can be used
+    instead of the access token for this sample until it expires.
+    """
+
+    access_token = authorization.credentials
+
+    try:
+        session_token = await data_repository.create_session_token(
+            sample_id=sample_id, access_token=access_token
+        )
+    except DataRepositoryPort.SessionTokensDisabledError as err:
+        raise HTTPException(
+            status_code=404, detail=MSG_SESSION_TOKENS_DISABLED
+        ) from err
+    except DataRepositoryPort.SampleNotFoundError as err:
+        raise HTTPException(status_code=404, detail=MSG_NOT_FOUND) from err
+    except DataRepositoryPort.UnauthorizedRequestError as err:
+        raise HTTPException(status_code=403, detail=MSG_UNAUTHORIZED) from err
+    return FastJSONResponse(session_token, status_code=201)
 
 
 # POST /sample
@@ -92,15 +198,41 @@ async def get_sample(
     "/samples",
     summary="Upload a new sample",
     status_code=201,
-    response_model=models.SampleAuthDetails,
+    response_model=models.SampleCreationResponse,
+    response_class=FastJSONResponse,
 )
 @inject
 async def post_sample(
     data: models.SampleCreation,
     data_repository: DataRepositoryPort = Depends(Provide[Container.data_repository]),
-) -> models.SampleAuthDetails:
+) -> FastJSONResponse:
     """Posts a new sample to the database"""
-    return await data_repository.create_sample(sample_creation=data)
+    sample = await data_repository.create_sample(sample_creation=data)
+    return FastJSONResponse(
+        sample_response(sample, excluded=models.SAMPLE_INTERNAL_FIELDS),
+        status_code=201,
+    )
+
+
+# POST /samples:batch
+@sample_router.post(
+    "/samples:batch",
+    summary="Upload multiple new samples",
+    status_code=200,
+    response_model=list[models.SampleBatchCreationResult],
+    response_class=FastJSONResponse,
+)
+@inject
+async def post_samples_batch(
+    data: list[dict[str, Any]] = Body(..., min_items=1, max_items=MAX_BATCH_SIZE),
+    data_repository: DataRepositoryPort = Depends(Provide[Container.data_repository]),
+) -> FastJSONResponse:
+    """
+    Posts multiple new samples to the database. Each item is validated and created
+    independently, the response holds one result per item in the submitted order.
+    """
+    results = await data_repository.create_samples(sample_creations=data)
+    return FastJSONResponse(results)
 
 
 # PATCH /sample
@@ -125,3 +257,61 @@ async def update_sample(
         raise HTTPException(status_code=404, detail=MSG_NOT_FOUND) from err
     except DataRepositoryPort.UnauthorizedRequestError as err:
         raise HTTPException(status_code=403, detail=MSG_UNAUTHORIZED) from err
+    except DataRepositoryPort.UpdateConflictError as err:
+        raise HTTPException(status_code=409, detail=MSG_UPDATE_CONFLICT) from err
+    except DataRepositoryPort.PublishingBacklogError as err:
+        raise HTTPException(status_code=503, detail=MSG_PUBLISHING_BACKLOG) from err
+
+
+# GET /metrics
+@sample_router.get(
+    "/metrics",
+    status_code=200,
+    summary="Report performance metrics of the service",
+    response_model=dict[str, float],
+)
+@inject
+async def get_metrics(
+    metrics: MetricsCollector = Depends(Provide[Container.metrics]),
+    config: MetricsConfig = Depends(Provide[Container.config]),
+    authorization: Optional[HTTPAuthorizationCredentials] = Depends(
+        optional_bearer_scheme
+    ),
+) -> dict[str, float]:
+    """
+    Returns the current value of all counters and gauges. Requires the configured
+    metrics token, the endpoint is disabled if no metrics token is configured.
+    """
+    if config.metrics_token is None:
+        raise HTTPException(status_code=404, detail=MSG_METRICS_DISABLED)
+    if authorization is None or not secrets.compare_digest(
+        authorization.credentials.encode(),
+        config.metrics_token.get_secret_value().encode(),
+    ):
+        raise HTTPException(status_code=403, detail=MSG_UNAUTHORIZED)
+    return metrics.snapshot()
+
+
+# PATCH /samples:batch
+@sample_router.patch(
+    "/samples:batch",
+    status_code=200,
+    summary="Update the test results of multiple existing samples",
+    response_model=list[models.SampleBatchUpdateResult],
+    response_class=FastJSONResponse,
+)
+@inject
+async def update_samples_batch(
+    data: list[dict[str, Any]] = Body(..., min_items=1, max_items=MAX_BATCH_SIZE),
+    data_repository: DataRepositoryPort = Depends(Provide[Container.data_repository]),
+) -> FastJSONResponse:
+    """
+    Updates multiple existing samples. Each item holds the sample_id, the
+    access_token for that sample, and the updates. The response holds one result per
+    item in the submitted order.
+    """
+    try:
+        results = await data_repository.update_samples(updates=data)
+    except DataRepositoryPort.PublishingBacklogError as err:
+        raise HTTPException(status_code=503, detail=MSG_PUBLISHING_BACKLOG) from err
+    return FastJSONResponse(results)
@@ -0,0 +1,686 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Kafka event subscribers that pass the position of each event on to the translator.
+Events are processed one at a time, in batches, or concurrently, and in the latter
+two modes only offsets of events that were processed successfully are committed."""
+
+import asyncio
+import dataclasses
+import logging
+import time
+import zlib
+from abc import abstractmethod
+from collections import deque
+from collections.abc import AsyncIterator, Collection, Sequence
+from contextlib import asynccontextmanager
+from typing import Any, Literal, NamedTuple, Optional
+
+from aiokafka import (
+    AIOKafkaConsumer,
+    ConsumerRebalanceListener,
+    ConsumerRecord,
+    TopicPartition,
+)
+from hexkit.base import InboundProviderBase
+from hexkit.custom_types import Ascii, JsonObject
+from hexkit.protocols.eventsub import EventSubscriberProtocol
+from hexkit.providers.akafka import KafkaConfig, KafkaEventSubscriber
+from hexkit.providers.akafka.provider import (
+    EventTypeNotFoundError,
+    generate_client_id,
+    get_event_type,
+)
+from pydantic import Field
+
+from cm.adapters.serialization import (
+    CONTENT_TYPE_HEADER,
+    EVENT_SCHEMA_VERSION,
+    SCHEMA_VERSION_HEADER,
+    EventDecodingError,
+    decode_event,
+)
+from cm.core.metrics import MetricsCollector
+
+
+class EventConsumerConfig(KafkaConfig):
+    """Config for connecting to Kafka and for how events are consumed"""
+
+    event_consumption_mode: Literal["single", "batch", "concurrent"] = Field(
+        "single",
+        description=(
+            "'single' processes one event at a time. 'batch' collects events and"
+            + " processes them together, committing the offsets only after the whole"
+            + " batch was processed. 'concurrent' distributes events among workers by"
+            + " sample ID, so that events for different samples are processed in"
+            + " parallel while events for the same sample keep their order."
+        ),
+        example="single",
+    )
+    event_batch_max_size: int = Field(
+        500,
+        ge=1,
+        description="Maximum number of events processed as one batch",
+        example=500,
+    )
+    event_batch_max_wait_ms: int = Field(
+        100,
+        ge=0,
+        description=(
+            "Number of milliseconds to wait for more events after the first event of"
+            + " a batch has arrived"
+        ),
+        example=100,
+    )
+    event_workers: int = Field(
+        8,
+        ge=1,
+        description="Number of workers processing events in the 'concurrent' mode",
+        example=8,
+    )
+    event_worker_queue_size: int = Field(
+        100,
+        ge=1,
+        description=(
+            "Maximum number of events waiting for each worker in the 'concurrent'"
+            + " mode. Consumption pauses while the queue of a worker is full."
+        ),
+        example=100,
+    )
+    event_commit_interval_ms: int = Field(
+        1000,
+        ge=1,
+        description=(
+            "In the 'concurrent' mode, offsets of processed events are committed at"
+            + " least this often (in milliseconds)"
+        ),
+        example=1000,
+    )
+
+
+class ConsumedEvent(NamedTuple):
+    """An event of interest along with its position in the topic"""
+
+    topic: Ascii
+    partition: int
+    offset: int
+    key: Ascii
+    type_: Ascii
+    payload: JsonObject
+
+
+class EventBatchSubscriberProtocol(EventSubscriberProtocol):
+    """An EventSubscriberProtocol that can also process events along with their
+    position in the topic, one at a time or multiple at once"""
+
+    @abstractmethod
+    async def consume_event(self, event: ConsumedEvent) -> None:
+        """Process a single event, which is of a type of interest"""
+        ...
+
+    @abstractmethod
+    async def consume_batch(self, events: Sequence[ConsumedEvent]) -> None:
+        """Process the events, which are all of the types of interest, in the order
+        they were received. Raises an exception if the batch has to be processed
+        again."""
+        ...
+
+
+def consumed_event(record: Any, type_: Ascii) -> ConsumedEvent:
+    """The event of the record, whose type is already known"""
+    return ConsumedEvent(
+        topic=record.topic,
+        partition=record.partition,
+        offset=record.offset,
+        key=record.key,
+        type_=type_,
+        payload=record.value,
+    )
+
+
+def decode_record_value(record: Any) -> Any:
+    """Decode the raw value of a record in the encoding given by its content-type
+    header. Raises an EventDecodingError if the encoding or the schema version given
+    in the headers is not supported. Records without these headers are expected to
+    be JSON in the current schema."""
+    headers = {name: value.decode("ascii", "replace") for name, value in record.headers}
+    schema_version = headers.get(SCHEMA_VERSION_HEADER)
+    if schema_version is not None and schema_version != EVENT_SCHEMA_VERSION:
+        raise EventDecodingError(f"Unsupported schema version: {schema_version}")
+    return decode_event(record.value, content_type=headers.get(CONTENT_TYPE_HEADER))
+
+
+def decode_record(record: ConsumerRecord) -> Optional[ConsumerRecord]:
+    """Returns the record with its value decoded, or None if it can't be decoded"""
+    try:
+        return dataclasses.replace(record, value=decode_record_value(record))
+    except ValueError as error:
+        logging.warning(
+            "Ignored an event that can't be decoded: %s: %s", event_label(record), error
+        )
+        return None
+
+
+class DecodingConsumer(AIOKafkaConsumer):
+    """A Kafka consumer that decodes events in the encoding given by their headers,
+    instead of only JSON. Events that can't be decoded, for example because of an
+    unknown schema version, are logged and skipped."""
+
+    def __init__(self, *topics, **kwargs):
+        super().__init__(*topics, **{**kwargs, "value_deserializer": None})
+
+    async def getone(self, *partitions) -> ConsumerRecord:
+        """Get the next record that can be decoded"""
+        while True:
+            record = decode_record(await super().getone(*partitions))
+            if record is not None:
+                return record
+
+    async def getmany(
+        self, *partitions, timeout_ms: int = 0, max_records: Optional[int] = None
+    ) -> dict[TopicPartition, list[ConsumerRecord]]:
+        """Get the records of the next poll that can be decoded, by partition"""
+        polled = await super().getmany(
+            *partitions, timeout_ms=timeout_ms, max_records=max_records
+        )
+        decoded = {
+            partition: [
+                record for record in map(decode_record, records) if record is not None
+            ]
+            for partition, records in polled.items()
+        }
+        return {partition: records for partition, records in decoded.items() if records}
+
+
+def make_manual_commit_consumer(
+    *, config: KafkaConfig, topics: Sequence[Ascii], kafka_consumer_cls: Any
+) -> Any:
+    """Create a consumer like hexkit's KafkaEventSubscriber does, but with automatic
+    committing of offsets disabled. The values are not deserialized, which is left to
+    the kafka_consumer_cls, such as the DecodingConsumer."""
+    client_id = generate_client_id(
+        service_name=config.service_name, instance_id=config.service_instance_id
+    )
+    return kafka_consumer_cls(
+        *topics,
+        bootstrap_servers=",".join(config.kafka_servers),
+        client_id=client_id,
+        group_id=config.service_name,
+        auto_offset_reset="earliest",
+        enable_auto_commit=False,
+        key_deserializer=lambda event_key: event_key.decode("ascii"),
+    )
+
+
+def event_label(record: Any) -> str:
+    """A label that identifies an event"""
+    return f"{record.topic} - {record.partition} - {record.offset} (topic-partition-offset)"
+
+
+def event_type_of_interest(
+    record: Any, types_of_interest: Sequence[Ascii]
+) -> Optional[str]:
+    """Returns the type of the record, or None if it has no type or one that is not of
+    interest"""
+    try:
+        type_ = get_event_type(record)
+    except EventTypeNotFoundError:
+        logging.warning("Ignored an event without type: %s", event_label(record))
+        return None
+    if type_ not in types_of_interest:
+        logging.info("Ignored event of type %s: %s", type_, event_label(record))
+        return None
+    return type_
+
+
+class KafkaSingleEventSubscriber(KafkaEventSubscriber):
+    """Apache Kafka-specific event subscription provider that passes one event at a
+    time to the translator, like hexkit's KafkaEventSubscriber, but along with the
+    position of the event in the topic"""
+
+    _translator: EventBatchSubscriberProtocol
+
+    async def _consume_event(self, event: Any) -> None:
+        """Consume an event by passing it down to the translator"""
+        type_ = event_type_of_interest(event, self._translator.types_of_interest)
+        if type_ is None:
+            return
+
+        logging.info('Consuming event of type "%s": %s', type_, event_label(event))
+        try:
+            # blocks until event processing is completed:
+            await self._translator.consume_event(consumed_event(event, type_))
+        except Exception:
+            logging.error(
+                "A fatal error occured while processing the event: %s",
+                event_label(event),
+            )
+            raise
+
+
+class KafkaBatchEventSubscriber(InboundProviderBase):
+    """Apache Kafka-specific event subscription provider that passes events to the
+    translator in batches. Offsets are committed manually after each batch, so a
+    batch that failed is consumed again after a restart."""
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls,
+        *,
+        config: EventConsumerConfig,
+        translator: EventBatchSubscriberProtocol,
+        metrics: Optional[MetricsCollector] = None,
+        kafka_consumer_cls: Any = DecodingConsumer,
+    ):
+        """Setup and teardown a KafkaBatchEventSubscriber. The kafka_consumer_cls can
+        be overwritten for unit testing."""
+        consumer = make_manual_commit_consumer(
+            config=config,
+            topics=translator.topics_of_interest,
+            kafka_consumer_cls=kafka_consumer_cls,
+        )
+        try:
+            await consumer.start()
+            yield cls(
+                consumer=consumer,
+                translator=translator,
+                max_size=config.event_batch_max_size,
+                max_wait_seconds=config.event_batch_max_wait_ms / 1000,
+                metrics=metrics,
+            )
+        finally:
+            await consumer.stop()
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        *,
+        consumer: Any,
+        translator: EventBatchSubscriberProtocol,
+        max_size: int,
+        max_wait_seconds: float,
+        metrics: Optional[MetricsCollector] = None,
+    ):
+        """Please do not call directly! Should be called by the `construct` method."""
+        self._consumer = consumer
+        self._translator = translator
+        self._max_size = max_size
+        self._max_wait_seconds = max_wait_seconds
+        self._metrics = metrics
+
+    async def _next_records(self) -> list[Any]:
+        """Wait for the first record, then collect records until the batch is full or
+        the maximum waiting time has passed"""
+        records: list[Any] = []
+        deadline = 0.0
+        while len(records) < self._max_size:
+            if records:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                timeout_ms = int(remaining * 1000)
+            else:
+                timeout_ms = int(self._max_wait_seconds * 1000)
+
+            polled = await self._consumer.getmany(
+                timeout_ms=timeout_ms, max_records=self._max_size - len(records)
+            )
+            new_records = [record for batch in polled.values() for record in batch]
+            if not new_records and records:
+                break
+            if new_records and not records:
+                deadline = time.monotonic() + self._max_wait_seconds
+            records.extend(new_records)
+        return records
+
+    def _events_of_interest(self, records: Sequence[Any]) -> list[ConsumedEvent]:
+        """Filter out the records without a type or of types not of interest"""
+        events = []
+        for record in records:
+            type_ = event_type_of_interest(record, self._translator.types_of_interest)
+            if type_ is None:
+                continue
+            events.append(consumed_event(record, type_))
+        return events
+
+    async def _consume_batch(self) -> None:
+        """Process the next batch and commit its offsets"""
+        records = await self._next_records()
+        events = self._events_of_interest(records)
+        if events:
+            try:
+                await self._translator.consume_batch(events)
+            except Exception:
+                logging.error(
+                    "A fatal error occured while processing a batch of %i events",
+                    len(events),
+                )
+                raise
+        await self._consumer.commit()
+
+        if self._metrics is not None:
+            self._metrics.increment("event_batches_consumed")
+            self._metrics.increment("events_consumed", len(events))
+
+    async def run(self, forever: bool = True) -> None:
+        """Start consuming batches of events and passing them down to the translator.
+        By default, it blocks forever. Set `forever` to `False` to make it return after
+        handling one batch."""
+        await self._consume_batch()
+        while forever:
+            await self._consume_batch()
+
+
+# a topic and a partition number:
+PartitionKey = tuple[str, int]
+# how often a revoked partition is checked for records that are still in flight:
+DRAIN_POLL_SECONDS = 0.01
+
+
+class OffsetTracker:
+    """Tracks which of the dispatched records were processed, to find the offsets
+    that can be committed: those below the first record that is still in flight."""
+
+    def __init__(self):
+        # the offsets in flight and the processed ones, per topic-partition:
+        self._in_flight: dict[PartitionKey, deque[int]] = {}
+        self._processed: dict[PartitionKey, set[int]] = {}
+
+    def dispatched(self, partition: PartitionKey, offset: int) -> None:
+        """Register a record that is about to be processed"""
+        self._in_flight.setdefault(partition, deque()).append(offset)
+        self._processed.setdefault(partition, set())
+
+    def processed(self, partition: PartitionKey, offset: int) -> None:
+        """Register a record that was processed. Records of partitions that were
+        forgotten in the meantime are ignored."""
+        processed = self._processed.get(partition)
+        if processed is not None:
+            processed.add(offset)
+
+    def pending(self, partitions: Optional[Collection[PartitionKey]] = None) -> int:
+        """The number of records that were dispatched but not yet committable, in the
+        given or in all partitions"""
+        if partitions is None:
+            return sum(map(len, self._in_flight.values()))
+        return sum(len(self._in_flight.get(partition, ())) for partition in partitions)
+
+    def forget(self, partitions: Collection[PartitionKey]) -> None:
+        """Stop tracking the records of the partitions"""
+        for partition in partitions:
+            self._in_flight.pop(partition, None)
+            self._processed.pop(partition, None)
+
+    def committable(
+        self, partitions: Collection[PartitionKey]
+    ) -> dict[PartitionKey, int]:
+        """Returns the offsets to commit for those of the given partitions that
+        advanced since the last call, which are the offsets of the next records to
+        consume"""
+        offsets = {}
+        for partition in partitions:
+            in_flight = self._in_flight.get(partition)
+            if in_flight is None:
+                continue
+            processed = self._processed[partition]
+            while in_flight and in_flight[0] in processed:
+                offset = in_flight.popleft()
+                processed.discard(offset)
+                offsets[partition] = offset + 1
+        return offsets
+
+
+class DrainingRebalanceListener(ConsumerRebalanceListener):
+    """Lets the KafkaConcurrentEventSubscriber finish the records of partitions that
+    are revoked in a rebalance, before they are assigned to another consumer. The
+    aiokafka consumer awaits the callbacks if they are coroutines."""
+
+    # pylint: disable=invalid-overridden-method
+
+    def __init__(self, subscriber: "KafkaConcurrentEventSubscriber"):
+        self._subscriber = subscriber
+
+    async def on_partitions_revoked(self, revoked: set[TopicPartition]) -> None:
+        """Drain and commit the revoked partitions"""
+        await self._subscriber.drain(revoked)
+
+    async def on_partitions_assigned(self, assigned: set[TopicPartition]) -> None:
+        """Consumption of the partitions continues from the committed offsets"""
+        self._subscriber.assigned(assigned)
+
+
+class KafkaConcurrentEventSubscriber(  # pylint: disable=too-many-instance-attributes
+    InboundProviderBase
+):
+    """Apache Kafka-specific event subscription provider that distributes events among
+    a number of workers by the hash of their sample ID (or key). Events for the same
+    sample are processed by the same worker, in order, while different samples are
+    processed concurrently. Offsets are committed manually and in order, so that only
+    processed events are committed, and only for partitions that are assigned to this
+    consumer. Partitions that are revoked in a rebalance are drained and committed
+    first. Events that were in flight during a restart may be processed again."""
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls,
+        *,
+        config: EventConsumerConfig,
+        translator: EventBatchSubscriberProtocol,
+        metrics: Optional[MetricsCollector] = None,
+        kafka_consumer_cls: Any = DecodingConsumer,
+    ):
+        """Setup and teardown a KafkaConcurrentEventSubscriber. The kafka_consumer_cls
+        can be overwritten for unit testing."""
+        consumer = make_manual_commit_consumer(
+            config=config, topics=(), kafka_consumer_cls=kafka_consumer_cls
+        )
+        subscriber = cls(
+            consumer=consumer,
+            translator=translator,
+            workers=config.event_workers,
+            queue_size=config.event_worker_queue_size,
+            commit_interval_seconds=config.event_commit_interval_ms / 1000,
+            metrics=metrics,
+        )
+        consumer.subscribe(
+            topics=list(translator.topics_of_interest),
+            listener=DrainingRebalanceListener(subscriber),
+        )
+        try:
+            await consumer.start()
+            yield subscriber
+        finally:
+            await consumer.stop()
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        *,
+        consumer: Any,
+        translator: EventBatchSubscriberProtocol,
+        workers: int,
+        queue_size: int,
+        commit_interval_seconds: float = 1.0,
+        metrics: Optional[MetricsCollector] = None,
+    ):
+        """Please do not call directly! Should be called by the `construct` method."""
+        self._consumer = consumer
+        self._translator = translator
+        self._queues: list[asyncio.Queue] = [
+            asyncio.Queue(maxsize=queue_size) for _ in range(workers)
+        ]
+        self._commit_interval_seconds = commit_interval_seconds
+        self._metrics = metrics
+        self._offsets = OffsetTracker()
+        # partitions whose remaining polled records are not dispatched anymore:
+        self._revoked: set[PartitionKey] = set()
+        self._failure: Optional[BaseException] = None
+        self._run_task: Optional[asyncio.Task] = None
+
+        if metrics is not None:
+            metrics.register_gauge(
+                "event_worker_queue_depth",
+                lambda: sum(queue.qsize() for queue in self._queues),
+            )
+
+    def _worker_for(self, record: Any) -> asyncio.Queue:
+        """The queue of the worker responsible for the sample of the record"""
+        value = record.value if isinstance(record.value, dict) else {}
+        routing_key = str(value.get("sample_id") or record.key)
+        return self._queues[zlib.crc32(routing_key.encode()) % len(self._queues)]
+
+    async def _work(self, queue: asyncio.Queue) -> None:
+        """Process the records of the queue one after the other"""
+        while True:
+            record, type_ = await queue.get()
+            try:
+                await self._translator.consume_event(consumed_event(record, type_))
+            except Exception as error:  # pylint: disable=broad-except
+                logging.error(
+                    "A fatal error occured while processing the event: %s",
+                    event_label(record),
+                )
+                # stop consuming, without committing this or any later offset:
+                self._failure = error
+                if self._run_task is not None:
+                    self._run_task.cancel()
+                return
+            self._offsets.processed((record.topic, record.partition), record.offset)
+            queue.task_done()
+            if self._metrics is not None:
+                self._metrics.increment("events_consumed")
+
+    async def _dispatch(self, record: Any) -> None:
+        """Pass the record to its worker, waiting while the worker's queue is full.
+        Records that are not of interest are processed right away."""
+        partition = (record.topic, record.partition)
+        self._offsets.dispatched(partition, record.offset)
+        type_ = event_type_of_interest(record, self._translator.types_of_interest)
+        if type_ is None:
+            self._offsets.processed(partition, record.offset)
+        else:
+            await self._worker_for(record).put((record, type_))
+
+    def _assigned(self) -> set[PartitionKey]:
+        """The partitions currently assigned to this consumer"""
+        return {
+            (partition.topic, partition.partition)
+            for partition in self._consumer.assignment()
+        }
+
+    async def _commit(self, partitions: Optional[Collection[PartitionKey]] = None):
+        """Commit the offsets up to the first record still in flight, of the given
+        partitions or of all assigned ones"""
+        if partitions is None:
+            partitions = self._assigned()
+        offsets = self._offsets.committable(partitions)
+        if offsets:
+            await self._consumer.commit(
+                {
+                    TopicPartition(topic, partition): offset
+                    for (topic, partition), offset in offsets.items()
+                }
+            )
+
+    async def _consume(self, forever: bool) -> None:
+        """Dispatch records and commit processed ones in the configured interval"""
+        next_commit = time.monotonic() + self._commit_interval_seconds
+        while True:
+            polled = await self._consumer.getmany(
+                timeout_ms=int(self._commit_interval_seconds * 1000)
+            )
+            for partition, records in polled.items():
+                for record in records:
+                    # the partition may be revoked while waiting for a worker:
+                    if (partition.topic, partition.partition) in self._revoked:
+                        break
+                    await self._dispatch(record)
+
+            if not forever and self._offsets.pending():
+                await asyncio.gather(*(queue.join() for queue in self._queues))
+                await self._commit()
+                return
+            if time.monotonic() >= next_commit:
+                await self._commit()
+                next_commit = time.monotonic() + self._commit_interval_seconds
+
+    async def drain(self, revoked: Collection[TopicPartition]) -> None:
+        """Wait until the dispatched records of the revoked partitions were processed,
+        commit them and stop tracking the partitions. Nothing is committed if a worker
+        failed, so the records are processed again by the next owner."""
+        partitions = {(partition.topic, partition.partition) for partition in revoked}
+        self._revoked.update(partitions)
+        while self._offsets.pending(partitions) and self._failure is None:
+            await asyncio.sleep(DRAIN_POLL_SECONDS)
+        if self._failure is None:
+            await self._commit(partitions)
+        self._offsets.forget(partitions)
+
+    def assigned(self, assigned: Collection[TopicPartition]) -> None:
+        """Resume dispatching records of partitions that are assigned again"""
+        self._revoked.difference_update(
+            (partition.topic, partition.partition) for partition in assigned
+        )
+
+    async def run(self, forever: bool = True) -> None:
+        """Start consuming events and passing them down to the workers. By default, it
+        blocks forever. Set `forever` to `False` to make it return once the events of
+        one poll were processed and committed."""
+        self._run_task = asyncio.current_task()
+        workers = [asyncio.create_task(self._work(queue)) for queue in self._queues]
+        try:
+            await self._consume(forever)
+        except asyncio.CancelledError:
+            if self._failure is None:
+                raise
+            raise self._failure  # pylint: disable=raise-missing-from
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            if self._failure is None:
+                await self._commit()
+
+
+class EventSubscriberConstructor:
+    """Constructor compatible with the hexkit.inject.AsyncContextConstructable type.
+    Used to construct the subscriber for the configured consumption mode."""
+
+    @staticmethod
+    @asynccontextmanager
+    async def construct(
+        *,
+        config: EventConsumerConfig,
+        translator: EventBatchSubscriberProtocol,
+        metrics: MetricsCollector,
+    ) -> AsyncIterator[InboundProviderBase]:
+        """Setup and teardown the event subscriber"""
+        if config.event_consumption_mode == "batch":
+            async with KafkaBatchEventSubscriber.construct(
+                config=config, translator=translator, metrics=metrics
+            ) as subscriber:
+                yield subscriber
+        elif config.event_consumption_mode == "concurrent":
+            async with KafkaConcurrentEventSubscriber.construct(
+                config=config, translator=translator, metrics=metrics
+            ) as concurrent_subscriber:
+                yield concurrent_subscriber
+        else:
+            async with KafkaSingleEventSubscriber.construct(
+                config=config,
+                translator=translator,
+                kafka_consumer_cls=DecodingConsumer,
+            ) as single_subscriber:
+                yield single_subscriber
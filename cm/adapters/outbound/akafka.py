@@ -14,13 +14,20 @@
 # limitations under the License.
 #
 """Kafka-based event publishing adapters and the exceptions they may throw."""
-import json
+import asyncio
+import logging
+import time
+from collections.abc import AsyncIterator, Sequence
+from contextlib import asynccontextmanager
+from typing import Literal, Optional
 
 from hexkit.protocols.eventpub import EventPublisherProtocol
 from pydantic import BaseSettings, Field
 
+from cm.adapters.serialization import to_jsonable
 from cm.core import models
-from cm.ports.outbound.event_pub import EventPublisherPort
+from cm.core.metrics import MetricsCollector
+from cm.ports.outbound.event_pub import EventBufferFullError, EventPublisherPort
 
 
 class EventPubTranslatorConfig(BaseSettings):
@@ -52,10 +59,338 @@ class EventPubTranslator(EventPublisherPort):
         self, *, sample_no_auth: models.SampleNoAuth
     ) -> None:
         """Publish an event saying that a sample was updated"""
-        payload = json.loads(sample_no_auth.json())
+        payload = to_jsonable(sample_no_auth)
         await self._provider.publish(
             payload=payload,
             type_=self._config.sample_updated_event_type,
             topic=self._config.sample_updated_event_topic,
             key=sample_no_auth.sample_id,
         )
+
+    async def publish_samples_updated(
+        self, *, samples_no_auth: Sequence[models.SampleNoAuth]
+    ) -> None:
+        """Publish one event per updated sample. The events are sent concurrently, so
+        that the Kafka producer can batch them."""
+        await asyncio.gather(
+            *(
+                self.publish_sample_updated(sample_no_auth=sample_no_auth)
+                for sample_no_auth in samples_no_auth
+            )
+        )
+
+
+class EventPublishingConfig(BaseSettings):
+    """Config for when and how events are handed to Kafka"""
+
+    event_publishing_mode: Literal["inline", "buffered", "outbox", "cdc"] = Field(
+        "inline",
+        description=(
+            "'inline' publishes the events of a request before responding to it."
+            + " 'buffered' queues them in memory and publishes them in batches in the"
+            + " background, so that the latency of Kafka doesn't add to the latency"
+            + " of requests. Queued events are lost if the service crashes."
+            + " 'outbox' marks updated samples with the same database write as the"
+            + " update, and a background relay publishes the marked samples, so that"
+            + " no event is lost. Events may be published more than once."
+            + " 'cdc' publishes nothing from the service itself. Instead, the separate"
+            + " cm-relay-changes process publishes the updates it observes on the"
+            + " change stream of the samples collection, including those made by"
+            + " other tools. This requires MongoDB to run as a replica set."
+        ),
+        example="inline",
+    )
+    event_buffer_max_size: int = Field(
+        10000,
+        ge=1,
+        description="Maximum number of events queued in the 'buffered' mode",
+        example=10000,
+    )
+    event_buffer_batch_size: int = Field(
+        500,
+        ge=1,
+        description="Maximum number of queued events published as one batch",
+        example=500,
+    )
+    event_buffer_linger_ms: float = Field(
+        5,
+        ge=0,
+        description=(
+            "Number of milliseconds to wait for more events before publishing a batch"
+            + " that is not full"
+        ),
+        example=5,
+    )
+    event_buffer_overflow_policy: Literal["block", "drop_oldest", "error"] = Field(
+        "block",
+        description=(
+            "What to do with a new event when the buffer is full: 'block' waits for"
+            + " space, 'drop_oldest' discards the oldest queued event, and 'error'"
+            + " fails the request with a 503 error. As its update was already stored,"
+            + " the event of that update is lost, so 'block' is the only policy"
+            + " that publishes every update."
+        ),
+        example="block",
+    )
+    event_buffer_max_attempts: int = Field(
+        5,
+        ge=1,
+        description=(
+            "Maximum number of attempts to publish a batch of queued events. The"
+            + " events of a batch that still fails are lost."
+        ),
+        example=5,
+    )
+    event_buffer_retry_backoff_ms: int = Field(
+        100,
+        ge=0,
+        description=(
+            "Number of milliseconds to wait before publishing a failed batch of"
+            + " queued events again. The wait doubles with each further attempt."
+        ),
+        example=100,
+    )
+    outbox_relay_batch_size: int = Field(
+        500,
+        ge=1,
+        description="Maximum number of samples the outbox relay publishes at once",
+        example=500,
+    )
+    outbox_relay_poll_interval_ms: float = Field(
+        100,
+        ge=0,
+        description=(
+            "Number of milliseconds the outbox relay waits before looking for updated"
+            + " samples again, after it found none or publishing failed"
+        ),
+        example=100,
+    )
+    change_stream_batch_size: int = Field(
+        500,
+        ge=1,
+        description=(
+            "Maximum number of changes the change stream relay publishes at once"
+        ),
+        example=500,
+    )
+    change_stream_max_await_ms: int = Field(
+        100,
+        ge=1,
+        description=(
+            "Number of milliseconds the change stream relay waits for more changes"
+            + " before publishing a batch that is not full"
+        ),
+        example=100,
+    )
+    change_stream_retry_interval_ms: int = Field(
+        1000,
+        ge=0,
+        description=(
+            "Number of milliseconds the change stream relay waits before resuming"
+            + " after an error"
+        ),
+        example=1000,
+    )
+
+
+class BufferedEventPublisher(  # pylint: disable=too-many-instance-attributes
+    EventPublisherPort
+):
+    """Queues events in a bounded buffer, from which a background task publishes
+    them in batches. A batch that fails is published again after a backoff, up to the
+    maximum number of attempts. The buffer is flushed when the publisher is
+    stopped."""
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        *,
+        publisher: EventPublisherPort,
+        max_size: int,
+        batch_size: int,
+        linger_seconds: float,
+        overflow_policy: Literal["block", "drop_oldest", "error"] = "block",
+        max_attempts: int = 5,
+        retry_backoff_seconds: float = 0.1,
+        metrics: Optional[MetricsCollector] = None,
+    ):
+        self._publisher = publisher
+        self._batch_size = batch_size
+        self._linger_seconds = linger_seconds
+        self._overflow_policy = overflow_policy
+        self._max_attempts = max_attempts
+        self._retry_backoff_seconds = retry_backoff_seconds
+        self._metrics = metrics or MetricsCollector()
+        self._queue: asyncio.Queue[models.SampleNoAuth] = asyncio.Queue(max_size)
+        # set when events are queued or the flusher is asked to stop. Stopping is not
+        # signalled through the queue, where the overflow policy could drop it:
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._flusher: Optional[asyncio.Task] = None
+
+        self._metrics.register_gauge("event_buffer_depth", self._queue.qsize)
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls,
+        *,
+        config: EventPublishingConfig,
+        publisher: EventPublisherPort,
+        metrics: MetricsCollector,
+    ) -> AsyncIterator["BufferedEventPublisher"]:
+        """Setup the publisher with its flusher, and flush the buffer on teardown"""
+        buffered_publisher = cls(
+            publisher=publisher,
+            max_size=config.event_buffer_max_size,
+            batch_size=config.event_buffer_batch_size,
+            linger_seconds=config.event_buffer_linger_ms / 1000,
+            overflow_policy=config.event_buffer_overflow_policy,
+            max_attempts=config.event_buffer_max_attempts,
+            retry_backoff_seconds=config.event_buffer_retry_backoff_ms / 1000,
+            metrics=metrics,
+        )
+        buffered_publisher.start()
+        try:
+            yield buffered_publisher
+        finally:
+            await buffered_publisher.stop()
+
+    def start(self) -> None:
+        """Start publishing queued events in the background"""
+        self._stopping = False
+        self._flusher = asyncio.create_task(self._flush_forever())
+
+    async def stop(self) -> None:
+        """Publish all queued events and stop the background task"""
+        if self._flusher is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._flusher
+        self._flusher = None
+
+    async def _enqueue(self, sample_no_auth: models.SampleNoAuth) -> None:
+        """Queue an event, applying the overflow policy if the buffer is full.
+
+        With the 'error' policy, the caller has already stored the update, so the
+        rejected event is lost. It is counted, and clients get a 503 error telling
+        them that the update was stored but not announced."""
+        if self._overflow_policy == "block":
+            await self._queue.put(sample_no_auth)
+        elif not self._queue.full():
+            self._queue.put_nowait(sample_no_auth)
+        elif self._overflow_policy == "error":
+            self._metrics.increment("event_buffer_events_rejected")
+            raise EventBufferFullError()
+        else:
+            self._queue.get_nowait()
+            self._metrics.increment("event_buffer_events_dropped")
+            self._queue.put_nowait(sample_no_auth)
+        self._wakeup.set()
+
+    async def _next_batch(self) -> list[models.SampleNoAuth]:
+        """Wait for the next batch of events. Returns an empty batch once the
+        flusher was asked to stop and the buffer is drained."""
+        while self._queue.empty():
+            if self._stopping:
+                return []
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        if not self._stopping and self._queue.qsize() < self._batch_size:
+            await asyncio.sleep(self._linger_seconds)
+
+        batch: list[models.SampleNoAuth] = []
+        while len(batch) < self._batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _flush(self, batch: list[models.SampleNoAuth]) -> None:
+        """Publish a batch of events, retrying with exponential backoff. If the last
+        attempt fails, the events are dropped and the failure is logged, as no caller
+        is left to report it to."""
+        started = time.perf_counter()
+        for attempt in range(1, self._max_attempts + 1):
+            try:
+                await self._publisher.publish_samples_updated(samples_no_auth=batch)
+                break
+            except Exception:  # pylint: disable=broad-except
+                if attempt == self._max_attempts:
+                    logging.exception(
+                        "Dropped %i sample_updated events after %i failed attempts.",
+                        len(batch),
+                        attempt,
+                    )
+                    self._metrics.increment("event_buffer_events_failed", len(batch))
+                    return
+                logging.warning(
+                    "Failed to publish %i sample_updated events, retrying.",
+                    len(batch),
+                    exc_info=True,
+                )
+                self._metrics.increment("event_buffer_flush_retries")
+                await asyncio.sleep(self._retry_backoff_seconds * 2 ** (attempt - 1))
+        self._metrics.increment("event_buffer_flushes")
+        self._metrics.increment("event_buffer_events_flushed", len(batch))
+        self._metrics.increment(
+            "event_buffer_flush_seconds", time.perf_counter() - started
+        )
+
+    async def _flush_forever(self) -> None:
+        """Publish batches of queued events until asked to stop"""
+        while True:
+            batch = await self._next_batch()
+            if not batch:
+                return
+            await self._flush(batch)
+
+    async def publish_sample_updated(
+        self, *, sample_no_auth: models.SampleNoAuth
+    ) -> None:
+        """Queue an event saying that a sample was updated"""
+        await self._enqueue(sample_no_auth)
+
+    async def publish_samples_updated(
+        self, *, samples_no_auth: Sequence[models.SampleNoAuth]
+    ) -> None:
+        """Queue one event per updated sample"""
+        for sample_no_auth in samples_no_auth:
+            await self._enqueue(sample_no_auth)
+
+
+class RelayedEventPublisher(EventPublisherPort):
+    """Publishes nothing itself, as the updates are published by a relay from the
+    database: the OutboxRelay or the ChangeStreamRelay"""
+
+    async def publish_sample_updated(
+        self, *, sample_no_auth: models.SampleNoAuth
+    ) -> None:
+        """The update is published by the relay"""
+
+    async def publish_samples_updated(
+        self, *, samples_no_auth: Sequence[models.SampleNoAuth]
+    ) -> None:
+        """The updates are published by the relay"""
+
+
+class EventPublisherConstructor:
+    """Constructor compatible with the hexkit.inject.AsyncContextConstructable type.
+    Used to construct the event publisher for the configured publishing mode."""
+
+    @staticmethod
+    @asynccontextmanager
+    async def construct(
+        *,
+        config: EventPublishingConfig,
+        translator: EventPubTranslator,
+        metrics: MetricsCollector,
+    ) -> AsyncIterator[EventPublisherPort]:
+        """Setup and teardown the event publisher"""
+        if config.event_publishing_mode == "buffered":
+            async with BufferedEventPublisher.construct(
+                config=config, publisher=translator, metrics=metrics
+            ) as buffered_publisher:
+                yield buffered_publisher
+        elif config.event_publishing_mode in ("outbox", "cdc"):
+            yield RelayedEventPublisher()
+        else:
+            yield translator
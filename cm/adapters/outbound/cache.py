@@ -0,0 +1,299 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A read-through cache in front of the Sample DAO"""
+
+import time
+from collections import OrderedDict
+from collections.abc import Collection, Sequence
+from typing import Any, Callable, Optional
+
+from pydantic import BaseSettings, Field
+
+from cm.adapters.outbound.dao import DelegatingSampleDao
+from cm.adapters.serialization import to_jsonable
+from cm.core import models
+from cm.core.metrics import MetricsCollector
+from cm.core.sample_record import SampleRecord
+from cm.core.single_flight import SingleFlight
+from cm.ports.inbound.sample_cache import SampleCachePort
+from cm.ports.outbound.dao import SampleDaoPort
+
+
+class SampleCacheConfig(BaseSettings):
+    """Config for the in-process cache of samples"""
+
+    sample_cache_max_entries: int = Field(
+        10000,
+        ge=0,
+        description=(
+            "Maximum number of samples to keep in memory. The least recently used"
+            + " sample is evicted first. Requests for some fields of a sample are"
+            + " served from memory if the sample is cached, but otherwise read with a"
+            + " projected query that doesn't populate the cache. Set to 0 to"
+            + " disable the cache."
+        ),
+        example=10000,
+    )
+    sample_cache_max_bytes: int = Field(
+        16 * 1024 * 1024,
+        ge=0,
+        description=(
+            "Maximum total size of the samples kept in memory, in bytes. The size of"
+            + " each sample is estimated from its compact in-memory representation."
+        ),
+        example=16 * 1024 * 1024,
+    )
+    sample_cache_ttl_seconds: float = Field(
+        60,
+        gt=0,
+        description=(
+            "Number of seconds a sample is served from memory. This bounds how long"
+            + " a stale sample can be served if an invalidation event is missed."
+        ),
+        example=60,
+    )
+
+
+class CachingSampleDao(  # pylint: disable=too-many-instance-attributes
+    DelegatingSampleDao, SampleCachePort
+):
+    """Wraps a Sample DAO, serving `get_by_id` and `get_many` from memory when possible.
+    Concurrent `get_by_id` calls for the same sample are coalesced even if the cache
+    is disabled.
+
+    Samples are stored as compact, immutable records, from which each caller receives
+    a new Sample. Writes through this DAO evict the affected
+    samples, writes by other instances are evicted via `evict`. Reads that were in
+    flight during an eviction don't populate the cache, so they can't reinsert stale
+    data.
+    """
+
+    @classmethod
+    async def construct(
+        cls,
+        *,
+        config: SampleCacheConfig,
+        sample_dao: SampleDaoPort,
+        metrics: MetricsCollector,
+    ) -> "CachingSampleDao":
+        """Constructor compatible with the hexkit.inject.AsyncConstructable type"""
+        return cls(
+            sample_dao=sample_dao,
+            max_entries=config.sample_cache_max_entries,
+            max_bytes=config.sample_cache_max_bytes,
+            ttl_seconds=config.sample_cache_ttl_seconds,
+            metrics=metrics,
+        )
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        *,
+        sample_dao: SampleDaoPort,
+        max_entries: int,
+        max_bytes: int,
+        ttl_seconds: float,
+        metrics: Optional[MetricsCollector] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        super().__init__(sample_dao=sample_dao)
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl_seconds = ttl_seconds
+        self._metrics = metrics
+        self._clock = clock
+
+        # maps sample IDs to the record of the sample and its expiry time:
+        self._entries: OrderedDict[str, tuple[SampleRecord, float]] = OrderedDict()
+        self._size = 0
+        # incremented by every eviction, see `_store`:
+        self._epoch = 0
+        self._reads: SingleFlight[str, models.Sample] = SingleFlight(
+            counter_name="sample_reads_coalesced", metrics=metrics
+        )
+
+        if metrics is not None:
+            metrics.register_gauge("sample_cache_entries", lambda: len(self._entries))
+            metrics.register_gauge("sample_cache_bytes", lambda: self._size)
+
+    @property
+    def enabled(self) -> bool:
+        """Whether samples are cached at all"""
+        return self._max_entries > 0
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        """Increment the named counter, if metrics are collected"""
+        if self._metrics is not None and amount:
+            self._metrics.increment(name, amount)
+
+    def _lookup(self, sample_id: str) -> Optional[models.Sample]:
+        """Returns a copy of the cached sample, unless it is missing or expired"""
+        entry = self._entries.get(sample_id)
+        if entry is None:
+            return None
+        record, expiry = entry
+        if expiry <= self._clock():
+            self._remove(sample_id)
+            return None
+        self._entries.move_to_end(sample_id)
+        return record.to_sample()
+
+    def _remove(self, sample_id: str) -> None:
+        """Remove the entry for the sample, if present"""
+        entry = self._entries.pop(sample_id, None)
+        if entry is not None:
+            self._size -= entry[0].nbytes
+
+    def _store(self, sample: models.Sample, *, epoch: int) -> None:
+        """Cache the sample, unless an eviction happened since the read that returned
+        it was started at the given epoch, as the sample might be outdated then"""
+        if not self.enabled or epoch != self._epoch:
+            return
+
+        record = SampleRecord.from_sample(sample)
+        if record.nbytes > self._max_bytes:
+            return
+
+        self._remove(sample.sample_id)
+        self._entries[sample.sample_id] = (record, self._clock() + self._ttl_seconds)
+        self._size += record.nbytes
+        while len(self._entries) > self._max_entries or self._size > self._max_bytes:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self._size -= evicted.nbytes
+
+    def evict(self, *, sample_id: str) -> None:
+        self._epoch += 1
+        self._remove(sample_id)
+        # later requests must not join a read that might return the old state:
+        self._reads.forget(sample_id)
+
+    def _evict_all(self, sample_ids: Collection[str]) -> None:
+        """Evict every one of the specified samples"""
+        for sample_id in sample_ids:
+            self.evict(sample_id=sample_id)
+
+    async def _read(self, id_: str) -> models.Sample:
+        """Get a sample from the database and cache it"""
+        epoch = self._epoch
+        sample = await self._sample_dao.get_by_id(id_)
+        self._store(sample, epoch=epoch)
+        return sample
+
+    async def get_by_id(self, id_: str) -> models.Sample:
+        """Get a sample from memory, or from the database on a miss. Concurrent misses
+        for the same sample share one database read."""
+        if self.enabled:
+            cached = self._lookup(id_)
+            if cached is not None:
+                self._count("sample_cache_hits")
+                return cached
+            self._count("sample_cache_misses")
+
+        sample = await self._reads.run(id_, lambda: self._read(id_))
+        return sample.copy(deep=True)
+
+    async def get_many(self, ids: Collection[str]) -> dict[str, models.Sample]:
+        """Get the cached samples from memory and the others with a single query"""
+        if not self.enabled:
+            return await self._sample_dao.get_many(ids)
+
+        samples: dict[str, models.Sample] = {}
+        for id_ in ids:
+            cached = self._lookup(id_)
+            if cached is not None:
+                samples[id_] = cached
+        missing = [id_ for id_ in ids if id_ not in samples]
+        self._count("sample_cache_hits", len(samples))
+        self._count("sample_cache_misses", len(missing))
+
+        if missing:
+            epoch = self._epoch
+            fetched = await self._sample_dao.get_many(missing)
+            for sample in fetched.values():
+                self._store(sample, epoch=epoch)
+            samples.update(fetched)
+        return samples
+
+    async def get_fields(self, id_: str, fields: Collection[str]) -> dict[str, Any]:
+        """Get the specified fields of a sample, from the cached sample if there is
+        one. On a miss, only the fields are read with a projected query. As that
+        doesn't return the whole sample, the cache is not populated."""
+        if self.enabled:
+            cached = self._lookup(id_)
+            if cached is not None:
+                self._count("sample_cache_hits")
+                return to_jsonable(cached, include={"sample_id", *fields})
+            self._count("sample_cache_misses")
+        return await self._sample_dao.get_fields(id_, fields)
+
+    # Writes are delegated to the wrapped DAO, evicting the written samples:
+
+    async def update(self, dto: models.Sample) -> None:
+        """Replace an existing sample"""
+        try:
+            await self._sample_dao.update(dto)
+        finally:
+            self.evict(sample_id=dto.sample_id)
+
+    async def upsert(self, dto: models.Sample) -> None:
+        """Insert or replace a sample"""
+        try:
+            await self._sample_dao.upsert(dto)
+        finally:
+            self.evict(sample_id=dto.sample_id)
+
+    async def delete(self, *, id_: str) -> None:
+        """Delete a sample"""
+        try:
+            await self._sample_dao.delete(id_=id_)
+        finally:
+            self.evict(sample_id=id_)
+
+    async def update_versioned(self, dto: models.Sample) -> models.Sample:
+        """Replace an existing sample if its version is unchanged"""
+        try:
+            return await self._sample_dao.update_versioned(dto)
+        finally:
+            self.evict(sample_id=dto.sample_id)
+
+    async def update_token_hash(
+        self, *, id_: str, access_token_hash: str, previous_hash: str
+    ) -> bool:
+        """Set only the access token hash of a sample"""
+        try:
+            return await self._sample_dao.update_token_hash(
+                id_=id_,
+                access_token_hash=access_token_hash,
+                previous_hash=previous_hash,
+            )
+        finally:
+            self.evict(sample_id=id_)
+
+    async def update_many(self, dtos: Sequence[models.Sample]) -> set[int]:
+        """Replace multiple existing samples if their versions are unchanged"""
+        try:
+            return await self._sample_dao.update_many(dtos)
+        finally:
+            self._evict_all([dto.sample_id for dto in dtos])
+
+    async def update_test_data(
+        self, updates: models.SampleUpdate
+    ) -> Optional[models.Sample]:
+        """Atomically set the test data fields of an existing sample"""
+        try:
+            return await self._sample_dao.update_test_data(updates)
+        finally:
+            self.evict(sample_id=updates.sample_id)
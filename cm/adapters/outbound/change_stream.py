@@ -0,0 +1,178 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Publishes sample updates observed on the change stream of the samples collection"""
+
+import asyncio
+import logging
+from collections.abc import Mapping
+from typing import Any, Optional
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from cm.adapters.outbound.akafka import EventPublishingConfig
+from cm.adapters.outbound.dao import TEST_DATA_FIELDS, SampleDaoFactory
+from cm.core import models
+from cm.core.metrics import MetricsCollector
+from cm.ports.outbound.event_pub import EventPublisherPort
+
+SAMPLES_COLLECTION = "samples"
+RESUME_TOKENS_COLLECTION = "change_stream_resume_tokens"
+
+# the fields whose change makes a change of interest. Updates of other fields, like
+# the migration of a token hash, are not updates of the sample:
+FIELDS_OF_INTEREST = sorted({*TEST_DATA_FIELDS, "version"})
+
+# replacements, which are versioned updates, and updates that touch any of the
+# fields of interest:
+CHANGES_OF_INTEREST = [
+    {
+        "$match": {
+            "$or": [
+                {"operationType": "replace"},
+                *(
+                    {f"updateDescription.updatedFields.{field}": {"$exists": True}}
+                    for field in FIELDS_OF_INTEREST
+                ),
+            ]
+        }
+    }
+]
+
+
+class MongoDbResumeTokenStore:
+    """Persists the resume token of a change stream in a MongoDB collection"""
+
+    def __init__(self, *, collection: AsyncIOMotorCollection, stream_name: str):
+        self._collection = collection
+        self._stream_name = stream_name
+
+    async def load(self) -> Optional[Mapping[str, Any]]:
+        """Returns the last saved resume token, if any"""
+        document = await self._collection.find_one({"_id": self._stream_name})
+        return None if document is None else document["token"]
+
+    async def save(self, token: Mapping[str, Any]) -> None:
+        """Save the resume token, replacing the previous one"""
+        await self._collection.replace_one(
+            {"_id": self._stream_name},
+            {"_id": self._stream_name, "token": token},
+            upsert=True,
+        )
+
+
+def sample_from_change(change: Mapping[str, Any]) -> Optional[models.SampleNoAuth]:
+    """Returns the sample as it was after the change, or None if the sample was
+    deleted before its state could be looked up"""
+    document = change.get("fullDocument")
+    if document is None:
+        return None
+    return models.SampleNoAuth(**document, sample_id=document["_id"])
+
+
+class ChangeStreamRelay:
+    """Watches the change stream of the samples collection and publishes the
+    updated samples in batches. The resume token is saved after each batch, so that
+    a restarted relay continues where it stopped. Changes are published again if the
+    relay stops between publishing and saving the token."""
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        *,
+        collection: Any,
+        token_store: Any,
+        publisher: EventPublisherPort,
+        batch_size: int,
+        max_await_ms: int,
+        retry_interval_seconds: float,
+        metrics: Optional[MetricsCollector] = None,
+    ):
+        self._collection = collection
+        self._token_store = token_store
+        self._publisher = publisher
+        self._batch_size = batch_size
+        self._max_await_ms = max_await_ms
+        self._retry_interval_seconds = retry_interval_seconds
+        self._metrics = metrics or MetricsCollector()
+
+    @classmethod
+    async def construct(
+        cls,
+        *,
+        config: EventPublishingConfig,
+        dao_factory: SampleDaoFactory,
+        publisher: EventPublisherPort,
+        metrics: MetricsCollector,
+    ) -> "ChangeStreamRelay":
+        """Setup the relay. Nothing is watched until it is run."""
+        return cls(
+            collection=dao_factory.get_collection(name=SAMPLES_COLLECTION),
+            token_store=MongoDbResumeTokenStore(
+                collection=dao_factory.get_collection(name=RESUME_TOKENS_COLLECTION),
+                stream_name=SAMPLES_COLLECTION,
+            ),
+            publisher=publisher,
+            batch_size=config.change_stream_batch_size,
+            max_await_ms=config.change_stream_max_await_ms,
+            retry_interval_seconds=config.change_stream_retry_interval_ms / 1000,
+            metrics=metrics,
+        )
+
+    async def _next_batch(self, stream: Any) -> list[Mapping[str, Any]]:
+        """Collect the changes that arrive within the maximum wait, up to the batch
+        size"""
+        changes: list[Mapping[str, Any]] = []
+        while len(changes) < self._batch_size:
+            change = await stream.try_next()
+            if change is None:
+                break
+            changes.append(change)
+        return changes
+
+    async def relay(self, stream: Any) -> int:
+        """Publish the next batch of changes and save the resume token. Returns the
+        number of changes."""
+        changes = await self._next_batch(stream)
+        samples = [
+            sample for sample in map(sample_from_change, changes) if sample is not None
+        ]
+        if samples:
+            await self._publisher.publish_samples_updated(samples_no_auth=samples)
+            self._metrics.increment("change_stream_events_relayed", len(samples))
+        if changes and stream.resume_token is not None:
+            await self._token_store.save(stream.resume_token)
+        return len(changes)
+
+    async def _watch(self) -> None:
+        """Relay changes from where the last run stopped until the stream ends"""
+        resume_token = await self._token_store.load()
+        async with self._collection.watch(
+            CHANGES_OF_INTEREST,
+            full_document="updateLookup",
+            resume_after=resume_token,
+            max_await_time_ms=self._max_await_ms,
+        ) as stream:
+            while stream.alive:
+                await self.relay(stream)
+
+    async def run(self) -> None:
+        """Relay changes forever, resuming after errors"""
+        while True:
+            try:
+                await self._watch()
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Failed to relay changes of the samples.")
+                self._metrics.increment("change_stream_relay_failures")
+            await asyncio.sleep(self._retry_interval_seconds)
@@ -15,10 +15,518 @@
 #
 """DAO translators for accessing the database."""
 
-from hexkit.protocols.dao import DaoFactoryProtocol
+import asyncio
+from collections.abc import AsyncIterator, Collection, Mapping, Sequence
+from datetime import datetime, timezone
+from typing import Any, Optional
 
+from hexkit.providers.mongodb.provider import MongoDbDaoFactory, MongoDbDaoNaturalId
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pydantic import BaseSettings, Field
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from cm.adapters.outbound.akafka import EventPublishingConfig
+from cm.adapters.serialization import to_jsonable
 from cm.core import models
-from cm.ports.outbound.dao import SampleDaoPort
+from cm.core.metrics import MetricsCollector
+from cm.ports.outbound.dao import (
+    BulkInsertError,
+    ResourceNotFoundError,
+    SampleDaoPort,
+    VersionConflictError,
+)
+
+DUPLICATE_KEY_ERROR_CODE = 11000
+TEST_DATA_FIELDS = {"status", "test_result", "test_date"}
+ID_SCAN_BATCH_SIZE = 10000
+# set on samples whose sample_updated event is still to be published from the outbox:
+EVENT_PENDING_FIELD = "event_pending"
+
+
+class MongoDbSampleDao(MongoDbDaoNaturalId[models.Sample]):
+    """A MongoDB-based DAO for Sample objects, implementing the bulk operations of the
+    SampleDaoPort on top of the generic DAO provided by hexkit."""
+
+    # whether updates are recorded in the outbox, see MongoDbOutboxSampleDao:
+    records_events = False
+
+    def _dto_to_document(self, dto: models.Sample) -> dict[str, Any]:
+        """Converts a sample into a MongoDB document, using the fast serializer"""
+        document = to_jsonable(dto)
+        document["_id"] = document.pop(self._id_field)
+        return document
+
+    async def insert_many(self, dtos: Sequence[models.Sample]) -> set[int]:
+        """Insert multiple new samples with a single, unordered bulk insert.
+
+        Returns:
+            The positions of samples that were not inserted because a sample with
+            the same ID already exists.
+
+        Raises:
+            BulkInsertError: when samples failed to be inserted for other reasons.
+        """
+        documents = [self._dto_to_document(dto) for dto in dtos]
+
+        try:
+            await self._collection.insert_many(
+                documents, ordered=False, session=self._session
+            )
+        except BulkWriteError as error:
+            conflicts: set[int] = set()
+            failures: dict[int, str] = {}
+            for write_error in error.details["writeErrors"]:
+                if write_error["code"] == DUPLICATE_KEY_ERROR_CODE:
+                    conflicts.add(write_error["index"])
+                else:
+                    failures[write_error["index"]] = write_error["errmsg"]
+            if failures:
+                raise BulkInsertError(
+                    inserted=set(range(len(documents))) - conflicts - failures.keys(),
+                    conflicts=conflicts,
+                    failures=failures,
+                ) from error
+            return conflicts
+
+        return set()
+
+    async def get_many(self, ids: Collection[str]) -> dict[str, models.Sample]:
+        """Get multiple samples with a single $in query.
+
+        Returns:
+            The samples that were found, by their ID. IDs without a matching sample
+            are missing from the result.
+        """
+        cursor = self._collection.find(
+            {"_id": {"$in": list(ids)}}, session=self._session
+        )
+        samples = [self._document_to_dto(document) async for document in cursor]
+        return {sample.sample_id: sample for sample in samples}
+
+    def _versioned_write(self, dto: models.Sample) -> tuple[dict, dict]:
+        """Returns the filter matching the stored sample only if its version is
+        unchanged, and the document to replace it with."""
+        document = self._dto_to_document(dto)
+        document["version"] = dto.version + 1
+        if self.records_events:
+            document[EVENT_PENDING_FIELD] = True
+        # documents written before versioning was introduced lack the field:
+        version = {"$in": [0, None]} if dto.version == 0 else dto.version
+        return {"_id": document["_id"], "version": version}, document
+
+    async def update_versioned(self, dto: models.Sample) -> models.Sample:
+        """Replace an existing sample if its stored version is unchanged.
+
+        Returns:
+            The sample as it was stored.
+
+        Raises:
+            ResourceNotFoundError: when no sample with the specified ID exists.
+            VersionConflictError: when the stored sample has a different version.
+        """
+        filter_, document = self._versioned_write(dto)
+        result = await self._collection.replace_one(
+            filter_, document, session=self._session
+        )
+
+        if result.matched_count == 0:
+            if not await self._collection.count_documents(
+                {"_id": dto.sample_id}, limit=1, session=self._session
+            ):
+                raise ResourceNotFoundError(id_=dto.sample_id)
+            raise VersionConflictError(id_=dto.sample_id)
+
+        return self._document_to_dto(document)
+
+    async def update_token_hash(
+        self, *, id_: str, access_token_hash: str, previous_hash: str
+    ) -> bool:
+        """$set only the access token hash if the stored one is the previous hash.
+        Neither the version nor the outbox flag are touched."""
+        result = await self._collection.update_one(
+            {"_id": id_, "access_token_hash": previous_hash},
+            {"$set": {"access_token_hash": access_token_hash}},
+            session=self._session,
+        )
+        return result.modified_count == 1
+
+    async def get_fields(self, id_: str, fields: Collection[str]) -> dict[str, Any]:
+        """Get the specified fields of a sample with a projection, so that only those
+        are read and transferred"""
+        projection = {field: True for field in fields if field != self._id_field}
+        document = await self._collection.find_one(
+            {"_id": id_}, {"_id": True, **projection}, session=self._session
+        )
+        if document is None:
+            raise ResourceNotFoundError(id_=id_)
+        document[self._id_field] = document.pop("_id")
+        return document
+
+    async def update_many(self, dtos: Sequence[models.Sample]) -> set[int]:
+        """Replace multiple existing samples with a single, unordered bulk write, each
+        on the condition that its version is unchanged.
+
+        The bulk result only counts the matches, so if some writes didn't match, the
+        samples are read again to find out which ones were not written.
+
+        Returns:
+            The positions of samples that were not written because they were modified
+            concurrently or don't exist anymore.
+        """
+        writes = [self._versioned_write(dto) for dto in dtos]
+        result = await self._collection.bulk_write(
+            [ReplaceOne(filter_, document) for filter_, document in writes],
+            ordered=False,
+            session=self._session,
+        )
+        if result.matched_count == len(dtos):
+            return set()
+
+        stored = await self.get_many([dto.sample_id for dto in dtos])
+        return {
+            position
+            for position, (_, document) in enumerate(writes)
+            if document["_id"] not in stored
+            or self._dto_to_document(stored[document["_id"]])
+            != {
+                key: value
+                for key, value in document.items()
+                if key != EVENT_PENDING_FIELD
+            }
+        }
+
+    async def update_test_data(
+        self, updates: models.SampleUpdate
+    ) -> Optional[models.Sample]:
+        """Atomically $set the test data fields with a single find-and-modify that
+        only matches if at least one of the fields differs.
+
+        Returns:
+            The sample as it is after the update, or None if it was unchanged.
+
+        Raises:
+            ResourceNotFoundError: when no sample with the specified ID exists.
+        """
+        fields = to_jsonable(updates, include=TEST_DATA_FIELDS)
+        changes = (
+            {**fields, EVENT_PENDING_FIELD: True} if self.records_events else fields
+        )
+        document = await self._collection.find_one_and_update(
+            {
+                "_id": updates.sample_id,
+                "$or": [{field: {"$ne": value}} for field, value in fields.items()],
+            },
+            {"$set": changes, "$inc": {"version": 1}},
+            return_document=ReturnDocument.AFTER,
+            session=self._session,
+        )
+        if document is not None:
+            return self._document_to_dto(document)
+        if not await self._collection.count_documents(
+            {"_id": updates.sample_id}, limit=1, session=self._session
+        ):
+            raise ResourceNotFoundError(id_=updates.sample_id)
+        return None
+
+    async def iter_ids(self) -> AsyncIterator[str]:
+        """Stream the IDs of all samples, using a cursor that only returns the _id"""
+        cursor = self._collection.find(
+            {}, projection={"_id": True}, batch_size=ID_SCAN_BATCH_SIZE
+        )
+        async for document in cursor:
+            yield document["_id"]
+
+
+class MongoDbOutboxSampleDao(MongoDbSampleDao):
+    """A MongoDB-based DAO for Sample objects that records every update in an outbox
+    embedded in the sample document, with the same write as the update itself.
+    MongoDB only guarantees atomicity for a single document without transactions, so
+    the outbox can't be a collection of its own."""
+
+    records_events = True
+
+    async def find_event_pending(self, *, limit: int) -> list[models.Sample]:
+        """Get up to the given number of samples whose update is still to be
+        published"""
+        cursor = self._collection.find({EVENT_PENDING_FIELD: True}, limit=limit)
+        return [self._document_to_dto(document) async for document in cursor]
+
+    async def clear_event_pending(self, samples: Sequence[models.Sample]) -> None:
+        """Mark the updates as published with a single, unordered bulk write. Samples
+        that were updated again in the meantime stay pending."""
+        await self._collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": sample.sample_id, "version": sample.version},
+                    {"$unset": {EVENT_PENDING_FIELD: ""}},
+                )
+                for sample in samples
+            ],
+            ordered=False,
+        )
+
+
+class DelegatingSampleDao:
+    """Passes every call on to the wrapped Sample DAO. Used as base class for wrappers
+    that only need to change some of the operations."""
+
+    def __init__(self, *, sample_dao: SampleDaoPort):
+        self._sample_dao = sample_dao
+
+    def with_transaction(self):
+        """Transactions are delegated to the wrapped DAO"""
+        return self._sample_dao.with_transaction()
+
+    async def get_by_id(self, id_: str) -> models.Sample:
+        """Get a sample by its ID"""
+        return await self._sample_dao.get_by_id(id_)
+
+    async def get_many(self, ids: Collection[str]) -> dict[str, models.Sample]:
+        """Get multiple samples by their IDs"""
+        return await self._sample_dao.get_many(ids)
+
+    async def get_fields(self, id_: str, fields: Collection[str]) -> dict[str, Any]:
+        """Get only the specified fields of a sample"""
+        return await self._sample_dao.get_fields(id_, fields)
+
+    async def find_one(self, *, mapping: Mapping[str, Any]) -> models.Sample:
+        """Find the only sample matching the mapping"""
+        return await self._sample_dao.find_one(mapping=mapping)
+
+    async def find_all(
+        self, *, mapping: Mapping[str, Any]
+    ) -> AsyncIterator[models.Sample]:
+        """Find all samples matching the mapping"""
+        async for sample in self._sample_dao.find_all(mapping=mapping):
+            yield sample
+
+    async def iter_ids(self) -> AsyncIterator[str]:
+        """Stream the IDs of all samples"""
+        async for sample_id in self._sample_dao.iter_ids():
+            yield sample_id
+
+    async def insert(self, dto: models.Sample) -> None:
+        """Insert a new sample"""
+        await self._sample_dao.insert(dto)
+
+    async def insert_many(self, dtos: Sequence[models.Sample]) -> set[int]:
+        """Insert multiple new samples"""
+        return await self._sample_dao.insert_many(dtos)
+
+    async def update(self, dto: models.Sample) -> None:
+        """Replace an existing sample"""
+        await self._sample_dao.update(dto)
+
+    async def upsert(self, dto: models.Sample) -> None:
+        """Insert or replace a sample"""
+        await self._sample_dao.upsert(dto)
+
+    async def delete(self, *, id_: str) -> None:
+        """Delete a sample"""
+        await self._sample_dao.delete(id_=id_)
+
+    async def update_versioned(self, dto: models.Sample) -> models.Sample:
+        """Replace an existing sample if its version is unchanged"""
+        return await self._sample_dao.update_versioned(dto)
+
+    async def update_token_hash(
+        self, *, id_: str, access_token_hash: str, previous_hash: str
+    ) -> bool:
+        """Set only the access token hash of a sample"""
+        return await self._sample_dao.update_token_hash(
+            id_=id_, access_token_hash=access_token_hash, previous_hash=previous_hash
+        )
+
+    async def update_many(self, dtos: Sequence[models.Sample]) -> set[int]:
+        """Replace multiple existing samples if their versions are unchanged"""
+        return await self._sample_dao.update_many(dtos)
+
+    async def update_test_data(
+        self, updates: models.SampleUpdate
+    ) -> Optional[models.Sample]:
+        """Atomically set the test data fields of an existing sample"""
+        return await self._sample_dao.update_test_data(updates)
+
+
+class SampleLookupBatchingConfig(BaseSettings):
+    """Config for batching concurrent sample lookups"""
+
+    sample_lookup_batch_window_ms: float = Field(
+        0,
+        ge=0,
+        description=(
+            "Number of milliseconds to collect concurrent lookups of samples by ID"
+            + " before resolving them with a single query. Set to 0 to disable"
+            + " batching, which avoids the added latency at low concurrency."
+        ),
+        example=1,
+    )
+    sample_lookup_batch_max_size: int = Field(
+        100,
+        ge=1,
+        description=(
+            "Number of distinct sample IDs that triggers the query before the window"
+            + " has elapsed"
+        ),
+        example=100,
+    )
+
+
+class BatchingSampleDao(DelegatingSampleDao):
+    """Collects concurrent `get_by_id` calls over a short window and resolves them
+    with a single `get_many` query (DataLoader pattern). All other operations are
+    passed on directly."""
+
+    def __init__(
+        self,
+        *,
+        sample_dao: SampleDaoPort,
+        window_seconds: float,
+        max_batch_size: int,
+        metrics: Optional[MetricsCollector] = None,
+    ):
+        super().__init__(sample_dao=sample_dao)
+        self._window_seconds = window_seconds
+        self._max_batch_size = max_batch_size
+        self._metrics = metrics
+        # the futures of the callers waiting for each sample ID:
+        self._pending: dict[str, list[asyncio.Future[models.Sample]]] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._queries: set[asyncio.Task] = set()
+
+    async def get_by_id(self, id_: str) -> models.Sample:
+        """Get a sample by its ID as part of the next batch query"""
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[models.Sample] = loop.create_future()
+        self._pending.setdefault(id_, []).append(future)
+
+        if len(self._pending) >= self._max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self._window_seconds, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        """Start the query for all pending lookups"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, {}
+        query = asyncio.create_task(self._resolve(batch))
+        # keeps a reference until the query is done:
+        self._queries.add(query)
+        query.add_done_callback(self._queries.discard)
+
+    async def _resolve(
+        self, batch: dict[str, list[asyncio.Future[models.Sample]]]
+    ) -> None:
+        """Query all samples of the batch and hand them to the waiting callers"""
+        if self._metrics is not None:
+            self._metrics.increment("sample_lookup_batches")
+            self._metrics.increment(
+                "sample_lookups_batched", sum(map(len, batch.values()))
+            )
+
+        try:
+            samples = await self._sample_dao.get_many(list(batch))
+        except Exception as error:  # pylint: disable=broad-except
+            samples = {}
+            failure: Optional[Exception] = error
+        else:
+            failure = None
+
+        for id_, futures in batch.items():
+            sample = samples.get(id_)
+            # callers that were cancelled are skipped:
+            waiting = [future for future in futures if not future.done()]
+            for position, future in enumerate(waiting):
+                if failure is not None:
+                    future.set_exception(failure)
+                elif sample is None:
+                    future.set_exception(ResourceNotFoundError(id_=id_))
+                else:
+                    # every caller gets its own instance:
+                    future.set_result(sample.copy(deep=True) if position else sample)
+
+
+class MongoDbProcessedEventStore:
+    """Stores the fingerprints of processed events in a MongoDB collection, where
+    they expire through a TTL index"""
+
+    def __init__(self, *, collection: AsyncIOMotorCollection):
+        self._collection = collection
+
+    async def get_many(self, keys: Collection[str]) -> dict[str, str]:
+        """Get the fingerprints stored for the given keys with a single $in query"""
+        cursor = self._collection.find({"_id": {"$in": list(keys)}})
+        return {document["_id"]: document["fingerprint"] async for document in cursor}
+
+    async def put_many(self, fingerprints: Mapping[str, str]) -> None:
+        """Upsert the fingerprints with a single, unordered bulk write"""
+        processed_at = datetime.now(timezone.utc)
+        await self._collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": key},
+                    {"$set": {"fingerprint": value, "processed_at": processed_at}},
+                    upsert=True,
+                )
+                for key, value in fingerprints.items()
+            ],
+            ordered=False,
+        )
+
+
+class SampleDaoFactory(MongoDbDaoFactory):
+    """A MongoDB DAO factory that can also provide the extended DAO for samples and
+    the store for processed events"""
+
+    async def get_sample_dao(
+        self, *, name: str, record_events: bool = False
+    ) -> SampleDaoPort:
+        """Constructs a DAO for Sample objects stored in the named collection. If
+        record_events is set, updates are recorded in the outbox."""
+        if record_events:
+            return await self.get_sample_outbox(name=name)
+
+        self._validate_dto_model_id(dto_model=models.Sample, id_field="sample_id")
+        return MongoDbSampleDao(
+            collection=self._db[name],
+            dto_model=models.Sample,
+            id_field="sample_id",
+        )
+
+    async def get_sample_outbox(self, *, name: str) -> MongoDbOutboxSampleDao:
+        """Constructs a DAO for Sample objects stored in the named collection that
+        records updates in the outbox, and indexes the samples with pending updates"""
+        self._validate_dto_model_id(dto_model=models.Sample, id_field="sample_id")
+        collection = self._db[name]
+        await collection.create_index(
+            EVENT_PENDING_FIELD,
+            partialFilterExpression={EVENT_PENDING_FIELD: True},
+        )
+        return MongoDbOutboxSampleDao(
+            collection=collection,
+            dto_model=models.Sample,
+            id_field="sample_id",
+        )
+
+    def get_collection(self, *, name: str) -> AsyncIOMotorCollection:
+        """Gives direct access to the named collection, for adapters that need
+        features of MongoDB that the DAOs don't provide, such as change streams"""
+        return self._db[name]
+
+    async def get_processed_event_store(
+        self, *, name: str, ttl_seconds: int
+    ) -> MongoDbProcessedEventStore:
+        """Constructs a store for processed events in the named collection, whose
+        entries expire after the given number of seconds"""
+        collection = self._db[name]
+        await collection.create_index("processed_at", expireAfterSeconds=ttl_seconds)
+        return MongoDbProcessedEventStore(collection=collection)
 
 
 class SampleDaoConstructor:
@@ -27,12 +535,26 @@ class SampleDaoConstructor:
     """
 
     @staticmethod
-    async def construct(*, dao_factory: DaoFactoryProtocol) -> SampleDaoPort:
-        """Setup the DAOs using the specified provider of the
-        DaoFactoryProtocol."""
+    async def construct(
+        *,
+        dao_factory: SampleDaoFactory,
+        config: SampleLookupBatchingConfig,
+        publishing_config: EventPublishingConfig,
+        metrics: MetricsCollector,
+    ) -> SampleDaoPort:
+        """Setup the DAOs using the specified SampleDaoFactory. Updates are recorded
+        in the outbox and lookups by ID are batched if configured."""
 
-        return await dao_factory.get_dao(
+        sample_dao = await dao_factory.get_sample_dao(
             name="samples",
-            dto_model=models.Sample,
-            id_field="sample_id",
+            record_events=publishing_config.event_publishing_mode == "outbox",
+        )
+        if not config.sample_lookup_batch_window_ms:
+            return sample_dao
+
+        return BatchingSampleDao(
+            sample_dao=sample_dao,
+            window_seconds=config.sample_lookup_batch_window_ms / 1000,
+            max_batch_size=config.sample_lookup_batch_max_size,
+            metrics=metrics,
         )
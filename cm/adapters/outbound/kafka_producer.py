@@ -0,0 +1,112 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A Kafka event publisher with a configurable encoding and compression"""
+
+from contextlib import asynccontextmanager
+from typing import Any, Literal, Optional
+
+from aiokafka import AIOKafkaProducer
+from hexkit.custom_types import Ascii, JsonObject
+from hexkit.providers.akafka import KafkaConfig, KafkaEventPublisher
+from hexkit.providers.akafka.provider import generate_client_id
+from pydantic import Field
+
+from cm.adapters.serialization import (
+    CONTENT_TYPE_HEADER,
+    EVENT_CONTENT_TYPES,
+    EVENT_SCHEMA_VERSION,
+    SCHEMA_VERSION_HEADER,
+    EventEncoding,
+    encode_event,
+)
+
+
+class EventEncodingConfig(KafkaConfig):
+    """Config for how published events are encoded and compressed"""
+
+    event_encoding: EventEncoding = Field(
+        "json",
+        description=(
+            "The encoding of the published events. 'msgpack' gives smaller events"
+            + " that are faster to (de)serialize, but requires the 'msgpack' extra."
+            + " All consumers of this service accept both encodings, so they can be"
+            + " switched without downtime; other consumers have to support msgpack"
+            + " before it is enabled. The encoding is given in the 'content-type'"
+            + " header of the events."
+        ),
+        example="json",
+    )
+    event_compression: Optional[Literal["gzip", "snappy", "lz4", "zstd"]] = Field(
+        None,
+        description=(
+            "The compression the producer applies to batches of events. 'snappy',"
+            + " 'lz4' and 'zstd' require the corresponding compression library to be"
+            + " installed. Consumers decompress transparently."
+        ),
+        example="lz4",
+    )
+
+
+class KafkaEncodingEventPublisher(KafkaEventPublisher):
+    """A KafkaEventPublisher that encodes events in the configured encoding and
+    compresses them. Besides the event type, the headers give the content type and the
+    schema version of the payload."""
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls,
+        *,
+        config: EventEncodingConfig,
+        kafka_producer_cls: Any = AIOKafkaProducer,
+    ):
+        """Setup and teardown a KafkaEncodingEventPublisher. The kafka_producer_cls can
+        be overwritten for unit testing."""
+        client_id = generate_client_id(
+            service_name=config.service_name, instance_id=config.service_instance_id
+        )
+        encoding = config.event_encoding
+        producer = kafka_producer_cls(
+            bootstrap_servers=",".join(config.kafka_servers),
+            client_id=client_id,
+            compression_type=config.event_compression,
+            key_serializer=lambda key: key.encode("ascii"),
+            value_serializer=lambda value: encode_event(value, encoding=encoding),
+        )
+        try:
+            await producer.start()
+            yield cls(producer=producer, encoding=encoding)
+        finally:
+            await producer.stop()
+
+    def __init__(self, *, producer: Any, encoding: EventEncoding = "json"):
+        """Please do not call directly! Should be called by the `construct` method."""
+        super().__init__(producer=producer)
+        self._headers = [
+            (CONTENT_TYPE_HEADER, EVENT_CONTENT_TYPES[encoding].encode("ascii")),
+            (SCHEMA_VERSION_HEADER, EVENT_SCHEMA_VERSION.encode("ascii")),
+        ]
+
+    async def _publish_validated(
+        self, *, payload: JsonObject, type_: Ascii, key: Ascii, topic: Ascii
+    ) -> None:
+        """Publish an event with already validated topic and type"""
+        await self._producer.send_and_wait(
+            topic,
+            key=key,
+            value=payload,
+            headers=[("type", type_.encode("ascii")), *self._headers],
+        )
@@ -0,0 +1,124 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Relays sample updates recorded in the outbox to Kafka"""
+
+import asyncio
+import logging
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from cm.adapters.outbound.akafka import EventPublishingConfig
+from cm.adapters.outbound.dao import SampleDaoFactory
+from cm.core import models
+from cm.core.metrics import MetricsCollector
+from cm.ports.outbound.event_pub import EventPublisherPort
+from cm.ports.outbound.outbox import SampleOutboxPort
+
+
+class OutboxRelay:
+    """Publishes the updates of samples that are marked in the outbox, in batches,
+    and clears the marks afterwards. A crash between publishing and clearing leads
+    to the updates being published again. When multiple instances of the service
+    run a relay, an update may also be published by more than one of them."""
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        *,
+        outbox: SampleOutboxPort,
+        publisher: EventPublisherPort,
+        batch_size: int,
+        poll_interval_seconds: float,
+        metrics: Optional[MetricsCollector] = None,
+    ):
+        self._outbox = outbox
+        self._publisher = publisher
+        self._batch_size = batch_size
+        self._poll_interval_seconds = poll_interval_seconds
+        self._metrics = metrics or MetricsCollector()
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls,
+        *,
+        config: EventPublishingConfig,
+        dao_factory: SampleDaoFactory,
+        publisher: EventPublisherPort,
+        metrics: MetricsCollector,
+    ) -> AsyncIterator[Optional["OutboxRelay"]]:
+        """Setup and teardown the relay along with its background task. Yields None
+        if events are not published through the outbox."""
+        if config.event_publishing_mode != "outbox":
+            yield None
+            return
+
+        relay = cls(
+            outbox=await dao_factory.get_sample_outbox(name="samples"),
+            publisher=publisher,
+            batch_size=config.outbox_relay_batch_size,
+            poll_interval_seconds=config.outbox_relay_poll_interval_ms / 1000,
+            metrics=metrics,
+        )
+        relay.start()
+        try:
+            yield relay
+        finally:
+            await relay.stop()
+
+    def start(self) -> None:
+        """Start relaying in the background"""
+        self._task = asyncio.create_task(self._relay_forever())
+
+    async def stop(self) -> None:
+        """Stop relaying. Updates that are not yet relayed stay in the outbox."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def relay(self) -> int:
+        """Publish one batch of pending updates and return its size"""
+        samples = await self._outbox.find_event_pending(limit=self._batch_size)
+        if not samples:
+            return 0
+
+        await self._publisher.publish_samples_updated(
+            samples_no_auth=[
+                models.from_validated(models.SampleNoAuth, sample) for sample in samples
+            ]
+        )
+        await self._outbox.clear_event_pending(samples)
+        self._metrics.increment("outbox_events_relayed", len(samples))
+        return len(samples)
+
+    async def _relay_forever(self) -> None:
+        """Relay batches right after each other while the outbox is full, and poll
+        it otherwise"""
+        while True:
+            try:
+                relayed = await self.relay()
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Failed to relay sample updates from the outbox.")
+                self._metrics.increment("outbox_relay_failures")
+                relayed = 0
+            if relayed < self._batch_size:
+                await asyncio.sleep(self._poll_interval_seconds)
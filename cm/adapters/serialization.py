@@ -0,0 +1,136 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fast JSON serialization of pydantic models for events, database documents and
+HTTP responses, based on orjson. Datetimes and enums are encoded natively and give
+the same result as pydantic's `.json()`. Events can alternatively be encoded with
+msgpack, if the optional dependency is installed."""
+
+from datetime import date, datetime, time
+from enum import Enum
+from typing import Any, Literal, Optional, Union
+
+import orjson
+from pydantic import BaseModel
+from starlette.responses import JSONResponse
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+EventEncoding = Literal["json", "msgpack"]
+
+CONTENT_TYPE_HEADER = "content-type"
+SCHEMA_VERSION_HEADER = "schema-version"
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+EVENT_CONTENT_TYPES: dict[EventEncoding, str] = {
+    "json": JSON_CONTENT_TYPE,
+    "msgpack": MSGPACK_CONTENT_TYPE,
+}
+
+# The version of the schema of the event payloads, sent in the "schema-version"
+# header. To be incremented with every incompatible change of the payloads.
+EVENT_SCHEMA_VERSION = "1"
+
+
+class EventDecodingError(ValueError):
+    """Raised when an event is in an encoding or schema version that is not
+    supported"""
+
+
+def _default(value: Any) -> Any:
+    """Encodes what orjson doesn't support natively. Models are encoded by their
+    field values, which skips the per-field processing of pydantic's `.dict()`. This
+    is equivalent as long as the models use no aliases or custom encoders."""
+    if isinstance(value, BaseModel):
+        return value.__dict__
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value: Any) -> bytes:
+    """Serialize the value, which may be or contain pydantic models, to JSON"""
+    return orjson.dumps(value, default=_default)
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """Deserialize JSON"""
+    return orjson.loads(data)
+
+
+def _jsonable(value: Any) -> Any:
+    """Convert the value into JSON-compatible values, the way orjson encodes it"""
+    if isinstance(value, BaseModel):
+        value = value.__dict__
+    if isinstance(value, dict):
+        return {key: _jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [_jsonable(item) for item in value]
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    return value
+
+
+def to_jsonable(
+    model: BaseModel, *, include: Optional[set[str]] = None
+) -> dict[str, Any]:
+    """Convert the model into a dict of JSON-compatible values, optionally only
+    including the given fields. Replaces `json.loads(model.json())`, but builds the
+    dict directly, so that the model is only serialized once it is sent or stored."""
+    return {
+        key: _jsonable(value)
+        for key, value in model.__dict__.items()
+        if include is None or key in include
+    }
+
+
+class FastJSONResponse(JSONResponse):
+    """A JSON response that can render pydantic models directly. Routes that return
+    it skip FastAPI's validation and encoding of the response."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def _require_msgpack() -> Any:
+    """Returns the msgpack module or raises an error if it is not installed"""
+    if msgpack is None:
+        raise RuntimeError(
+            "The msgpack event encoding requires the 'msgpack' extra to be installed."
+        )
+    return msgpack
+
+
+def encode_event(payload: Any, *, encoding: EventEncoding = "json") -> bytes:
+    """Encode the payload of an event, which has to consist of JSON-compatible values"""
+    if encoding == "msgpack":
+        return _require_msgpack().packb(payload)
+    return orjson.dumps(payload)
+
+
+def decode_event(data: bytes, *, content_type: Optional[str] = None) -> Any:
+    """Decode the value of an event in the encoding given by its content type.
+    Events without a content type, such as those of other services, are expected to
+    be JSON."""
+    if content_type is None or content_type == JSON_CONTENT_TYPE:
+        return orjson.loads(data)
+    if content_type == MSGPACK_CONTENT_TYPE:
+        return _require_msgpack().unpackb(data)
+    raise EventDecodingError(f"Unsupported content type: {content_type}")
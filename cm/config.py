@@ -17,11 +17,23 @@
 
 from ghga_service_chassis_lib.api import ApiConfigBase
 from ghga_service_chassis_lib.config import config_from_yaml
-from hexkit.providers.akafka import KafkaConfig
 from hexkit.providers.mongodb.provider import MongoDbConfig
 
 from cm.adapters.inbound.akafka import EventSubTranslatorConfig
-from cm.adapters.outbound.akafka import EventPubTranslatorConfig
+from cm.adapters.inbound.dead_letters import DeadLetterConfig
+from cm.adapters.inbound.dedup import EventDeduplicationConfig
+from cm.adapters.inbound.kafka_consumer import EventConsumerConfig
+from cm.adapters.outbound.akafka import EventPublishingConfig, EventPubTranslatorConfig
+from cm.adapters.outbound.cache import SampleCacheConfig
+from cm.adapters.outbound.dao import SampleLookupBatchingConfig
+from cm.adapters.outbound.kafka_producer import EventEncodingConfig
+from cm.core.authorizer import AuthorizerConfig
+from cm.core.id_filter import SampleIdFilterConfig
+from cm.core.metrics import MetricsConfig
+from cm.core.retry import ConflictRetryConfig
+from cm.core.session import SessionTokenConfig
+from cm.core.token_cache import VerifiedTokenCacheConfig
+from cm.core.token_pool import TokenPoolConfig
 
 
 class SamplesDaoFactoryConfig(MongoDbConfig):
@@ -34,9 +46,22 @@ class SamplesDaoFactoryConfig(MongoDbConfig):
 class Config(  # pylint: disable=too-many-ancestors
     ApiConfigBase,
     MongoDbConfig,
-    KafkaConfig,
+    EventConsumerConfig,
     EventPubTranslatorConfig,
+    EventPublishingConfig,
+    EventEncodingConfig,
     EventSubTranslatorConfig,
+    DeadLetterConfig,
+    EventDeduplicationConfig,
+    AuthorizerConfig,
+    VerifiedTokenCacheConfig,
+    TokenPoolConfig,
+    SessionTokenConfig,
+    ConflictRetryConfig,
+    SampleCacheConfig,
+    SampleIdFilterConfig,
+    SampleLookupBatchingConfig,
+    MetricsConfig,
 ):
     """Config parameters and their defaults."""
 
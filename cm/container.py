@@ -15,15 +15,29 @@
 #
 """Dependency-Injection container"""
 from hexkit.inject import ContainerBase, get_configurator, get_constructor
-from hexkit.providers.akafka.provider import KafkaEventPublisher, KafkaEventSubscriber
-from hexkit.providers.mongodb import MongoDbDaoFactory
 
-from cm.adapters.inbound.akafka import EventSubTranslator
-from cm.adapters.outbound.akafka import EventPubTranslator
-from cm.adapters.outbound.dao import SampleDaoConstructor
+from cm.adapters.inbound.akafka import (
+    EventSubTranslator,
+    SampleCacheInvalidationTranslator,
+    SampleCacheSubscriber,
+)
+from cm.adapters.inbound.dead_letters import DeadLetterQueue
+from cm.adapters.inbound.dedup import EventDeduplicator
+from cm.adapters.inbound.kafka_consumer import EventSubscriberConstructor
+from cm.adapters.outbound.akafka import EventPublisherConstructor, EventPubTranslator
+from cm.adapters.outbound.cache import CachingSampleDao
+from cm.adapters.outbound.dao import SampleDaoConstructor, SampleDaoFactory
+from cm.adapters.outbound.kafka_producer import KafkaEncodingEventPublisher
+from cm.adapters.outbound.outbox import OutboxRelay
 from cm.config import Config
 from cm.core.authorizer import Authorizer
 from cm.core.data_repository import DataRepository
+from cm.core.id_filter import SampleIdFilter
+from cm.core.metrics import MetricsCollector
+from cm.core.retry import ConflictRetrier
+from cm.core.session import SessionTokenSigner
+from cm.core.token_cache import VerifiedTokenCache
+from cm.core.token_pool import TokenPool
 
 
 class Container(ContainerBase):
@@ -32,29 +46,96 @@ class Container(ContainerBase):
     config = get_configurator(Config)
 
     # outbound providers
-    dao_factory = get_constructor(MongoDbDaoFactory, config=config)
-    kafka_event_publisher = get_constructor(KafkaEventPublisher, config=config)
+    dao_factory = get_constructor(SampleDaoFactory, config=config)
+    kafka_event_publisher = get_constructor(KafkaEncodingEventPublisher, config=config)
+
+    # domain/core components needed by the outbound translators:
+    metrics = get_constructor(MetricsCollector)
 
     # outbound translators
-    sample_dao = get_constructor(SampleDaoConstructor, dao_factory=dao_factory)
-    event_publisher = get_constructor(
+    uncached_sample_dao = get_constructor(
+        SampleDaoConstructor,
+        dao_factory=dao_factory,
+        config=config,
+        publishing_config=config,
+        metrics=metrics,
+    )
+    sample_dao = get_constructor(
+        CachingSampleDao, config=config, sample_dao=uncached_sample_dao, metrics=metrics
+    )
+    event_pub_translator = get_constructor(
         EventPubTranslator, config=config, provider=kafka_event_publisher
     )
+    event_publisher = get_constructor(
+        EventPublisherConstructor,
+        config=config,
+        translator=event_pub_translator,
+        metrics=metrics,
+    )
+    outbox_relay = get_constructor(
+        OutboxRelay,
+        config=config,
+        dao_factory=dao_factory,
+        publisher=event_pub_translator,
+        metrics=metrics,
+    )
 
     # domain/core components:
+    authorizer = get_constructor(Authorizer, config=config, metrics=metrics)
+    token_cache = get_constructor(VerifiedTokenCache, config=config, metrics=metrics)
+    token_pool = get_constructor(
+        TokenPool,
+        config=config,
+        authorizer_config=config,
+        authorizer=authorizer,
+        metrics=metrics,
+    )
+    session_signer = get_constructor(SessionTokenSigner, config=config)
+    update_retrier = get_constructor(ConflictRetrier, config=config, metrics=metrics)
+    sample_id_filter = get_constructor(
+        SampleIdFilter, config=config, sample_dao=sample_dao, metrics=metrics
+    )
     data_repository = get_constructor(
         DataRepository,
         sample_dao=sample_dao,
-        authorizer=Authorizer(),
+        authorizer=authorizer,
         event_publisher=event_publisher,
+        token_cache=token_cache,
+        token_pool=token_pool,
+        session_signer=session_signer,
+        update_retrier=update_retrier,
+        sample_id_filter=sample_id_filter,
     )
 
     # inbound translators
+    dead_letter_queue = get_constructor(
+        DeadLetterQueue, config=config, provider=kafka_event_publisher, metrics=metrics
+    )
+    event_deduplicator = get_constructor(
+        EventDeduplicator, config=config, dao_factory=dao_factory, metrics=metrics
+    )
     event_sub_translator = get_constructor(
-        EventSubTranslator, config=config, data_repository=data_repository
+        EventSubTranslator,
+        config=config,
+        data_repository=data_repository,
+        dead_letters=dead_letter_queue,
+        deduplicator=event_deduplicator,
+    )
+
+    sample_cache_invalidation_translator = get_constructor(
+        SampleCacheInvalidationTranslator, config=config, sample_cache=sample_dao
     )
 
     # inbound providers
     kafka_event_subscriber = get_constructor(
-        KafkaEventSubscriber, config=config, translator=event_sub_translator
+        EventSubscriberConstructor,
+        config=config,
+        translator=event_sub_translator,
+        metrics=metrics,
+    )
+    sample_cache_subscriber = get_constructor(
+        SampleCacheSubscriber,
+        config=config,
+        cache_config=config,
+        translator=sample_cache_invalidation_translator,
     )
@@ -16,11 +16,43 @@
 
 """Interface for an authorizer class, which can generate, hash, and validate tokens."""
 
+import asyncio
 import secrets
 import string
 from abc import ABC, abstractmethod
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Callable, Literal, Optional, TypeVar
 
-import bcrypt
+from pydantic import Field
+
+from cm.core.hashing import TOKEN_HASHERS, TokenHasher, TokenHashingConfig
+from cm.core.metrics import MetricsCollector
+from cm.core.single_flight import SingleFlight
+
+ResultT = TypeVar("ResultT")
+
+ACCESS_TOKEN_LENGTH = 16
+
+
+class AuthorizerConfig(TokenHashingConfig):
+    """Config for the authorizer"""
+
+    auth_executor: Literal["inline", "thread", "process"] = Field(
+        "thread",
+        description=(
+            "Where token hashing and verification are run. 'inline' runs them on the"
+            + " event loop, 'thread' and 'process' dispatch them to a worker pool so"
+            + " that the event loop is not blocked for the duration of the hash."
+        ),
+        example="thread",
+    )
+    auth_max_workers: int = Field(
+        4,
+        ge=1,
+        description="Number of workers in the pool used for hashing and verification",
+        example=4,
+    )
 
 
 class AuthorizerInterface(ABC):
@@ -31,28 +63,120 @@ class AuthorizerInterface(ABC):
         """Produce a string containing "length" random numbers and letters"""
 
     @abstractmethod
-    def hash_token(self, *, token: str) -> str:
+    async def hash_token(self, *, token: str) -> str:
         """Returns a hashed token for storage in the database"""
 
     @abstractmethod
-    def check_token(self, *, token_plain: str, token_hashed: str) -> bool:
+    async def check_token(self, *, token_plain: str, token_hashed: str) -> bool:
         """Compares a plaintext and hashed token to see if they are equivalent"""
 
+    @abstractmethod
+    def needs_rehash(self, *, token_hashed: str) -> bool:
+        """Checks whether the hash should be replaced by one produced with the
+        currently configured algorithm and parameters"""
+
+    @abstractmethod
+    def queue_depth(self) -> int:
+        """The number of hashing or verification operations waiting to be run"""
+
 
 class Authorizer(AuthorizerInterface):
-    """Implementation of an AuthorizerPort"""
+    """Implementation of an AuthorizerPort. Hashing and verification either run inline
+    or are dispatched to a bounded worker pool. New tokens are hashed with the
+    configured backend, while existing hashes are verified with the backend that
+    produced them."""
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(cls, *, config: AuthorizerConfig, metrics: MetricsCollector):
+        """Setup and teardown an Authorizer along with its worker pool, if any"""
+        executor: Optional[Executor] = None
+        if config.auth_executor == "thread":
+            executor = ThreadPoolExecutor(
+                max_workers=config.auth_max_workers, thread_name_prefix="cm-auth"
+            )
+        elif config.auth_executor == "process":
+            executor = ProcessPoolExecutor(max_workers=config.auth_max_workers)
+
+        try:
+            yield cls(
+                config=config,
+                executor=executor,
+                max_workers=config.auth_max_workers,
+                metrics=metrics,
+            )
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+    def __init__(
+        self,
+        *,
+        config: Optional[TokenHashingConfig] = None,
+        executor: Optional[Executor] = None,
+        max_workers: int = 1,
+        metrics: Optional[MetricsCollector] = None,
+    ):
+        """Without a config, the default hashing config is used. Without an executor,
+        hashing and verification are run inline."""
+        config = config or TokenHashingConfig()
+        self._hashers = {
+            name: hasher_cls.from_config(config)
+            for name, hasher_cls in TOKEN_HASHERS.items()
+        }
+        self._hasher = self._hashers[config.token_hash_algorithm]
+        self._executor = executor
+        self._max_workers = max_workers
+        self._in_flight = 0
+        # identical verifications, e.g. from clients polling in parallel, run once:
+        self._checks: SingleFlight[tuple[str, str], bool] = SingleFlight(
+            counter_name="token_checks_coalesced", metrics=metrics
+        )
+
+        if metrics is not None:
+            metrics.register_gauge("auth_pool_in_flight", lambda: self._in_flight)
+            metrics.register_gauge("auth_pool_queue_depth", self.queue_depth)
+
+    def queue_depth(self) -> int:
+        """The number of operations waiting for a free worker"""
+        if self._executor is None:
+            return 0
+        return max(self._in_flight - self._max_workers, 0)
+
+    async def _run(self, func: Callable[..., ResultT], *args) -> ResultT:
+        """Run the function inline or, if configured, on the worker pool"""
+        if self._executor is None:
+            return func(*args)
+
+        self._in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            self._in_flight -= 1
 
     def generate_token(self, *, length: int) -> str:
         """Produce a string containing "length" random numbers and letters"""
         chars = string.ascii_letters + string.digits
         return "".join([secrets.choice(chars) for _ in range(length)])
 
-    def hash_token(self, *, token: str) -> str:
-        token_bytes = bytes(token, encoding="utf-8")
-        hash_bytes = bcrypt.hashpw(token_bytes, bcrypt.gensalt())
-        return str(hash_bytes, encoding="utf-8")
+    def _hasher_for(self, token_hashed: str) -> TokenHasher:
+        """Returns the backend that produced the hash"""
+        for hasher in self._hashers.values():
+            if hasher.identifies(token_hashed):
+                return hasher
+        raise ValueError("The token hash was not produced by any known algorithm.")
+
+    async def hash_token(self, *, token: str) -> str:
+        return await self._run(self._hasher.hash, token)
+
+    async def check_token(self, *, token_plain: str, token_hashed: str) -> bool:
+        hasher = self._hasher_for(token_hashed)
+        return await self._checks.run(
+            (token_hashed, token_plain),
+            lambda: self._run(hasher.verify, token_plain, token_hashed),
+        )
 
-    def check_token(self, *, token_plain: str, token_hashed: str) -> bool:
-        token_plain_bytes = bytes(token_plain, encoding="utf-8")
-        token_hashed_bytes = bytes(token_hashed, encoding="utf-8")
-        return bcrypt.checkpw(token_plain_bytes, token_hashed_bytes)
+    def needs_rehash(self, *, token_hashed: str) -> bool:
+        hasher = self._hasher_for(token_hashed)
+        return hasher is not self._hasher or hasher.needs_rehash(token_hashed)
@@ -15,17 +15,57 @@
 #
 """This is called a repository but it has nothing to do with the Repository Pattern.
 Basically, it houses all the domain logic."""
+import asyncio
 import secrets
 import string
+from collections.abc import Collection, Mapping, Sequence
+from functools import partial
+from typing import Any, Optional, TypeVar
+
+from pydantic import BaseModel, ValidationError
 
 from cm.core import models
-from cm.core.authorizer import AuthorizerInterface
+from cm.core.authorizer import ACCESS_TOKEN_LENGTH, AuthorizerInterface
+from cm.core.id_filter import SampleIdFilter
+from cm.core.retry import ConflictRetrier
+from cm.core.session import SessionTokenSigner
+from cm.core.token_cache import VerifiedTokenCache
+from cm.core.token_pool import TokenPool
 from cm.ports.inbound.data_repository import DataRepositoryPort
-from cm.ports.outbound.dao import ResourceNotFoundError, SampleDaoPort
-from cm.ports.outbound.event_pub import EventPublisherPort
+from cm.ports.outbound.dao import BulkInsertError, ResourceNotFoundError, SampleDaoPort
+from cm.ports.outbound.event_pub import EventBufferFullError, EventPublisherPort
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+
+def validate_items(
+    items: Sequence[Mapping[str, Any]], model: type[ModelT]
+) -> tuple[dict[int, ModelT], dict[int, str]]:
+    """Validates each item against the model. Returns the valid items and the
+    validation errors, both by the position of the item."""
+    valid_items: dict[int, ModelT] = {}
+    errors: dict[int, str] = {}
+    for index, item in enumerate(items):
+        try:
+            valid_items[index] = model(**item)
+        except ValidationError as err:
+            errors[index] = str(err)
+    return valid_items, errors
 
 
-class DataRepository(DataRepositoryPort):
+def apply_test_data(sample: models.Sample, updates: models.SampleUpdate) -> None:
+    """Set the test data fields of the sample to the values of the updates"""
+    models.assign_validated(
+        sample,
+        status=updates.status,
+        test_result=updates.test_result,
+        test_date=updates.test_date,
+    )
+
+
+class DataRepository(  # pylint: disable=too-many-instance-attributes
+    DataRepositoryPort
+):
     """Data repository implementation for sample object interaction"""
 
     def __init__(
@@ -33,71 +73,462 @@ class DataRepository(DataRepositoryPort):
         *,
         sample_dao: SampleDaoPort,
         authorizer: AuthorizerInterface,
-        event_publisher: EventPublisherPort
+        event_publisher: EventPublisherPort,
+        token_cache: Optional[VerifiedTokenCache] = None,
+        token_pool: Optional[TokenPool] = None,
+        session_signer: Optional[SessionTokenSigner] = None,
+        update_retrier: Optional[ConflictRetrier] = None,
+        sample_id_filter: Optional[SampleIdFilter] = None,
     ):
         """Initialize with the sample_dao object."""
         self._sample_dao = sample_dao
         self._authorizer = authorizer
         self._event_publisher = event_publisher
+        self._token_cache = token_cache
+        self._token_pool = token_pool
+        self._session_signer = session_signer
+        self._update_retrier = update_retrier or ConflictRetrier()
+        self._sample_id_filter = sample_id_filter
 
     def _random_string(self, num):
         """Produce a string containing num random numbers and letters"""
         chars = string.ascii_letters + string.digits
         return "".join([secrets.choice(chars) for _ in range(num)])
 
+    async def _new_token_pair(self) -> tuple[str, str]:
+        """Returns a new access token and its hash, from the token pool if possible"""
+        if self._token_pool is not None:
+            return await self._token_pool.get_token_pair()
+        access_token = self._authorizer.generate_token(length=ACCESS_TOKEN_LENGTH)
+        return access_token, await self._authorizer.hash_token(token=access_token)
+
+    async def _is_authorized(self, *, sample: models.Sample, access_token: str) -> bool:
+        """Check the access token against the sample's hash. Tokens that were
+        recently verified for this sample are accepted without hashing again."""
+        if self._token_cache is not None and self._token_cache.is_verified(
+            sample_id=sample.sample_id,
+            token=access_token,
+            token_hashed=sample.access_token_hash,
+        ):
+            return True
+
+        authorized = await self._authorizer.check_token(
+            token_plain=access_token, token_hashed=sample.access_token_hash
+        )
+        if authorized and self._token_cache is not None:
+            self._token_cache.add(
+                sample_id=sample.sample_id,
+                token=access_token,
+                token_hashed=sample.access_token_hash,
+            )
+        return authorized
+
+    async def _rehash_token(self, *, sample: models.Sample, access_token: str) -> None:
+        """Re-hash a verified access token if its stored hash was produced with an
+        outdated algorithm or cost, so that stored hashes migrate to the configured
+        backend over time. Only the hash is written, so this is not an update of the
+        sample and is not announced. If the sample was modified concurrently, the
+        migration is attempted again on a later request."""
+        if not self._authorizer.needs_rehash(token_hashed=sample.access_token_hash):
+            return
+
+        access_token_hash = await self._authorizer.hash_token(token=access_token)
+        if not await self._sample_dao.update_token_hash(
+            id_=sample.sample_id,
+            access_token_hash=access_token_hash,
+            previous_hash=sample.access_token_hash,
+        ):
+            return
+        models.assign_validated(sample, access_token_hash=access_token_hash)
+        if self._token_cache is not None:
+            self._token_cache.add(
+                sample_id=sample.sample_id,
+                token=access_token,
+                token_hashed=access_token_hash,
+            )
+
+    async def _authorize(
+        self,
+        *,
+        sample: models.Sample,
+        access_token: str,
+        accept_session_token: bool = True,
+    ) -> None:
+        """Raises UnauthorizedRequestError unless the access token, or a session token
+        issued for this sample, is valid. A stored token hash that is outdated is
+        migrated, see `_rehash_token`."""
+        if self._session_signer is not None and self._session_signer.is_session_token(
+            access_token
+        ):
+            if accept_session_token and self._session_signer.verify(
+                token=access_token, sample_id=sample.sample_id
+            ):
+                return
+            raise self.UnauthorizedRequestError(sample_id=sample.sample_id)
+
+        if not await self._is_authorized(sample=sample, access_token=access_token):
+            raise self.UnauthorizedRequestError(sample_id=sample.sample_id)
+        await self._rehash_token(sample=sample, access_token=access_token)
+
+    def _check_might_exist(self, sample_id: str) -> None:
+        """Raises SampleNotFoundError for IDs that are known not to exist, so that
+        the database can be skipped for them"""
+        if self._sample_id_filter is not None and not (
+            self._sample_id_filter.might_exist(sample_id)
+        ):
+            raise self.SampleNotFoundError(sample_id=sample_id)
+
+    async def _get_sample(self, sample_id: str) -> models.Sample:
+        """Get the sample, skipping the database for IDs that are known not to exist.
+        Raises SampleNotFoundError if there is no sample with the ID."""
+        self._check_might_exist(sample_id)
+        try:
+            return await self._sample_dao.get_by_id(sample_id)
+        except ResourceNotFoundError as err:
+            raise self.SampleNotFoundError(sample_id=sample_id) from err
+
     async def retrieve_sample(
         self, *, sample_id: str, access_token: str
     ) -> models.Sample:
+        sample = await self._get_sample(sample_id)
+        await self._authorize(sample=sample, access_token=access_token)
+        return sample
+
+    async def retrieve_sample_fields(
+        self, *, sample_id: str, access_token: str, fields: Collection[str]
+    ) -> dict[str, Any]:
+        self._check_might_exist(sample_id)
         try:
-            sample = await self._sample_dao.get_by_id(sample_id)
+            document = await self._sample_dao.get_fields(
+                sample_id, {*fields, *models.SAMPLE_AUTH_FIELDS}
+            )
         except ResourceNotFoundError as err:
             raise self.SampleNotFoundError(sample_id=sample_id) from err
-        if not self._authorizer.check_token(
-            token_plain=access_token, token_hashed=sample.access_token_hash
-        ):
-            raise self.UnauthorizedRequestError(sample_id=sample_id)
-        return sample
+
+        # only the fields needed for authorization are set on this partial sample:
+        auth_sample = models.Sample.construct(
+            sample_id=sample_id, access_token_hash=document["access_token_hash"]
+        )
+        await self._authorize(sample=auth_sample, access_token=access_token)
+        return {
+            field: value
+            for field, value in document.items()
+            if field not in models.SAMPLE_AUTH_FIELDS
+        }
 
     async def create_sample(
         self, *, sample_creation: models.SampleCreation
     ) -> models.SampleAuthDetails:
-        access_token = self._authorizer.generate_token(length=16)
-        access_token_hash = self._authorizer.hash_token(token=access_token)
-        sample = models.Sample(
-            **sample_creation.dict(),
+        access_token, access_token_hash = await self._new_token_pair()
+        sample = models.from_validated(
+            models.Sample,
+            sample_creation,
             sample_id=self._random_string(10),
-            access_token_hash=access_token_hash
+            access_token_hash=access_token_hash,
         )
         await self._sample_dao.insert(sample)
-        sample_auth_details = models.SampleAuthDetails(
-            **sample.dict(), access_token=access_token
+        if self._sample_id_filter is not None:
+            self._sample_id_filter.add(sample.sample_id)
+        if self._token_cache is not None:
+            # the submitter is likely to poll the sample right away:
+            self._token_cache.add(
+                sample_id=sample.sample_id,
+                token=access_token,
+                token_hashed=access_token_hash,
+            )
+        sample_auth_details = models.from_validated(
+            models.SampleAuthDetails, sample, access_token=access_token
         )
         return sample_auth_details
 
+    async def create_samples(
+        self, *, sample_creations: Sequence[Mapping[str, Any]]
+    ) -> list[models.SampleBatchCreationResult]:
+        valid_creations, errors = validate_items(
+            sample_creations, models.SampleCreation
+        )
+        results = {
+            index: models.SampleBatchCreationResult(
+                index=index, status=models.BatchItemStatus.INVALID, error=error
+            )
+            for index, error in errors.items()
+        }
+
+        token_pairs = await asyncio.gather(
+            *(self._new_token_pair() for _ in valid_creations)
+        )
+        samples = {
+            index: models.from_validated(
+                models.Sample,
+                sample_creation,
+                sample_id=self._random_string(10),
+                access_token_hash=access_token_hash,
+            )
+            for (index, sample_creation), (_, access_token_hash) in zip(
+                valid_creations.items(), token_pairs
+            )
+        }
+        failures: dict[int, str] = {}
+        try:
+            conflicts = (
+                await self._sample_dao.insert_many(list(samples.values()))
+                if samples
+                else set()
+            )
+        except BulkInsertError as error:
+            conflicts, failures = error.conflicts, error.failures
+
+        for position, ((index, sample), (access_token, access_token_hash)) in enumerate(
+            zip(samples.items(), token_pairs)
+        ):
+            if position in failures:
+                results[index] = models.SampleBatchCreationResult(
+                    index=index,
+                    status=models.BatchItemStatus.FAILED,
+                    error=failures[position],
+                )
+            elif position in conflicts:
+                results[index] = models.SampleBatchCreationResult(
+                    index=index,
+                    status=models.BatchItemStatus.CONFLICT,
+                    error=f"A sample with the ID {sample.sample_id} already exists",
+                )
+            else:
+                if self._sample_id_filter is not None:
+                    self._sample_id_filter.add(sample.sample_id)
+                if self._token_cache is not None:
+                    self._token_cache.add(
+                        sample_id=sample.sample_id,
+                        token=access_token,
+                        token_hashed=access_token_hash,
+                    )
+                results[index] = models.SampleBatchCreationResult(
+                    index=index,
+                    status=models.BatchItemStatus.CREATED,
+                    sample_id=sample.sample_id,
+                    access_token=access_token,
+                )
+
+        return [results[index] for index in range(len(sample_creations))]
+
+    async def _apply_updates(
+        self,
+        *,
+        sample_id: str,
+        updates: Sequence[models.SampleUpdate],
+        access_token: Optional[str] = None,
+    ) -> Optional[models.Sample]:
+        """Read the sample, apply the updates in order, and write it back on the
+        condition that it wasn't modified in the meantime. The access token is
+        checked unless it is None. Returns the sample as it was stored, or None if
+        the updates didn't change it and nothing was written.
+
+        Raises:
+            ResourceNotFoundError: when the sample doesn't exist.
+            VersionConflictError: when the sample was modified concurrently.
+        """
+        sample = await self._sample_dao.get_by_id(sample_id)
+        if access_token is not None:
+            await self._authorize(sample=sample, access_token=access_token)
+        # taken after the authorization, which may have migrated the token hash:
+        stored = sample.copy()
+        for update in updates:
+            apply_test_data(sample, update)
+        if sample == stored:
+            return None
+        return await self._sample_dao.update_versioned(sample)
+
+    async def _publish_updated(self, samples: Sequence[models.Sample]) -> None:
+        """Announce that the samples were updated"""
+        samples_no_auth = [
+            models.from_validated(models.SampleNoAuth, sample) for sample in samples
+        ]
+        try:
+            if len(samples_no_auth) == 1:
+                await self._event_publisher.publish_sample_updated(
+                    sample_no_auth=samples_no_auth[0]
+                )
+            else:
+                await self._event_publisher.publish_samples_updated(
+                    samples_no_auth=samples_no_auth
+                )
+        except EventBufferFullError as err:
+            raise self.PublishingBacklogError() from err
+
     async def update_sample(
         self,
         *,
         updates: models.SampleUpdate,
         access_token: str = "",
-        is_external: bool = True
+        is_external: bool = True,
     ) -> None:
         try:
-            sample = await self._sample_dao.get_by_id(updates.sample_id)
+            if is_external:
+                sample = await self._update_retrier.run(
+                    lambda: self._apply_updates(
+                        sample_id=updates.sample_id,
+                        updates=[updates],
+                        access_token=access_token,
+                    )
+                )
+            else:
+                # internal updates need no authorization, so they can be applied
+                # without reading the sample first:
+                sample = await self._sample_dao.update_test_data(updates)
         except ResourceNotFoundError as err:
             raise self.SampleNotFoundError(sample_id=updates.sample_id) from err
+        except ConflictRetrier.RetriesExhaustedError as err:
+            raise self.UpdateConflictError(sample_id=updates.sample_id) from err
 
-        if is_external:
-            if not self._authorizer.check_token(
-                token_plain=access_token, token_hashed=sample.access_token_hash
-            ):
-                raise self.UnauthorizedRequestError(sample_id=updates.sample_id)
+        # redelivered or repeated updates that change nothing are not announced:
+        if sample is None:
+            return
+
+        await self._publish_updated([sample])
+
+    async def _authorize_many(
+        self,
+        *,
+        updates: dict[int, models.SampleBatchUpdate],
+        samples: dict[str, models.Sample],
+    ) -> set[int]:
+        """Concurrently authorize the batch updates for existing samples. Returns
+        the positions of the updates that are unauthorized."""
+        positions = [
+            index for index, update in updates.items() if update.sample_id in samples
+        ]
+        outcomes = await asyncio.gather(
+            *(
+                self._authorize(
+                    sample=samples[updates[index].sample_id],
+                    access_token=updates[index].access_token,
+                )
+                for index in positions
+            ),
+            return_exceptions=True,
+        )
+
+        unauthorized = set()
+        for index, outcome in zip(positions, outcomes):
+            if isinstance(outcome, self.UnauthorizedRequestError):
+                unauthorized.add(index)
+            elif isinstance(outcome, BaseException):
+                raise outcome
+        return unauthorized
 
-        sample.status = updates.status
-        sample.test_result = updates.test_result
-        sample.test_date = updates.test_date
-        await self._sample_dao.update(sample)
+    async def _write_batch(
+        self,
+        *,
+        samples: dict[str, models.Sample],
+        updates: Mapping[str, Sequence[models.SampleUpdate]],
+    ) -> dict[str, models.BatchItemStatus]:
+        """Write the updated samples with a single bulk operation. Samples that were
+        modified concurrently are read and updated again one by one. The samples are
+        replaced with their stored state, or removed if the retried updates turned
+        out to change nothing. Returns the samples that could not be updated, along
+        with the reason."""
+        sample_list = list(samples.values())
+        conflicts = await self._sample_dao.update_many(sample_list)
+        conflicting_ids = [sample_list[position].sample_id for position in conflicts]
+        outcomes = await asyncio.gather(
+            *(
+                self._update_retrier.run(
+                    partial(
+                        self._apply_updates,
+                        sample_id=sample_id,
+                        updates=updates[sample_id],
+                    )
+                )
+                for sample_id in conflicting_ids
+            ),
+            return_exceptions=True,
+        )
+
+        failures = {}
+        for sample_id, outcome in zip(conflicting_ids, outcomes):
+            if isinstance(outcome, ResourceNotFoundError):
+                failures[sample_id] = models.BatchItemStatus.NOT_FOUND
+            elif isinstance(outcome, ConflictRetrier.RetriesExhaustedError):
+                failures[sample_id] = models.BatchItemStatus.CONFLICT
+            elif isinstance(outcome, BaseException):
+                raise outcome
+            elif outcome is None:
+                del samples[sample_id]
+            else:
+                samples[sample_id] = outcome
+
+        for sample_id in failures:
+            del samples[sample_id]
+        return failures
+
+    async def update_samples(
+        self, *, updates: Sequence[Mapping[str, Any]], is_external: bool = True
+    ) -> list[models.SampleBatchUpdateResult]:
+        valid_updates, errors = validate_items(updates, models.SampleBatchUpdate)
+        results = {
+            index: models.SampleBatchUpdateResult(
+                index=index, status=models.BatchItemStatus.INVALID, error=error
+            )
+            for index, error in errors.items()
+        }
+
+        samples = await self._sample_dao.get_many(
+            {update.sample_id for update in valid_updates.values()}
+        )
+        unauthorized = (
+            await self._authorize_many(updates=valid_updates, samples=samples)
+            if is_external
+            else set()
+        )
+        # taken after the authorization, which may have migrated token hashes:
+        stored = {sample_id: sample.copy() for sample_id, sample in samples.items()}
+
+        # updates to the same sample are applied in the order supplied:
+        applied: dict[str, list[models.SampleUpdate]] = {}
+        for index, update in valid_updates.items():
+            if update.sample_id in samples and index not in unauthorized:
+                apply_test_data(samples[update.sample_id], update)
+                applied.setdefault(update.sample_id, []).append(update)
+        # samples that end up unchanged are neither written nor announced:
+        updated_samples = {
+            sample_id: samples[sample_id]
+            for sample_id in applied
+            if samples[sample_id] != stored[sample_id]
+        }
 
-        sample_no_auth = models.SampleNoAuth(**sample.dict())
-        await self._event_publisher.publish_sample_updated(
-            sample_no_auth=sample_no_auth
+        failures = (
+            await self._write_batch(samples=updated_samples, updates=applied)
+            if updated_samples
+            else {}
         )
+
+        for index, update in valid_updates.items():
+            status = failures.get(update.sample_id, models.BatchItemStatus.UPDATED)
+            if update.sample_id not in samples:
+                status = models.BatchItemStatus.NOT_FOUND
+            elif index in unauthorized:
+                status = models.BatchItemStatus.UNAUTHORIZED
+            results[index] = models.SampleBatchUpdateResult(
+                index=index, sample_id=update.sample_id, status=status
+            )
+
+        if updated_samples:
+            await self._publish_updated(list(updated_samples.values()))
+
+        return [results[index] for index in range(len(updates))]
+
+    async def create_session_token(
+        self, *, sample_id: str, access_token: str
+    ) -> models.SessionToken:
+        if self._session_signer is None:
+            raise self.SessionTokensDisabledError()
+
+        sample = await self._get_sample(sample_id)
+
+        # session tokens can't be used to obtain new ones, so they can't be extended:
+        await self._authorize(
+            sample=sample, access_token=access_token, accept_session_token=False
+        )
+
+        session_token, expires_at = self._session_signer.issue(sample_id=sample_id)
+        return models.SessionToken(session_token=session_token, expires_at=expires_at)
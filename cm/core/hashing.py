@@ -0,0 +1,221 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Interchangeable backends for hashing access tokens. Every hash encodes the
+algorithm that produced it, so tokens hashed by different backends can coexist in
+the database."""
+
+import base64
+import hashlib
+import hmac
+import secrets
+from abc import ABC, abstractmethod
+from typing import Literal, Optional
+
+import bcrypt
+from pydantic import BaseSettings, Field, SecretStr, root_validator, validator
+
+
+class TokenHashingConfig(BaseSettings):
+    """Config for hashing access tokens"""
+
+    token_hash_algorithm: Literal["bcrypt", "hmac-sha256", "scrypt"] = Field(
+        "bcrypt",
+        description=(
+            "Algorithm used to hash new access tokens. Tokens hashed with a different"
+            + " algorithm or cost are re-hashed on their next successful verification."
+        ),
+        example="hmac-sha256",
+    )
+    token_hash_pepper: Optional[SecretStr] = Field(
+        None,
+        description=(
+            "Secret key for the 'hmac-sha256' algorithm. Required if that algorithm is"
+            + " used or if hashes produced by it are stored in the database."
+        ),
+        example="a-long-random-secret",
+    )
+    bcrypt_rounds: int = Field(
+        12, ge=4, le=31, description="Cost factor for bcrypt", example=12
+    )
+    scrypt_cost: int = Field(
+        2**14,
+        ge=2,
+        description="CPU/memory cost parameter n for scrypt (a power of two)",
+        example=2**14,
+    )
+
+    @validator("scrypt_cost")
+    @classmethod
+    def check_scrypt_cost(cls, value: int) -> int:
+        """Make sure the scrypt cost is a power of two, as scrypt requires"""
+        if value & (value - 1):
+            raise ValueError("The scrypt_cost must be a power of two.")
+        return value
+
+    @root_validator(skip_on_failure=True)
+    @classmethod
+    def check_pepper(cls, values):
+        """Make sure a pepper is set if HMAC-SHA256 is used"""
+        if values["token_hash_algorithm"] == "hmac-sha256" and not values.get(
+            "token_hash_pepper"
+        ):
+            raise ValueError("The hmac-sha256 algorithm requires a token_hash_pepper.")
+        return values
+
+
+class TokenHasher(ABC):
+    """A backend for hashing and verifying access tokens"""
+
+    name: str
+
+    @classmethod
+    @abstractmethod
+    def from_config(cls, config: TokenHashingConfig) -> "TokenHasher":
+        """Create an instance configured according to the config"""
+
+    @abstractmethod
+    def hash(self, token: str) -> str:
+        """Returns the hash of the token, encoding the algorithm used"""
+
+    @abstractmethod
+    def verify(self, token: str, token_hashed: str) -> bool:
+        """Checks whether the token matches the hash"""
+
+    def identifies(self, token_hashed: str) -> bool:
+        """Checks whether the hash was produced by this backend"""
+        return token_hashed.startswith(f"${self.name}$")
+
+    def needs_rehash(  # pylint: disable=unused-argument
+        self, token_hashed: str
+    ) -> bool:
+        """Checks whether a hash produced by this backend used outdated parameters"""
+        return False
+
+
+class BcryptHasher(TokenHasher):
+    """Uses bcrypt, which encodes its own identifier and cost in the hash"""
+
+    name = "bcrypt"
+
+    def __init__(self, *, rounds: int = 12):
+        self._rounds = rounds
+
+    @classmethod
+    def from_config(cls, config: TokenHashingConfig) -> "BcryptHasher":
+        return cls(rounds=config.bcrypt_rounds)
+
+    def hash(self, token: str) -> str:
+        hash_bytes = bcrypt.hashpw(token.encode("utf-8"), bcrypt.gensalt(self._rounds))
+        return hash_bytes.decode("utf-8")
+
+    def verify(self, token: str, token_hashed: str) -> bool:
+        return bcrypt.checkpw(token.encode("utf-8"), token_hashed.encode("utf-8"))
+
+    def identifies(self, token_hashed: str) -> bool:
+        return token_hashed[:4] in ("$2a$", "$2b$", "$2y$")
+
+    def needs_rehash(self, token_hashed: str) -> bool:
+        return int(token_hashed[4:6]) != self._rounds
+
+
+class HmacSha256Hasher(TokenHasher):
+    """Uses an HMAC-SHA256 keyed with a secret pepper. Only suitable for high-entropy
+    tokens such as the randomly generated access tokens, for which the hash does not
+    need to be slow. Format: $hmac-sha256$<hex digest>"""
+
+    name = "hmac-sha256"
+
+    def __init__(self, *, pepper: Optional[SecretStr]):
+        self._pepper = pepper
+
+    @classmethod
+    def from_config(cls, config: TokenHashingConfig) -> "HmacSha256Hasher":
+        return cls(pepper=config.token_hash_pepper)
+
+    def _digest(self, token: str) -> str:
+        """Returns the hex digest of the token"""
+        if self._pepper is None:
+            raise ValueError("Cannot use hmac-sha256 without a token_hash_pepper.")
+        key = self._pepper.get_secret_value().encode("utf-8")
+        return hmac.new(key, token.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def hash(self, token: str) -> str:
+        return f"${self.name}${self._digest(token)}"
+
+    def verify(self, token: str, token_hashed: str) -> bool:
+        return hmac.compare_digest(self.hash(token), token_hashed)
+
+
+class ScryptHasher(TokenHasher):
+    """Uses scrypt with a random salt.
+    Format: $scrypt$n=<n>,r=<r>,p=<p>$<base64 salt>$<base64 hash>"""
+
+    name = "scrypt"
+
+    def __init__(self, *, n: int = 2**14, r: int = 8, p: int = 1):
+        self._params = {"n": n, "r": r, "p": p}
+
+    @classmethod
+    def from_config(cls, config: TokenHashingConfig) -> "ScryptHasher":
+        return cls(n=config.scrypt_cost)
+
+    @staticmethod
+    def _derive(token: str, salt: bytes, params: dict[str, int]) -> bytes:
+        """Derive the scrypt hash of the token"""
+        maxmem = 256 * params["n"] * params["r"] + 1024**2
+        return hashlib.scrypt(
+            token.encode("utf-8"), salt=salt, dklen=32, maxmem=maxmem, **params
+        )
+
+    @staticmethod
+    def _parse(token_hashed: str) -> tuple[dict[str, int], bytes, bytes]:
+        """Split a hash into its parameters, salt, and derived key"""
+        _, _, params, salt, derived = token_hashed.split("$")
+        parsed_params = {
+            key: int(value)
+            for key, value in (param.split("=") for param in params.split(","))
+        }
+        return parsed_params, base64.b64decode(salt), base64.b64decode(derived)
+
+    def hash(self, token: str) -> str:
+        salt = secrets.token_bytes(16)
+        derived = self._derive(token, salt, self._params)
+        params = ",".join(f"{key}={value}" for key, value in self._params.items())
+        return "$".join(
+            [
+                "",
+                self.name,
+                params,
+                base64.b64encode(salt).decode("ascii"),
+                base64.b64encode(derived).decode("ascii"),
+            ]
+        )
+
+    def verify(self, token: str, token_hashed: str) -> bool:
+        params, salt, derived = self._parse(token_hashed)
+        return hmac.compare_digest(self._derive(token, salt, params), derived)
+
+    def needs_rehash(self, token_hashed: str) -> bool:
+        params, _, _ = self._parse(token_hashed)
+        return params != self._params
+
+
+# registry of all available backends, by the name used to select them in the config:
+TOKEN_HASHERS: dict[str, type[TokenHasher]] = {
+    BcryptHasher.name: BcryptHasher,
+    HmacSha256Hasher.name: HmacSha256Hasher,
+    ScryptHasher.name: ScryptHasher,
+}
@@ -0,0 +1,234 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An in-memory filter of existing sample IDs, so that requests for unknown IDs can be
+rejected without a database round trip."""
+
+import asyncio
+import hashlib
+import logging
+import math
+import time
+from contextlib import asynccontextmanager, suppress
+from typing import Optional
+
+from pydantic import BaseSettings, Field
+
+from cm.core.metrics import MetricsCollector
+from cm.ports.outbound.dao import SampleDaoPort
+
+MIN_CAPACITY = 1024
+
+
+class SampleIdFilterConfig(BaseSettings):
+    """Config for the filter of existing sample IDs"""
+
+    sample_id_filter_enabled: bool = Field(
+        False,
+        description=(
+            "Whether to reject requests for unknown sample IDs using an in-memory"
+            + " filter instead of a database lookup. Samples created by other"
+            + " instances of the service are only known after the next rebuild, so"
+            + " only enable this for a single instance or with a short rebuild"
+            + " interval."
+        ),
+        example=False,
+    )
+    sample_id_filter_false_positive_rate: float = Field(
+        0.01,
+        gt=0,
+        lt=1,
+        description=(
+            "Targeted share of unknown IDs that still cause a database lookup. Lower"
+            + " rates need more memory."
+        ),
+        example=0.01,
+    )
+    sample_id_filter_rebuild_interval_seconds: float = Field(
+        300,
+        gt=0,
+        description=(
+            "Number of seconds between two rebuilds of the filter from the database"
+        ),
+        example=300,
+    )
+
+
+class BloomFilter:
+    """A Bloom filter for strings, sized for an expected number of entries and a
+    false-positive rate"""
+
+    def __init__(self, *, capacity: int, false_positive_rate: float):
+        capacity = max(capacity, 1)
+        self._num_bits = math.ceil(
+            -capacity * math.log(false_positive_rate) / math.log(2) ** 2
+        )
+        self._num_hashes = max(1, round(self._num_bits / capacity * math.log(2)))
+        self._bits = bytearray(math.ceil(self._num_bits / 8))
+        self.capacity = capacity
+        self.entries = 0
+
+    def _positions(self, item: str) -> list[int]:
+        """The bit positions of the item, obtained by double hashing"""
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [
+            (first + index * second) % self._num_bits
+            for index in range(self._num_hashes)
+        ]
+
+    def add(self, item: str) -> None:
+        """Add the item to the filter"""
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.entries += 1
+
+    def __contains__(self, item: str) -> bool:
+        """False if the item was definitely never added"""
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+    def false_positive_rate(self) -> float:
+        """The expected false-positive rate for the current number of entries"""
+        return (
+            1 - math.exp(-self._num_hashes * self.entries / self._num_bits)
+        ) ** self._num_hashes
+
+
+class SampleIdFilter:  # pylint: disable=too-many-instance-attributes
+    """Knows which sample IDs definitely don't exist.
+
+    The filter is built with a scan of all sample IDs in the background and rebuilt
+    periodically, which also resizes it to the current number of samples. Until the
+    first build has finished, every ID is considered to possibly exist.
+    """
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls,
+        *,
+        config: SampleIdFilterConfig,
+        sample_dao: SampleDaoPort,
+        metrics: MetricsCollector,
+    ):
+        """Setup and teardown a SampleIdFilter along with its rebuild task. Yields
+        None if the filter is disabled."""
+        if not config.sample_id_filter_enabled:
+            yield None
+            return
+
+        sample_id_filter = cls(
+            sample_dao=sample_dao,
+            false_positive_rate=config.sample_id_filter_false_positive_rate,
+            rebuild_interval_seconds=config.sample_id_filter_rebuild_interval_seconds,
+            metrics=metrics,
+        )
+        sample_id_filter.start()
+        try:
+            yield sample_id_filter
+        finally:
+            await sample_id_filter.stop()
+
+    def __init__(
+        self,
+        *,
+        sample_dao: SampleDaoPort,
+        false_positive_rate: float = 0.01,
+        rebuild_interval_seconds: float = 300,
+        metrics: Optional[MetricsCollector] = None,
+    ):
+        self._sample_dao = sample_dao
+        self._false_positive_rate = false_positive_rate
+        self._rebuild_interval_seconds = rebuild_interval_seconds
+        self._metrics = metrics
+        self._filter: Optional[BloomFilter] = None
+        # the filter being built, which has to learn about new IDs as well:
+        self._next_filter: Optional[BloomFilter] = None
+        self._rebuild_task: Optional[asyncio.Task] = None
+        self.last_rebuild_seconds = 0.0
+
+        if metrics is not None:
+            metrics.register_gauge(
+                "sample_id_filter_false_positive_rate",
+                lambda: self._filter.false_positive_rate() if self._filter else 0.0,
+            )
+            metrics.register_gauge(
+                "sample_id_filter_rebuild_seconds", lambda: self.last_rebuild_seconds
+            )
+
+    def start(self) -> None:
+        """Start building the filter in the background"""
+        if self._rebuild_task is None:
+            self._rebuild_task = asyncio.create_task(self._rebuild_periodically())
+
+    async def stop(self) -> None:
+        """Stop rebuilding the filter"""
+        if self._rebuild_task is not None:
+            self._rebuild_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._rebuild_task
+            self._rebuild_task = None
+
+    async def _scan(self, *, capacity: int) -> BloomFilter:
+        """Build a filter of the given capacity from a scan of all sample IDs"""
+        self._next_filter = BloomFilter(
+            capacity=capacity, false_positive_rate=self._false_positive_rate
+        )
+        try:
+            async for sample_id in self._sample_dao.iter_ids():
+                self._next_filter.add(sample_id)
+            return self._next_filter
+        finally:
+            self._next_filter = None
+
+    async def rebuild(self) -> None:
+        """Build a new filter with a scan of all sample IDs and swap it in. The filter
+        is sized for twice the number of samples found, to leave room for growth."""
+        started = time.monotonic()
+        entries = self._filter.entries if self._filter else 0
+        new_filter = await self._scan(capacity=max(2 * entries, MIN_CAPACITY))
+        if new_filter.false_positive_rate() > self._false_positive_rate:
+            # too small for the number of samples, which is known now:
+            self._filter = new_filter
+            new_filter = await self._scan(capacity=2 * new_filter.entries)
+        self._filter = new_filter
+        self.last_rebuild_seconds = time.monotonic() - started
+
+    async def _rebuild_periodically(self) -> None:
+        """Rebuild the filter in the configured interval"""
+        while True:
+            try:
+                await self.rebuild()
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Failed to rebuild the sample ID filter")
+            await asyncio.sleep(self._rebuild_interval_seconds)
+
+    def add(self, sample_id: str) -> None:
+        """Register a newly created sample ID"""
+        for bloom_filter in (self._filter, self._next_filter):
+            if bloom_filter is not None:
+                bloom_filter.add(sample_id)
+
+    def might_exist(self, sample_id: str) -> bool:
+        """False if no sample with this ID exists. Counts the rejected IDs."""
+        if self._filter is None or sample_id in self._filter:
+            return True
+        if self._metrics is not None:
+            self._metrics.increment("sample_id_filter_rejections")
+        return False
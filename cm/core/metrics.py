@@ -0,0 +1,63 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A lightweight, in-process collector for counters and gauges, used to expose
+performance-related metrics of the service's components."""
+
+from typing import Callable, Optional
+
+from pydantic import BaseSettings, Field, SecretStr
+
+
+class MetricsConfig(BaseSettings):
+    """Config for exposing the collected metrics"""
+
+    metrics_token: Optional[SecretStr] = Field(
+        None,
+        description=(
+            "Bearer token that must be presented to read the metrics endpoint."
+            + " If not set, the metrics endpoint is disabled."
+        ),
+        example="a-long-random-token",
+    )
+
+
+class MetricsCollector:
+    """Collects named counters and gauges reported by the service's components"""
+
+    def __init__(self):
+        """Start with no counters and no gauges"""
+        self._counters: dict[str, float] = {}
+        self._gauges: dict[str, Callable[[], float]] = {}
+
+    @classmethod
+    async def construct(cls) -> "MetricsCollector":
+        """Constructor compatible with the hexkit.inject.AsyncConstructable type. Used
+        so that all components of a container report to the same collector."""
+        return cls()
+
+    def increment(self, name: str, amount: float = 1) -> None:
+        """Increase the counter with the given name by the given amount"""
+        self._counters[name] = self._counters.get(name, 0) + amount
+
+    def register_gauge(self, name: str, callback: Callable[[], float]) -> None:
+        """Register a callback that returns the current value of the named gauge"""
+        self._gauges[name] = callback
+
+    def snapshot(self) -> dict[str, float]:
+        """Returns the current value of all counters and gauges"""
+        values = dict(self._counters)
+        values.update({name: callback() for name, callback in self._gauges.items()})
+        return dict(sorted(values.items()))
@@ -15,11 +15,45 @@
 
 """Defines dataclasses for holding business-logic data"""
 
+from datetime import datetime, timezone
 from enum import Enum
+from typing import Any, Optional, TypeVar
 
 from ghga_service_chassis_lib.utils import DateTimeUTC
 from pydantic import BaseModel, EmailStr, Field
 
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+# the test date of samples without a test result yet. Defaults are not validated, so
+# it is given as a datetime for models constructed without validation to match:
+NO_TEST_DATE = datetime(9999, 12, 31, 11, 59, tzinfo=timezone.utc)
+
+
+def from_validated(model_cls: type[ModelT], source: BaseModel, **values: Any) -> ModelT:
+    """Create an instance of the model class from the fields of an already validated
+    model and the given values, without validating them again. The values are not
+    converted, so they have to be of the types of the fields already. Fields of the
+    source that the model class doesn't define are left out."""
+    fields = {
+        name: value
+        for name, value in source.__dict__.items()
+        if name in model_cls.__fields__
+    }
+    return model_cls.construct(**{**fields, **values})
+
+
+def assign_validated(model: BaseModel, **values: Any) -> None:
+    """Set fields of the model to values that were already validated as part of
+    another model, bypassing the validation on assignment"""
+    model.__dict__.update(values)
+    model.__fields_set__.update(values)
+
+
+# fields of samples that are only used for authorization and are never returned:
+SAMPLE_AUTH_FIELDS = frozenset({"access_token_hash"})
+# fields of samples that are only used by the service itself and are never returned:
+SAMPLE_INTERNAL_FIELDS = frozenset({"version"})
+
 
 class SampleStatus(str, Enum):
     """Enumeration for Sample status values"""
@@ -37,6 +71,18 @@ class SampleTestResult(str, Enum):
     NEGATIVE = "negative"
 
 
+class BatchItemStatus(str, Enum):
+    """Enumeration for the outcome of a single item in a batch operation"""
+
+    CREATED = "created"
+    UPDATED = "updated"
+    INVALID = "invalid"
+    CONFLICT = "conflict"
+    FAILED = "failed"
+    NOT_FOUND = "not_found"
+    UNAUTHORIZED = "unauthorized"
+
+
 class SampleCreation(BaseModel):
     """Pydantic model to perform validation on new submission data.
     This is separate from the Sample model to prevent someone from submitting
@@ -54,7 +100,7 @@ class SampleFullCreation(SampleCreation):
     status: SampleStatus = SampleStatus.PENDING
     test_result: SampleTestResult = SampleTestResult.INCONCLUSIVE
     test_date: DateTimeUTC = Field(
-        default="9999-12-31T11:59Z", description="The date the test was completed."
+        default=NO_TEST_DATE, description="The date the test was completed."
     )
 
     class Config:
@@ -68,6 +114,10 @@ class Sample(SampleFullCreation):
 
     sample_id: str
     access_token_hash: str
+    version: int = Field(
+        default=0,
+        description="Incremented on every update, to detect concurrent modifications",
+    )
 
 
 class SampleAuthDetails(Sample):
@@ -76,6 +126,32 @@ class SampleAuthDetails(Sample):
     access_token: str = Field(default=..., regex=r"^[a-zA-Z0-9]*$")
 
 
+class SampleResponse(SampleFullCreation):
+    """A sample as it is returned to clients, without the auth and internal fields"""
+
+    sample_id: str
+
+
+class SampleProjection(BaseModel):
+    """A sample as it is returned to clients that requested only some of its fields.
+    Fields that were not requested are left out."""
+
+    sample_id: str
+    patient_pseudonym: Optional[str] = None
+    submitter_email: Optional[EmailStr] = None
+    collection_date: Optional[DateTimeUTC] = None
+    status: Optional[SampleStatus] = None
+    test_result: Optional[SampleTestResult] = None
+    test_date: Optional[DateTimeUTC] = None
+
+
+class SampleCreationResponse(SampleResponse):
+    """A newly created sample as it is returned to the submitter"""
+
+    access_token_hash: str
+    access_token: str
+
+
 class SampleUpdate(BaseModel):
     """Update class for Sample"""
 
@@ -83,11 +159,43 @@ class SampleUpdate(BaseModel):
     status: SampleStatus
     test_result: SampleTestResult
     test_date: DateTimeUTC = Field(
-        default="9999-12-31T11:59Z", description="The date the test was completed."
+        default=NO_TEST_DATE, description="The date the test was completed."
     )
 
 
+class SampleBatchUpdate(SampleUpdate):
+    """A SampleUpdate along with the access token for the sample, for batch updates"""
+
+    access_token: str = ""
+
+
 class SampleNoAuth(SampleCreation, SampleUpdate):
     """A class containing all of the sample information without the auth values"""
 
     ...
+
+
+class SessionToken(BaseModel):
+    """A short-lived token granting access to a single sample"""
+
+    session_token: str
+    expires_at: DateTimeUTC
+
+
+class SampleBatchCreationResult(BaseModel):
+    """The outcome of creating a single sample as part of a batch"""
+
+    index: int = Field(..., description="Position of the item in the submitted batch")
+    status: BatchItemStatus
+    sample_id: Optional[str] = None
+    access_token: Optional[str] = None
+    error: Optional[str] = None
+
+
+class SampleBatchUpdateResult(BaseModel):
+    """The outcome of updating a single sample as part of a batch"""
+
+    index: int = Field(..., description="Position of the item in the submitted batch")
+    sample_id: Optional[str] = None
+    status: BatchItemStatus
+    error: Optional[str] = None
@@ -0,0 +1,127 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Retrying of conditional writes that lost a race against a concurrent update of
+the same sample (optimistic concurrency control)."""
+
+import asyncio
+import random
+from collections.abc import Awaitable
+from typing import Callable, Optional, TypeVar
+
+from pydantic import BaseSettings, Field
+
+from cm.core.metrics import MetricsCollector
+from cm.ports.outbound.dao import VersionConflictError
+
+ResultT = TypeVar("ResultT")
+
+
+class ConflictRetryConfig(BaseSettings):
+    """Config for retrying updates after version conflicts"""
+
+    update_max_attempts: int = Field(
+        5,
+        ge=1,
+        description=(
+            "Maximum number of attempts to apply an update to a sample that is"
+            + " concurrently modified by other requests or events"
+        ),
+        example=5,
+    )
+    update_retry_base_delay_seconds: float = Field(
+        0.01,
+        ge=0,
+        description=(
+            "Delay before the first retry after a version conflict. The delay is"
+            + " doubled for every further retry and randomized to avoid lockstep."
+        ),
+        example=0.01,
+    )
+    update_retry_max_delay_seconds: float = Field(
+        0.5,
+        ge=0,
+        description="Upper bound for the delay between two attempts of an update",
+        example=0.5,
+    )
+
+
+class ConflictRetrier:
+    """Runs read-modify-write operations until their conditional write succeeds.
+
+    Conflicts and retries are counted as `update_conflicts` and `update_retries`.
+    """
+
+    class RetriesExhaustedError(RuntimeError):
+        """Raised when an operation still conflicts after the last attempt"""
+
+        def __init__(self, *, attempts: int):
+            message = f"Update still conflicted after {attempts} attempts"
+            super().__init__(message)
+
+    @classmethod
+    async def construct(
+        cls, *, config: ConflictRetryConfig, metrics: MetricsCollector
+    ) -> "ConflictRetrier":
+        """Constructor compatible with the hexkit.inject.AsyncConstructable type"""
+        return cls(
+            max_attempts=config.update_max_attempts,
+            base_delay=config.update_retry_base_delay_seconds,
+            max_delay=config.update_retry_max_delay_seconds,
+            metrics=metrics,
+        )
+
+    def __init__(
+        self,
+        *,
+        max_attempts: int = 5,
+        base_delay: float = 0.01,
+        max_delay: float = 0.5,
+        metrics: Optional[MetricsCollector] = None,
+    ):
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._metrics = metrics
+
+    def _count(self, name: str) -> None:
+        """Increment the named counter, if metrics are collected"""
+        if self._metrics is not None:
+            self._metrics.increment(name)
+
+    def _delay(self, *, retry: int) -> float:
+        """Exponential backoff with full jitter, bounded by the maximum delay"""
+        return random.uniform(  # nosec
+            0, min(self._max_delay, self._base_delay * 2**retry)
+        )
+
+    async def run(self, operation: Callable[[], Awaitable[ResultT]]) -> ResultT:
+        """Await the operation, calling it again after a backoff whenever it raises
+        a VersionConflictError. The operation has to re-read the current state on
+        every call.
+
+        Raises:
+            RetriesExhaustedError: when the last attempt still conflicted.
+        """
+        for retry in range(self._max_attempts):
+            if retry:
+                self._count("update_retries")
+                await asyncio.sleep(self._delay(retry=retry - 1))
+            try:
+                return await operation()
+            except VersionConflictError:
+                self._count("update_conflicts")
+
+        raise self.RetriesExhaustedError(attempts=self._max_attempts)
@@ -0,0 +1,89 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A compact representation of samples, for holding many of them in memory"""
+
+import sys
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple
+
+from cm.core import models
+
+_STATUSES = tuple(models.SampleStatus)
+_TEST_RESULTS = tuple(models.SampleTestResult)
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def to_epoch_micros(value: datetime) -> int:
+    """Convert a datetime with timezone to microseconds since the epoch"""
+    return (value - _EPOCH) // _MICROSECOND
+
+
+def from_epoch_micros(micros: int) -> datetime:
+    """Convert microseconds since the epoch to a datetime in UTC"""
+    return _EPOCH + timedelta(microseconds=micros)
+
+
+class SampleRecord(NamedTuple):
+    """An immutable Sample that takes a fraction of the memory of the pydantic model.
+    Enums are stored as their index and datetimes as microseconds since the epoch,
+    which is lossless for the UTC datetimes of samples."""
+
+    sample_id: str
+    patient_pseudonym: str
+    submitter_email: str
+    collection_date: int
+    status: int
+    test_result: int
+    test_date: int
+    access_token_hash: str
+    version: int
+
+    @classmethod
+    def from_sample(cls, sample: models.Sample) -> "SampleRecord":
+        """Create the record of a validated sample"""
+        return cls(
+            sample_id=sample.sample_id,
+            patient_pseudonym=sample.patient_pseudonym,
+            submitter_email=sample.submitter_email,
+            collection_date=to_epoch_micros(sample.collection_date),
+            status=_STATUSES.index(sample.status),
+            test_result=_TEST_RESULTS.index(sample.test_result),
+            test_date=to_epoch_micros(sample.test_date),
+            access_token_hash=sample.access_token_hash,
+            version=sample.version,
+        )
+
+    def to_sample(self) -> models.Sample:
+        """Create a new Sample from the record. The values were validated when the
+        record was created, so they are not validated again."""
+        return models.Sample.construct(
+            sample_id=self.sample_id,
+            patient_pseudonym=self.patient_pseudonym,
+            submitter_email=self.submitter_email,
+            collection_date=from_epoch_micros(self.collection_date),
+            status=_STATUSES[self.status],
+            test_result=_TEST_RESULTS[self.test_result],
+            test_date=from_epoch_micros(self.test_date),
+            access_token_hash=self.access_token_hash,
+            version=self.version,
+        )
+
+    @property
+    def nbytes(self) -> int:
+        """The approximate memory taken by the record and its values"""
+        sizes = map(sys.getsizeof, self)  # pylint: disable=not-an-iterable
+        return sys.getsizeof(self) + sum(sizes)
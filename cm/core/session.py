@@ -0,0 +1,126 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Short-lived, HMAC-signed session tokens that are scoped to a single sample. They
+can be verified with a constant-time signature check instead of a hash verification
+of the long-lived access token."""
+
+import hashlib
+import hmac
+import logging
+import secrets
+import time
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+from pydantic import BaseSettings, Field, SecretStr
+
+SESSION_TOKEN_PREFIX = "st"
+
+
+class SessionTokenConfig(BaseSettings):
+    """Config for session tokens"""
+
+    session_tokens_enabled: bool = Field(
+        False,
+        description=(
+            "Whether access tokens can be exchanged for short-lived session tokens,"
+            + " which are verified without hashing"
+        ),
+        example=True,
+    )
+    session_token_ttl_seconds: int = Field(
+        900,
+        gt=0,
+        description="Number of seconds a session token stays valid",
+        example=900,
+    )
+    session_token_secret: Optional[SecretStr] = Field(
+        None,
+        description=(
+            "Secret key used to sign session tokens. Must be shared by all instances"
+            + " of the service. If not set, a random key is generated on startup, so"
+            + " session tokens are only valid for the instance that issued them."
+        ),
+        example="a-long-random-secret",
+    )
+
+
+class SessionTokenSigner:
+    """Issues and verifies session tokens of the form st.<expiry>.<signature>, where
+    the signature covers the sample ID and the expiry (in epoch seconds). Since access
+    tokens only consist of letters and digits, the two can't be confused."""
+
+    @classmethod
+    async def construct(
+        cls, *, config: SessionTokenConfig
+    ) -> Optional["SessionTokenSigner"]:
+        """Constructor compatible with the hexkit.inject.AsyncConstructable type.
+        Returns None if session tokens are disabled."""
+        if not config.session_tokens_enabled:
+            return None
+
+        if config.session_token_secret is None:
+            logging.warning(
+                "No session_token_secret set, session tokens are instance-specific."
+            )
+            secret = secrets.token_bytes(32)
+        else:
+            secret = config.session_token_secret.get_secret_value().encode("utf-8")
+
+        return cls(secret=secret, ttl_seconds=config.session_token_ttl_seconds)
+
+    def __init__(
+        self,
+        *,
+        secret: bytes,
+        ttl_seconds: int,
+        clock: Callable[[], float] = time.time,
+    ):
+        self._secret = secret
+        self._ttl_seconds = ttl_seconds
+        self._clock = clock
+
+    def _sign(self, *, sample_id: str, expires: int) -> str:
+        """Returns the hex signature for the sample ID and expiry"""
+        message = f"{sample_id}.{expires}".encode("utf-8")
+        return hmac.new(self._secret, message, hashlib.sha256).hexdigest()
+
+    @staticmethod
+    def is_session_token(token: str) -> bool:
+        """Checks whether the token has the form of a session token"""
+        return token.startswith(f"{SESSION_TOKEN_PREFIX}.")
+
+    def issue(self, *, sample_id: str) -> tuple[str, datetime]:
+        """Returns a session token for the sample and the time it expires"""
+        expires = int(self._clock()) + self._ttl_seconds
+        signature = self._sign(sample_id=sample_id, expires=expires)
+        token = f"{SESSION_TOKEN_PREFIX}.{expires}.{signature}"
+        return token, datetime.fromtimestamp(expires, tz=timezone.utc)
+
+    def verify(self, *, token: str, sample_id: str) -> bool:
+        """Checks that the session token was issued for the sample and hasn't expired"""
+        try:
+            prefix, expires, signature = token.split(".")
+            expires_int = int(expires)
+        except ValueError:
+            return False
+
+        expected = self._sign(sample_id=sample_id, expires=expires_int)
+        return (
+            prefix == SESSION_TOKEN_PREFIX
+            and hmac.compare_digest(expected, signature)
+            and expires_int > self._clock()
+        )
@@ -0,0 +1,67 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Coalescing of concurrent calls that would produce the same result"""
+
+import asyncio
+from collections.abc import Awaitable, Hashable
+from typing import Callable, Generic, Optional, TypeVar
+
+from cm.core.metrics import MetricsCollector
+
+KeyT = TypeVar("KeyT", bound=Hashable)
+ResultT = TypeVar("ResultT")
+
+
+class SingleFlight(Generic[KeyT, ResultT]):
+    """Lets concurrent callers with the same key share one in-flight call.
+
+    The call runs as a task of its own, so a cancelled caller doesn't cancel it for the
+    others. Its result or exception is passed to every caller, which have to copy
+    mutable results before modifying them. Callers that joined an existing call are
+    counted under the given counter name.
+    """
+
+    def __init__(
+        self, *, counter_name: str, metrics: Optional[MetricsCollector] = None
+    ):
+        self._counter_name = counter_name
+        self._metrics = metrics
+        self._calls: dict[KeyT, asyncio.Task[ResultT]] = {}
+
+    def _discard(self, key: KeyT, task: asyncio.Task[ResultT]) -> None:
+        """Remove the finished call, unless it was already replaced"""
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # prevents warnings if all callers were cancelled:
+            task.exception()
+
+    async def run(self, key: KeyT, func: Callable[[], Awaitable[ResultT]]) -> ResultT:
+        """Await the result of the call in flight for the key, or of a new call of
+        func if there is none"""
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._discard(key, done))
+        elif self._metrics is not None:
+            self._metrics.increment(self._counter_name)
+        return await asyncio.shield(task)
+
+    def forget(self, key: KeyT) -> None:
+        """Let later callers start a new call even if one is in flight for the key,
+        e.g. because its result is known to be outdated"""
+        self._calls.pop(key, None)
@@ -0,0 +1,130 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A cache of successful token verifications, so that clients polling the same
+sample don't pay for a full hash verification on every request."""
+
+import hashlib
+import hmac
+import secrets
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from pydantic import BaseSettings, Field
+
+from cm.core.metrics import MetricsCollector
+
+
+class VerifiedTokenCacheConfig(BaseSettings):
+    """Config for the verified-token cache"""
+
+    token_cache_max_entries: int = Field(
+        10000,
+        ge=0,
+        description=(
+            "Maximum number of verified tokens to remember. The least recently used"
+            + " entry is evicted first. Set to 0 to disable the cache."
+        ),
+        example=10000,
+    )
+    token_cache_ttl_seconds: float = Field(
+        300,
+        gt=0,
+        description="Number of seconds a successful verification is remembered for",
+        example=300,
+    )
+
+
+class VerifiedTokenCache:
+    """Remembers which tokens were successfully verified for which sample.
+
+    Entries are keyed by the sample ID and a keyed HMAC of the presented token, so
+    plaintext tokens are never stored. The key is generated randomly on startup. An
+    entry only counts as a hit while the sample's stored hash is unchanged.
+    """
+
+    @classmethod
+    async def construct(
+        cls, *, config: VerifiedTokenCacheConfig, metrics: MetricsCollector
+    ) -> "VerifiedTokenCache":
+        """Constructor compatible with the hexkit.inject.AsyncConstructable type"""
+        return cls(
+            max_entries=config.token_cache_max_entries,
+            ttl_seconds=config.token_cache_ttl_seconds,
+            metrics=metrics,
+        )
+
+    def __init__(
+        self,
+        *,
+        max_entries: int,
+        ttl_seconds: float,
+        metrics: Optional[MetricsCollector] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._metrics = metrics
+        self._clock = clock
+        self._key = secrets.token_bytes(32)
+
+        # maps (sample_id, token digest) to (token hash, expiry time):
+        self._entries: OrderedDict[tuple[str, bytes], tuple[str, float]] = OrderedDict()
+
+        if metrics is not None:
+            metrics.register_gauge("token_cache_entries", lambda: len(self._entries))
+
+    def _cache_key(self, *, sample_id: str, token: str) -> tuple[str, bytes]:
+        """Combine the sample ID with the keyed HMAC of the token"""
+        digest = hmac.new(self._key, token.encode("utf-8"), hashlib.sha256).digest()
+        return sample_id, digest
+
+    def _count(self, name: str) -> None:
+        """Increment the named counter, if metrics are collected"""
+        if self._metrics is not None:
+            self._metrics.increment(name)
+
+    def is_verified(self, *, sample_id: str, token: str, token_hashed: str) -> bool:
+        """Returns True if the token was recently verified against the given hash"""
+        if not self._max_entries:
+            return False
+
+        key = self._cache_key(sample_id=sample_id, token=token)
+        entry = self._entries.get(key)
+
+        if entry is not None:
+            cached_hash, expires_at = entry
+            if cached_hash == token_hashed and expires_at > self._clock():
+                self._entries.move_to_end(key)
+                self._count("token_cache_hits")
+                return True
+            # the entry has expired or the stored hash has changed since:
+            del self._entries[key]
+
+        self._count("token_cache_misses")
+        return False
+
+    def add(self, *, sample_id: str, token: str, token_hashed: str) -> None:
+        """Remember that the token was successfully verified against the given hash"""
+        if not self._max_entries:
+            return
+
+        key = self._cache_key(sample_id=sample_id, token=token)
+        self._entries[key] = (token_hashed, self._clock() + self._ttl_seconds)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,167 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A pool of pre-generated access tokens and their hashes, so that creating a sample
+doesn't have to wait for the token to be hashed."""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager, suppress
+from typing import Optional
+
+from pydantic import BaseSettings, Field
+
+from cm.core.authorizer import (
+    ACCESS_TOKEN_LENGTH,
+    AuthorizerConfig,
+    AuthorizerInterface,
+)
+from cm.core.metrics import MetricsCollector
+
+REFILL_RATE_WINDOW_SECONDS = 60.0
+
+
+class TokenPoolConfig(BaseSettings):
+    """Config for the access token pool"""
+
+    token_pool_size: int = Field(
+        32,
+        ge=0,
+        description=(
+            "Number of ready (token, hash) pairs to keep for new samples. The pool is"
+            + " refilled in the background whenever the authorizer is idle. Set to 0"
+            + " to hash tokens on the request path instead. The pool is not used if"
+            + " the auth_executor is 'inline'."
+        ),
+        example=32,
+    )
+    token_pool_idle_poll_seconds: float = Field(
+        0.05,
+        gt=0,
+        description=(
+            "How long the refill task waits before checking again while the"
+            + " authorizer is busy with requests"
+        ),
+        example=0.05,
+    )
+
+
+class TokenPool:  # pylint: disable=too-many-instance-attributes
+    """Keeps a bounded pool of (token, hash) pairs that is refilled in the background.
+    When the pool is empty, new pairs are produced on demand."""
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls,
+        *,
+        config: TokenPoolConfig,
+        authorizer_config: AuthorizerConfig,
+        authorizer: AuthorizerInterface,
+        metrics: MetricsCollector,
+    ):
+        """Setup and teardown a TokenPool along with its refill task. The pool is
+        disabled if tokens are hashed inline, as refilling it would then block the
+        event loop."""
+        size = config.token_pool_size
+        if size and authorizer_config.auth_executor == "inline":
+            logging.warning(
+                "The token pool is disabled, as it requires a worker pool for hashing."
+            )
+            size = 0
+
+        token_pool = cls(
+            authorizer=authorizer,
+            size=size,
+            idle_poll_seconds=config.token_pool_idle_poll_seconds,
+            metrics=metrics,
+        )
+        token_pool.start()
+        try:
+            yield token_pool
+        finally:
+            await token_pool.stop()
+
+    def __init__(
+        self,
+        *,
+        authorizer: AuthorizerInterface,
+        size: int,
+        idle_poll_seconds: float = 0.05,
+        metrics: Optional[MetricsCollector] = None,
+    ):
+        self._authorizer = authorizer
+        self._size = size
+        self._idle_poll_seconds = idle_poll_seconds
+        self._metrics = metrics
+        self._pairs: deque[tuple[str, str]] = deque()
+        self._consumed = asyncio.Event()
+        self._refill_times: deque[float] = deque()
+        self._refill_task: Optional[asyncio.Task] = None
+
+        if metrics is not None:
+            metrics.register_gauge("token_pool_depth", lambda: len(self._pairs))
+            metrics.register_gauge("token_pool_refill_rate", self.refill_rate)
+
+    def start(self) -> None:
+        """Start refilling the pool in the background"""
+        if self._size and self._refill_task is None:
+            self._refill_task = asyncio.create_task(self._refill())
+
+    async def stop(self) -> None:
+        """Stop refilling the pool"""
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._refill_task
+            self._refill_task = None
+
+    def refill_rate(self) -> float:
+        """The number of pairs produced per second, averaged over the last minute"""
+        cutoff = time.monotonic() - REFILL_RATE_WINDOW_SECONDS
+        while self._refill_times and self._refill_times[0] < cutoff:
+            self._refill_times.popleft()
+        return len(self._refill_times) / REFILL_RATE_WINDOW_SECONDS
+
+    async def _new_pair(self) -> tuple[str, str]:
+        """Generate a token and hash it"""
+        token = self._authorizer.generate_token(length=ACCESS_TOKEN_LENGTH)
+        return token, await self._authorizer.hash_token(token=token)
+
+    async def _refill(self) -> None:
+        """Keep the pool full, only hashing while no other hashing work is queued"""
+        while True:
+            if len(self._pairs) >= self._size:
+                self._consumed.clear()
+                await self._consumed.wait()
+            elif self._authorizer.queue_depth():
+                await asyncio.sleep(self._idle_poll_seconds)
+            else:
+                self._pairs.append(await self._new_pair())
+                self._refill_times.append(time.monotonic())
+                if self._metrics is not None:
+                    self._metrics.increment("token_pool_refilled")
+
+    async def get_token_pair(self) -> tuple[str, str]:
+        """Returns a token and its hash, taken from the pool if possible"""
+        if self._pairs:
+            self._consumed.set()
+            return self._pairs.popleft()
+
+        if self._size and self._metrics is not None:
+            self._metrics.increment("token_pool_fallbacks")
+        return await self._new_pair()
@@ -14,12 +14,21 @@
 # limitations under the License.
 #
 """Top-level functionality for the microservice"""
+import asyncio
+from typing import Optional
+
 from fastapi import FastAPI
 from ghga_service_chassis_lib.api import configure_app, run_server
 
+from cm.adapters.inbound.dead_letters import DeadLetterReplayer, ReplayResult
 from cm.adapters.inbound.fastapi_.routes import sample_router
+from cm.adapters.outbound.akafka import EventPubTranslator
+from cm.adapters.outbound.change_stream import ChangeStreamRelay
+from cm.adapters.outbound.dao import SampleDaoFactory
+from cm.adapters.outbound.kafka_producer import KafkaEncodingEventPublisher
 from cm.config import Config
 from cm.container import Container
+from cm.core.metrics import MetricsCollector
 
 
 def get_configured_container(*, config: Config) -> Container:
@@ -44,6 +53,14 @@ def get_rest_api(*, config: Config) -> FastAPI:
     return api
 
 
+async def keep_sample_cache_coherent(*, container: Container) -> None:
+    """Evict samples from the cache as they are updated by any instance. Returns
+    right away if the cache is disabled."""
+    subscriber = await container.sample_cache_subscriber()
+    if subscriber is not None:
+        await subscriber.run(forever=True)
+
+
 async def run_rest():
     """Run the server"""
     config = Config()
@@ -51,7 +68,10 @@ async def run_rest():
     async with get_configured_container(config=config) as container:
         container.wire(modules=["cm.adapters.inbound.fastapi_.routes"])
         api = get_rest_api(config=config)
-        await run_server(app=api, config=config)
+        await asyncio.gather(
+            run_server(app=api, config=config),
+            keep_sample_cache_coherent(container=container),
+        )
 
 
 async def consume_events(run_forever: bool = True):
@@ -61,3 +81,47 @@ async def consume_events(run_forever: bool = True):
     async with get_configured_container(config=config) as container:
         event_consumer = await container.kafka_event_subscriber()
         await event_consumer.run(forever=run_forever)
+
+
+async def run_rest_and_consume_events():
+    """Run the server and consume events using a single container, so that both
+    share the same worker pools and report to the same metrics collector"""
+    config = Config()
+
+    async with get_configured_container(config=config) as container:
+        container.wire(modules=["cm.adapters.inbound.fastapi_.routes"])
+        api = get_rest_api(config=config)
+        event_consumer = await container.kafka_event_subscriber()
+        await asyncio.gather(
+            run_server(app=api, config=config),
+            event_consumer.run(forever=True),
+            keep_sample_cache_coherent(container=container),
+        )
+
+
+async def replay_dead_letters(*, max_events: Optional[int] = None) -> ReplayResult:
+    """Publish the events of the dead-letter topic back to their original topics
+    and return how many were replayed and how many were skipped as malformed"""
+    config = Config()
+
+    async with KafkaEncodingEventPublisher.construct(config=config) as publisher:
+        async with DeadLetterReplayer.construct(
+            config=config, dead_letter_config=config, provider=publisher
+        ) as replayer:
+            return await replayer.run(max_events=max_events)
+
+
+async def relay_sample_changes():
+    """Publish the updates of samples as they appear on the change stream of the
+    database. Only a single relay should run at a time. The relay is set up without
+    the container, which would also start the event consumers."""
+    config = Config()
+
+    async with KafkaEncodingEventPublisher.construct(config=config) as provider:
+        relay = await ChangeStreamRelay.construct(
+            config=config,
+            dao_factory=SampleDaoFactory(config=config),
+            publisher=EventPubTranslator(config=config, provider=provider),
+            metrics=MetricsCollector(),
+        )
+        await relay.run()
@@ -17,6 +17,8 @@
 """Port for a data repository, which, again, has very little to do with the
 repository design pattern."""
 from abc import ABC, abstractmethod
+from collections.abc import Collection, Mapping, Sequence
+from typing import Any
 
 from cm.core import models
 
@@ -38,6 +40,27 @@ class DataRepositoryPort(ABC):
             message = f"Unauthorized to access Sample ID {sample_id}"
             super().__init__(message)
 
+    class UpdateConflictError(RuntimeError):
+        """Raised when an update could not be applied because the sample kept being
+        modified concurrently"""
+
+        def __init__(self, *, sample_id: str):
+            message = f"Sample ID {sample_id} is being modified concurrently"
+            super().__init__(message)
+
+    class PublishingBacklogError(RuntimeError):
+        """Raised when an update was stored, but the event announcing it could not
+        be queued for publishing because too many events are waiting"""
+
+        def __init__(self):
+            super().__init__("Too many events are waiting to be published")
+
+    class SessionTokensDisabledError(RuntimeError):
+        """Raised when a session token is requested but session tokens are disabled"""
+
+        def __init__(self):
+            super().__init__("Session tokens are not enabled")
+
     @abstractmethod
     async def retrieve_sample(
         self, *, sample_id: str, access_token: str
@@ -48,6 +71,18 @@ class DataRepositoryPort(ABC):
             UnauthorizedRequestError: when access_token doesn't match what's expected"""
         ...
 
+    @abstractmethod
+    async def retrieve_sample_fields(
+        self, *, sample_id: str, access_token: str, fields: Collection[str]
+    ) -> dict[str, Any]:
+        """Retrieves only the specified fields of the sample with the specified
+        sample_id, along with the sample_id, as JSON-compatible values. Fields needed
+        for authorization are read as well, but are never returned.
+        Raises:
+            SampleNotFoundError: when unable to find a matching sample_id
+            UnauthorizedRequestError: when access_token doesn't match what's expected"""
+        ...
+
     @abstractmethod
     async def create_sample(
         self, *, sample_creation: models.SampleCreation
@@ -56,6 +91,17 @@ class DataRepositoryPort(ABC):
         object along with a randomly generated access token and sample ID"""
         ...
 
+    @abstractmethod
+    async def create_samples(
+        self, *, sample_creations: Sequence[Mapping[str, Any]]
+    ) -> list[models.SampleBatchCreationResult]:
+        """Validates each of the supplied items as a SampleCreation and creates the
+        valid ones like `create_sample` does, using a single bulk insert. Returns one
+        result per item, in the order they were supplied. Items that are invalid or
+        could not be inserted don't affect the other items, and the result of each
+        tells whether it was created."""
+        ...
+
     @abstractmethod
     async def update_sample(
         self,
@@ -65,8 +111,35 @@ class DataRepositoryPort(ABC):
         is_external: bool = True,
     ) -> None:
         """Takes the supplied SampleUpdate object, finds the matching sample,
-        and applies the updates
+        and applies the updates. The sample is written on the condition that it wasn't
+        modified since it was read, retrying otherwise.
         Raises:
             SampleNotFoundError: when unable to find a matching sample_id
-            UnauthorizedRequestError: when access_token doesn't match what's expected"""
+            UnauthorizedRequestError: when access_token doesn't match what's expected
+            UpdateConflictError: when the sample kept being modified concurrently"""
+        ...
+
+    @abstractmethod
+    async def create_session_token(
+        self, *, sample_id: str, access_token: str
+    ) -> models.SessionToken:
+        """Verifies the access token for the sample once and returns a short-lived
+        session token that can be used in place of the access token for that sample.
+        Raises:
+            SampleNotFoundError: when unable to find a matching sample_id
+            UnauthorizedRequestError: when access_token doesn't match what's expected
+            SessionTokensDisabledError: when session tokens are disabled"""
+        ...
+
+    @abstractmethod
+    async def update_samples(
+        self, *, updates: Sequence[Mapping[str, Any]], is_external: bool = True
+    ) -> list[models.SampleBatchUpdateResult]:
+        """Validates each of the supplied items as a SampleBatchUpdate and applies the
+        valid ones like `update_sample` does. All samples are fetched with a single
+        query and written with a single bulk operation, and the resulting events are
+        published as a batch. Returns one result per item, in the order they were
+        supplied. Items that are invalid, unauthorized, refer to non-existing samples,
+        or kept conflicting with concurrent modifications don't affect the other
+        items."""
         ...
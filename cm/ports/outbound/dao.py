@@ -15,6 +15,9 @@
 #
 # pylint: disable=unused-import
 """DAO port"""
+from collections.abc import AsyncIterator, Collection, Sequence
+from typing import Any, Optional, Protocol
+
 from hexkit.protocols.dao import (  # noqa: F401
     DaoNaturalId,
     ResourceAlreadyExistsError,
@@ -23,5 +26,121 @@ from hexkit.protocols.dao import (  # noqa: F401
 
 from cm.core import models
 
-# port described by a type alias:
-SampleDaoPort = DaoNaturalId[models.Sample]
+
+class VersionConflictError(RuntimeError):
+    """Raised when a conditional update finds that the stored sample was modified
+    since it was read"""
+
+    def __init__(self, *, id_: str):
+        message = f"The sample with ID {id_} was modified concurrently"
+        super().__init__(message)
+
+
+class BulkInsertError(RuntimeError):
+    """Raised when samples of a bulk insert failed for other reasons than an existing
+    sample with the same ID. As samples are inserted independently of each other,
+    the others may have been inserted nonetheless. All samples are referred to by
+    their position in the bulk insert."""
+
+    def __init__(
+        self, *, inserted: set[int], conflicts: set[int], failures: dict[int, str]
+    ):
+        self.inserted = inserted
+        self.conflicts = conflicts
+        self.failures = failures
+        message = (
+            f"Failed to insert {len(failures)} of"
+            + f" {len(inserted) + len(conflicts) + len(failures)} samples"
+        )
+        super().__init__(message)
+
+
+class SampleDaoPort(DaoNaturalId[models.Sample], Protocol):
+    """The generic DAO for Sample objects, extended by bulk operations"""
+
+    async def insert_many(self, dtos: Sequence[models.Sample]) -> set[int]:
+        """Insert multiple new samples with a single database operation. Samples are
+        inserted independently of each other, so a conflict only affects that sample.
+
+        Returns:
+            The positions of samples that were not inserted because a sample with
+            the same ID already exists.
+
+        Raises:
+            BulkInsertError: when samples failed to be inserted for other reasons,
+                telling which samples were inserted and which were not.
+        """
+        ...
+
+    async def get_many(self, ids: Collection[str]) -> dict[str, models.Sample]:
+        """Get multiple samples with a single database query.
+
+        Returns:
+            The samples that were found, by their ID. IDs without a matching sample
+            are missing from the result.
+        """
+        ...
+
+    async def get_fields(self, id_: str, fields: Collection[str]) -> dict[str, Any]:
+        """Get only the specified fields of a sample, reading no more than those from
+        the database. The values are JSON-compatible, and the sample_id is always
+        included.
+
+        Raises:
+            ResourceNotFoundError: when no sample with the specified ID exists.
+        """
+        ...
+
+    async def update_versioned(self, dto: models.Sample) -> models.Sample:
+        """Replace an existing sample on the condition that its stored version still
+        matches the version of the DTO. The version is incremented on write.
+
+        Returns:
+            The sample as it was stored.
+
+        Raises:
+            ResourceNotFoundError: when no sample with the specified ID exists.
+            VersionConflictError: when the stored sample has a different version.
+        """
+        ...
+
+    async def update_token_hash(
+        self, *, id_: str, access_token_hash: str, previous_hash: str
+    ) -> bool:
+        """Set only the access token hash of a sample, on the condition that its
+        stored hash is still the previous one. This is not an update of the sample:
+        its version is kept and no update is recorded for publishing.
+
+        Returns:
+            Whether the hash was written.
+        """
+        ...
+
+    async def update_many(self, dtos: Sequence[models.Sample]) -> set[int]:
+        """Replace multiple existing samples with a single database operation, each on
+        the condition that its version is unchanged, like `update_versioned` does.
+
+        Returns:
+            The positions of samples that were not written because they were modified
+            concurrently or don't exist anymore.
+        """
+        ...
+
+    async def update_test_data(
+        self, updates: models.SampleUpdate
+    ) -> Optional[models.Sample]:
+        """Atomically set the status, test_result, and test_date of an existing
+        sample with a single database operation, incrementing its version. Nothing
+        is written if the sample already has these values.
+
+        Returns:
+            The sample as it is after the update, or None if it was unchanged.
+
+        Raises:
+            ResourceNotFoundError: when no sample with the specified ID exists.
+        """
+        ...
+
+    def iter_ids(self) -> AsyncIterator[str]:
+        """Stream the IDs of all samples, without loading the samples themselves"""
+        ...
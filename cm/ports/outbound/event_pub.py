@@ -17,11 +17,20 @@
 Contains definition for the outbound port for event publishing
 """
 
+from collections.abc import Sequence
 from typing import Protocol
 
 from cm.core import models
 
 
+class EventBufferFullError(RuntimeError):
+    """Raised when an event can't be queued for publishing because the buffer is
+    full"""
+
+    def __init__(self):
+        super().__init__("The buffer of events to publish is full")
+
+
 class EventPublisherPort(Protocol):
     """An interface for an adapter that publishes events related to this service"""
 
@@ -30,3 +39,9 @@ class EventPublisherPort(Protocol):
     ) -> None:
         """Publish an event with the updated Sample info"""
         ...
+
+    async def publish_samples_updated(
+        self, *, samples_no_auth: Sequence[models.SampleNoAuth]
+    ) -> None:
+        """Publish one event per updated Sample, as a batch"""
+        ...
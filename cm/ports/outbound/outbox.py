@@ -0,0 +1,35 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Port for the outbox of sample updates that are still to be published"""
+
+from collections.abc import Sequence
+from typing import Protocol
+
+from cm.core import models
+
+
+class SampleOutboxPort(Protocol):
+    """Gives access to samples whose update is still to be published"""
+
+    async def find_event_pending(self, *, limit: int) -> list[models.Sample]:
+        """Get up to the given number of samples whose update is still to be
+        published"""
+        ...
+
+    async def clear_event_pending(self, samples: Sequence[models.Sample]) -> None:
+        """Mark the updates of the given samples as published, unless the samples
+        were updated again since they were read"""
+        ...
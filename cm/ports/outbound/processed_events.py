@@ -0,0 +1,33 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Port for remembering which events were already processed"""
+
+from collections.abc import Collection, Mapping
+from typing import Protocol
+
+
+class ProcessedEventStorePort(Protocol):
+    """Persists the fingerprints of processed events by their identifying key"""
+
+    async def get_many(self, keys: Collection[str]) -> dict[str, str]:
+        """Get the fingerprints stored for the given keys with a single query. Keys
+        without a stored fingerprint are missing from the result."""
+        ...
+
+    async def put_many(self, fingerprints: Mapping[str, str]) -> None:
+        """Store the fingerprints by their keys with a single operation, replacing
+        any fingerprints previously stored for the same keys"""
+        ...
@@ -0,0 +1,87 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks the latency of concurrent GET /samples/{sample_id} requests with token
+verification running inline on the event loop vs. on a worker pool."""
+
+import asyncio
+import time
+
+import httpx
+import typer
+
+from cm.core import models
+from cm.core.authorizer import Authorizer, AuthorizerConfig
+from cm.core.metrics import MetricsCollector
+from tests.benchmarks.utils import report, rest_client, timed
+from tests.fixtures.data_repository import VALID_SAMPLE, make_data_repository
+
+
+async def get_sample(
+    client: httpx.AsyncClient, sample: models.SampleAuthDetails
+) -> float:
+    """Returns the latency of retrieving the sample with its access token"""
+    headers = {"Authorization": f"Bearer {sample.access_token}"}
+    return await timed(
+        lambda: client.get(f"/samples/{sample.sample_id}", headers=headers)
+    )
+
+
+async def benchmark_mode(
+    *, auth_executor: str, workers: int, concurrency: int, rounds: int
+) -> None:
+    """Run the GET load against a service using the given authorizer mode"""
+    metrics = MetricsCollector()
+    config = AuthorizerConfig(auth_executor=auth_executor, auth_max_workers=workers)
+    async with Authorizer.construct(config=config, metrics=metrics) as authorizer:
+        data_repository = make_data_repository(authorizer=authorizer)
+        # one sample per concurrent request, since identical concurrent
+        # verifications would be coalesced instead of running on the executor:
+        samples = [
+            await data_repository.create_sample(
+                sample_creation=models.SampleCreation(**VALID_SAMPLE)
+            )
+            for _ in range(concurrency)
+        ]
+
+        async with rest_client(
+            data_repository=data_repository, metrics=metrics
+        ) as client:
+            latencies: list[float] = []
+            start = time.perf_counter()
+            for _ in range(rounds):
+                latencies += await asyncio.gather(
+                    *(get_sample(client, sample) for sample in samples)
+                )
+            total_seconds = time.perf_counter() - start
+
+    report(f"{auth_executor} (workers={workers})", latencies, total_seconds)
+
+
+def main(concurrency: int = 16, rounds: int = 3, workers: int = 4):
+    """Compare GET latencies for all authorizer modes"""
+    for auth_executor in ["inline", "thread", "process"]:
+        asyncio.run(
+            benchmark_mode(
+                auth_executor=auth_executor,
+                workers=workers,
+                concurrency=concurrency,
+                rounds=rounds,
+            )
+        )
+
+
+if __name__ == "__main__":
+    typer.run(main)
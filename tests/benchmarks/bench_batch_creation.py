@@ -0,0 +1,67 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks creating N samples with N single POST requests vs. one batch request"""
+
+import asyncio
+import time
+
+import typer
+
+from cm.core.authorizer import Authorizer, AuthorizerConfig
+from cm.core.metrics import MetricsCollector
+from tests.benchmarks.utils import report, rest_client, timed
+from tests.fixtures.dao import InMemSampleDao
+from tests.fixtures.data_repository import VALID_SAMPLE, make_data_repository
+
+
+async def benchmark(*, samples: int, db_latency_ms: float, bcrypt_rounds: int):
+    """Create the samples both ways and report the results"""
+    metrics = MetricsCollector()
+    config = AuthorizerConfig(bcrypt_rounds=bcrypt_rounds)
+    async with Authorizer.construct(config=config, metrics=metrics) as authorizer:
+        data_repository = make_data_repository(
+            authorizer=authorizer,
+            sample_dao=InMemSampleDao(latency=db_latency_ms / 1000),
+        )
+        async with rest_client(
+            data_repository=data_repository, metrics=metrics
+        ) as client:
+            start = time.perf_counter()
+            latencies = [
+                await timed(lambda: client.post("/samples", json=VALID_SAMPLE))
+                for _ in range(samples)
+            ]
+            report("single POSTs", latencies, time.perf_counter() - start)
+
+            batch = [VALID_SAMPLE] * samples
+            latency = await timed(lambda: client.post("/samples:batch", json=batch))
+            typer.echo(
+                f"{'one batch POST':<32} total={latency * 1000:8.2f}ms"
+                + f" throughput={samples / latency:9.1f}/s"
+            )
+
+
+def main(samples: int = 100, db_latency_ms: float = 1.0, bcrypt_rounds: int = 4):
+    """Compare single and batch sample creation"""
+    asyncio.run(
+        benchmark(
+            samples=samples, db_latency_ms=db_latency_ms, bcrypt_rounds=bcrypt_rounds
+        )
+    )
+
+
+if __name__ == "__main__":
+    typer.run(main)
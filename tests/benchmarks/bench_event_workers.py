@@ -0,0 +1,85 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks the consumption of sample update events with a growing number of
+concurrent workers"""
+
+import asyncio
+import time
+
+import typer
+
+from cm.adapters.inbound.akafka import EventSubTranslator
+from cm.adapters.inbound.kafka_consumer import KafkaConcurrentEventSubscriber
+from cm.core import models
+from tests.fixtures.config import DEFAULT_CONFIG
+from tests.fixtures.dao import InMemSampleDao
+from tests.fixtures.data_repository import VALID_SAMPLE, make_data_repository
+from tests.fixtures.kafka import FakeConsumer, make_update_record
+
+
+async def consume(
+    *, workers: int, events: int, samples: int, db_latency_ms: float, connections: int
+) -> float:
+    """Returns the number of events consumed per second"""
+    sample_dao = InMemSampleDao(latency=db_latency_ms / 1000, connections=connections)
+    await sample_dao.insert_many(
+        [
+            models.Sample(**VALID_SAMPLE, sample_id=f"s{number}", access_token_hash="h")
+            for number in range(samples)
+        ]
+    )
+    records = [
+        make_update_record(offset, f"s{offset % samples}", "positive")
+        for offset in range(events)
+    ]
+    subscriber = KafkaConcurrentEventSubscriber(
+        consumer=FakeConsumer(records, poll_size=events),
+        translator=EventSubTranslator(
+            config=DEFAULT_CONFIG,
+            data_repository=make_data_repository(sample_dao=sample_dao),
+        ),
+        workers=workers,
+        queue_size=100,
+    )
+
+    start = time.perf_counter()
+    await subscriber.run(forever=False)
+    return events / (time.perf_counter() - start)
+
+
+def main(
+    events: int = 2000,
+    samples: int = 500,
+    db_latency_ms: float = 1.0,
+    connections: int = 16,
+):
+    """Report the consumer throughput for 1 to 32 workers. The connection limit
+    emulates the point where the database becomes the bottleneck."""
+    for workers in (1, 2, 4, 8, 16, 32):
+        throughput = asyncio.run(
+            consume(
+                workers=workers,
+                events=events,
+                samples=samples,
+                db_latency_ms=db_latency_ms,
+                connections=connections,
+            )
+        )
+        typer.echo(f"{workers:>3} workers  throughput={throughput:9.1f} events/s")
+
+
+if __name__ == "__main__":
+    typer.run(main)
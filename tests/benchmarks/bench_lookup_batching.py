@@ -0,0 +1,121 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks concurrent lookups of samples with and without batching them into
+$in queries"""
+
+import asyncio
+import random
+import time
+from functools import partial
+
+import typer
+
+from cm.adapters.outbound.dao import BatchingSampleDao
+from cm.core import models
+from cm.core.metrics import MetricsCollector
+from cm.ports.outbound.dao import SampleDaoPort
+from tests.benchmarks.utils import report, timed
+from tests.fixtures.dao import InMemSampleDao
+from tests.fixtures.data_repository import VALID_SAMPLE
+
+
+async def make_sample_dao(
+    *, samples: int, db_latency_ms: float, connections: int
+) -> InMemSampleDao:
+    """Returns an in-memory DAO holding the given number of samples"""
+    sample_dao = InMemSampleDao(latency=db_latency_ms / 1000, connections=connections)
+    await sample_dao.insert_many(
+        [
+            models.Sample(**VALID_SAMPLE, sample_id=str(number), access_token_hash="h")
+            for number in range(samples)
+        ]
+    )
+    sample_dao.round_trips = 0
+    return sample_dao
+
+
+async def run_lookups(
+    label: str, *, sample_dao: SampleDaoPort, samples: int, lookups: int
+) -> None:
+    """Look up random samples all at once and report the results"""
+    ids = [str(random.randrange(samples)) for _ in range(lookups)]  # nosec
+    start = time.perf_counter()
+    latencies = await asyncio.gather(
+        *(timed(partial(sample_dao.get_by_id, id_)) for id_ in ids)
+    )
+    report(label, latencies, time.perf_counter() - start)
+
+
+async def benchmark(  # pylint: disable=too-many-arguments
+    *,
+    samples: int,
+    lookups: int,
+    db_latency_ms: float,
+    connections: int,
+    window_ms: float,
+    max_batch_size: int,
+):
+    """Run the lookups against the plain and the batching DAO"""
+    plain_dao = await make_sample_dao(
+        samples=samples, db_latency_ms=db_latency_ms, connections=connections
+    )
+    await run_lookups(
+        "plain DAO", sample_dao=plain_dao, samples=samples, lookups=lookups
+    )
+    typer.echo(f"{'':<32} round trips={plain_dao.round_trips}")
+
+    metrics = MetricsCollector()
+    batched_dao = await make_sample_dao(
+        samples=samples, db_latency_ms=db_latency_ms, connections=connections
+    )
+    batching_dao = BatchingSampleDao(
+        sample_dao=batched_dao,
+        window_seconds=window_ms / 1000,
+        max_batch_size=max_batch_size,
+        metrics=metrics,
+    )
+    await run_lookups(
+        f"batching DAO ({window_ms}ms window)",
+        sample_dao=batching_dao,
+        samples=samples,
+        lookups=lookups,
+    )
+    typer.echo(f"{'':<32} round trips={batched_dao.round_trips}")
+
+
+def main(  # pylint: disable=too-many-arguments
+    samples: int = 10000,
+    lookups: int = 2000,
+    db_latency_ms: float = 1.0,
+    connections: int = 100,
+    window_ms: float = 1.0,
+    max_batch_size: int = 100,
+):
+    """Compare concurrent lookups with and without batching"""
+    asyncio.run(
+        benchmark(
+            samples=samples,
+            lookups=lookups,
+            db_latency_ms=db_latency_ms,
+            connections=connections,
+            window_ms=window_ms,
+            max_batch_size=max_batch_size,
+        )
+    )
+
+
+if __name__ == "__main__":
+    typer.run(main)
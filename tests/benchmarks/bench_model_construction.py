@@ -0,0 +1,88 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Microbenchmark of the CPU time spent on the models of a sample creation and of a
+sample update, comparing re-validation with the construction of trusted models"""
+
+import typer
+
+from cm.core import models
+from cm.core.data_repository import apply_test_data
+from tests.benchmarks.utils import measure
+from tests.fixtures.data_repository import VALID_SAMPLE
+
+UPDATE = models.SampleUpdate(
+    sample_id="sample",
+    status="completed",
+    test_result="negative",
+    test_date="2023-01-16T08:30:15+01:00",
+)
+
+
+def create_revalidated(creation: models.SampleCreation) -> models.SampleAuthDetails:
+    """The models of a creation, re-validated at every step"""
+    sample = models.Sample(
+        **creation.dict(), sample_id="sample", access_token_hash="hash"
+    )
+    return models.SampleAuthDetails(**sample.dict(), access_token="token")
+
+
+def create_trusted(creation: models.SampleCreation) -> models.SampleAuthDetails:
+    """The models of a creation, constructed from validated data"""
+    sample = models.from_validated(
+        models.Sample, creation, sample_id="sample", access_token_hash="hash"
+    )
+    return models.from_validated(models.SampleAuthDetails, sample, access_token="token")
+
+
+def update_revalidated(sample: models.Sample) -> models.SampleNoAuth:
+    """The models of an update, re-validated on assignment and for the event"""
+    sample = sample.copy()
+    sample.status = UPDATE.status
+    sample.test_result = UPDATE.test_result
+    sample.test_date = UPDATE.test_date
+    return models.SampleNoAuth(**sample.dict())
+
+
+def update_trusted(sample: models.Sample) -> models.SampleNoAuth:
+    """The models of an update, without validating data again"""
+    sample = sample.copy()
+    apply_test_data(sample, UPDATE)
+    return models.from_validated(models.SampleNoAuth, sample)
+
+
+def compare(path: str, revalidated, trusted, model, *, iterations: int) -> None:
+    """Measure both ways of handling the models and print the time saved"""
+    assert revalidated(model) == trusted(model)  # nosec
+    slow = measure(
+        f"{path} (re-validated)", lambda: revalidated(model), iterations=iterations
+    )
+    fast = measure(f"{path} (trusted)", lambda: trusted(model), iterations=iterations)
+    typer.echo(f"{'':<40} saved={slow - fast:.2f}us/request")
+
+
+def main(iterations: int = 20000):
+    """Compare the CPU time per request spent on models"""
+    creation = models.SampleCreation(**VALID_SAMPLE)
+    sample = models.Sample(**VALID_SAMPLE, sample_id="sample", access_token_hash="h")
+
+    compare(
+        "create", create_revalidated, create_trusted, creation, iterations=iterations
+    )
+    compare("update", update_revalidated, update_trusted, sample, iterations=iterations)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,79 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of the memory taken by cached samples, comparing pydantic models, their
+JSON serialization and the compact records, and of the time to restore a Sample"""
+
+import tracemalloc
+from typing import Any, Callable
+
+import typer
+
+from cm.adapters.serialization import dumps, loads
+from cm.core import models
+from cm.core.sample_record import SampleRecord
+from tests.benchmarks.utils import measure
+from tests.fixtures.data_repository import VALID_SAMPLE
+
+
+def make_samples(count: int) -> list[models.Sample]:
+    """Returns samples with distinct IDs, token hashes and test dates"""
+    return [
+        models.Sample(
+            **VALID_SAMPLE,
+            sample_id=f"{index:010d}",
+            access_token_hash=f"{index:064x}",
+            status="completed",
+            test_result="negative",
+            test_date=f"2023-01-16T08:30:{index % 60:02d}.{index % 1000:03d}Z",
+            version=index % 1000,
+        )
+        for index in range(count)
+    ]
+
+
+def bytes_per_sample(
+    label: str, documents: list[bytes], convert: Callable[[bytes], Any]
+) -> Any:
+    """Print the memory allocated per sample when holding all samples converted from
+    their serialized documents, as the cache does after reading from the database"""
+    tracemalloc.start()
+    held = [convert(document) for document in documents]
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    typer.echo(f"{label:<40} {allocated / len(documents):8.0f}B/sample")
+    return held[0]
+
+
+def main(count: int = 100000, iterations: int = 20000):
+    """Compare the memory per cached sample and the time to get a Sample back"""
+    documents = [dumps(sample) for sample in make_samples(count)]
+
+    def parse(document: bytes) -> models.Sample:
+        return models.Sample(**loads(document))
+
+    bytes_per_sample("pydantic Sample", documents, parse)
+    data = bytes_per_sample("serialized (orjson)", documents, lambda d: d[:-1] + b"}")
+    record = bytes_per_sample(
+        "SampleRecord", documents, lambda d: SampleRecord.from_sample(parse(d))
+    )
+    typer.echo(f"{'':<40} estimated={record.nbytes}B/sample")
+
+    measure("restore from JSON", lambda: parse(data), iterations=iterations)
+    measure("restore from record", record.to_sample, iterations=iterations)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,82 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Microbenchmarks of serializing samples for events, database documents and HTTP
+responses, comparing pydantic and FastAPI's own paths with the orjson-based ones"""
+
+import json
+from typing import Any, Callable
+
+import typer
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from cm.adapters.serialization import FastJSONResponse, to_jsonable
+from cm.core import models
+from tests.benchmarks.utils import measure
+from tests.fixtures.data_repository import VALID_SAMPLE
+
+
+def compare(
+    path: str, slow: Callable[[], Any], fast: Callable[[], Any], *, iterations: int
+) -> None:
+    """Measure both ways of serializing and print the speedup"""
+    assert slow() == fast()  # nosec
+    slow_micros = measure(f"{path} (pydantic)", slow, iterations=iterations)
+    fast_micros = measure(f"{path} (orjson)", fast, iterations=iterations)
+    typer.echo(f"{'':<40} speedup={slow_micros / fast_micros:.1f}x")
+
+
+def main(iterations: int = 20000, batch_size: int = 100):
+    """Compare the serialization paths"""
+    sample = models.Sample(
+        **VALID_SAMPLE, sample_id="sample", access_token_hash="h", version=3
+    )
+    sample_no_auth = models.SampleNoAuth(**sample.dict())
+    results = [
+        models.SampleBatchUpdateResult(
+            index=index, sample_id=str(index), status=models.BatchItemStatus.UPDATED
+        )
+        for index in range(batch_size)
+    ]
+
+    compare(
+        "event payload",
+        lambda: json.loads(sample_no_auth.json()),
+        lambda: to_jsonable(sample_no_auth),
+        iterations=iterations,
+    )
+    compare(
+        "DAO document",
+        lambda: json.loads(sample.json()),
+        lambda: to_jsonable(sample),
+        iterations=iterations,
+    )
+    compare(
+        "HTTP response (sample)",
+        lambda: JSONResponse(jsonable_encoder(sample)).body,
+        lambda: FastJSONResponse(sample).body,
+        iterations=iterations,
+    )
+    compare(
+        f"HTTP response ({batch_size} results)",
+        lambda: JSONResponse(jsonable_encoder(results)).body,
+        lambda: FastJSONResponse(results).body,
+        iterations=max(iterations // batch_size, 1),
+    )
+
+
+if __name__ == "__main__":
+    typer.run(main)
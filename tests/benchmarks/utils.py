@@ -0,0 +1,88 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Utilities shared by the benchmarks"""
+# pylint: disable=c-extension-no-member
+
+import statistics
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable
+from contextlib import asynccontextmanager
+
+import httpx
+import typer
+from dependency_injector import providers
+
+from cm.config import Config
+from cm.core.data_repository import DataRepository
+from cm.core.metrics import MetricsCollector
+from cm.main import get_configured_container, get_rest_api
+from tests.fixtures.config import DEFAULT_CONFIG
+
+
+@asynccontextmanager
+async def rest_client(
+    *,
+    data_repository: DataRepository,
+    metrics: MetricsCollector,
+    config: Config = DEFAULT_CONFIG,
+) -> AsyncIterator[httpx.AsyncClient]:
+    """Yields a client for the REST API, which is wired to the given components
+    instead of the ones that would connect to MongoDB and Kafka"""
+    container = get_configured_container(config=config)
+    container.data_repository.override(providers.Object(data_repository))
+    container.metrics.override(providers.Object(metrics))
+    container.wire(modules=["cm.adapters.inbound.fastapi_.routes"])
+    api = get_rest_api(config=config)
+    try:
+        async with httpx.AsyncClient(app=api, base_url="http://localhost") as client:
+            yield client
+    finally:
+        container.unwire()
+
+
+def measure(label: str, func: Callable[[], object], *, iterations: int) -> float:
+    """Run func the given number of times, print and return microseconds per call"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    micros = (time.perf_counter() - start) / iterations * 1e6
+    typer.echo(f"{label:<40} {micros:8.2f}us/op")
+    return micros
+
+
+async def timed(func: Callable[[], Awaitable[object]]) -> float:
+    """Returns the time in seconds it took to await the result of func"""
+    start = time.perf_counter()
+    await func()
+    return time.perf_counter() - start
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """Returns the given percentile of the values (nearest-rank method)"""
+    ordered = sorted(values)
+    rank = max(int(round(percent / 100 * len(ordered))) - 1, 0)
+    return ordered[rank]
+
+
+def report(label: str, latencies: list[float], total_seconds: float) -> None:
+    """Print latency percentiles (in milliseconds) and throughput"""
+    typer.echo(
+        f"{label:<32}"
+        + f" p50={percentile(latencies, 50) * 1000:8.2f}ms"
+        + f" p99={percentile(latencies, 99) * 1000:8.2f}ms"
+        + f" mean={statistics.mean(latencies) * 1000:8.2f}ms"
+        + f" throughput={len(latencies) / total_seconds:9.1f}/s"
+    )
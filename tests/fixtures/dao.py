@@ -0,0 +1,236 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An in-memory stand-in for the Sample DAO, for use in unit tests and benchmarks"""
+
+import asyncio
+import json
+from collections.abc import AsyncIterator, Collection, Mapping, Sequence
+from typing import Any, Optional
+
+from hexkit.protocols.dao import (
+    MultipleHitsFoundError,
+    NoHitsFoundError,
+    ResourceAlreadyExistsError,
+    ResourceNotFoundError,
+)
+
+from cm.adapters.outbound.dao import EVENT_PENDING_FIELD
+from cm.core import models
+from cm.ports.outbound.dao import VersionConflictError
+
+
+class InMemSampleDao:  # pylint: disable=too-many-instance-attributes
+    """Stores Sample objects as serialized documents, like the MongoDB-based DAO does.
+    An artificial latency can be set to emulate database round trips, which are
+    counted in `round_trips`. The number of concurrent round trips can be limited to
+    emulate a connection pool. If record_events is set, updates are recorded in the
+    outbox like the MongoDbOutboxSampleDao does."""
+
+    def __init__(
+        self,
+        *,
+        latency: float = 0.0,
+        connections: Optional[int] = None,
+        record_events: bool = False,
+    ):
+        self.documents: dict[str, dict[str, Any]] = {}
+        self.record_events = record_events
+        self.latency = latency
+        self.round_trips = 0
+        self._connections = (
+            asyncio.Semaphore(connections) if connections is not None else None
+        )
+
+    async def _round_trip(self) -> None:
+        """Emulate a database round trip"""
+        self.round_trips += 1
+        if self._connections is None:
+            await asyncio.sleep(self.latency)
+            return
+        async with self._connections:
+            await asyncio.sleep(self.latency)
+
+    async def get_by_id(self, id_: str) -> models.Sample:
+        """Get a sample by its ID"""
+        await self._round_trip()
+        try:
+            return models.Sample(**self.documents[id_])
+        except KeyError as err:
+            raise ResourceNotFoundError(id_=id_) from err
+
+    async def get_fields(self, id_: str, fields: Collection[str]) -> dict[str, Any]:
+        """Get the specified fields of a sample"""
+        await self._round_trip()
+        try:
+            document = self.documents[id_]
+        except KeyError as err:
+            raise ResourceNotFoundError(id_=id_) from err
+        return {
+            field: value
+            for field, value in document.items()
+            if field in fields or field == "sample_id"
+        }
+
+    async def insert(self, dto: models.Sample) -> None:
+        """Insert a new sample"""
+        await self._round_trip()
+        if dto.sample_id in self.documents:
+            raise ResourceAlreadyExistsError(id_=dto.sample_id)
+        self.documents[dto.sample_id] = json.loads(dto.json())
+
+    async def insert_many(self, dtos: Sequence[models.Sample]) -> set[int]:
+        """Insert multiple new samples, returning the positions of conflicting ones"""
+        await self._round_trip()
+        conflicts = set()
+        for position, dto in enumerate(dtos):
+            if dto.sample_id in self.documents:
+                conflicts.add(position)
+            else:
+                self.documents[dto.sample_id] = json.loads(dto.json())
+        return conflicts
+
+    async def update(self, dto: models.Sample) -> None:
+        """Replace an existing sample"""
+        await self._round_trip()
+        if dto.sample_id not in self.documents:
+            raise ResourceNotFoundError(id_=dto.sample_id)
+        self.documents[dto.sample_id] = json.loads(dto.json())
+
+    def _write_versioned(self, dto: models.Sample) -> models.Sample:
+        """Replace the sample if its stored version is unchanged, see
+        `update_versioned`"""
+        try:
+            stored = self.documents[dto.sample_id]
+        except KeyError as err:
+            raise ResourceNotFoundError(id_=dto.sample_id) from err
+        if stored.get("version", 0) != dto.version:
+            raise VersionConflictError(id_=dto.sample_id)
+        written = dto.copy(update={"version": dto.version + 1})
+        self.documents[dto.sample_id] = json.loads(written.json())
+        if self.record_events:
+            self.documents[dto.sample_id][EVENT_PENDING_FIELD] = True
+        return written
+
+    async def update_versioned(self, dto: models.Sample) -> models.Sample:
+        """Replace the sample if its stored version is unchanged"""
+        await self._round_trip()
+        return self._write_versioned(dto)
+
+    async def update_token_hash(
+        self, *, id_: str, access_token_hash: str, previous_hash: str
+    ) -> bool:
+        """Set only the access token hash, if the stored one is the previous hash"""
+        await self._round_trip()
+        document = self.documents.get(id_)
+        if document is None or document["access_token_hash"] != previous_hash:
+            return False
+        document["access_token_hash"] = access_token_hash
+        return True
+
+    async def update_test_data(
+        self, updates: models.SampleUpdate
+    ) -> Optional[models.Sample]:
+        """Set the test data fields of an existing sample in a single round trip,
+        unless they already have the given values"""
+        await self._round_trip()
+        try:
+            document = self.documents[updates.sample_id]
+        except KeyError as err:
+            raise ResourceNotFoundError(id_=updates.sample_id) from err
+        fields = json.loads(
+            updates.json(include={"status", "test_result", "test_date"})
+        )
+        if all(document.get(field) == value for field, value in fields.items()):
+            return None
+        document.update(fields)
+        document["version"] = document.get("version", 0) + 1
+        if self.record_events:
+            document[EVENT_PENDING_FIELD] = True
+        return models.Sample(**document)
+
+    async def get_many(self, ids: Collection[str]) -> dict[str, models.Sample]:
+        """Get all samples with the given IDs that exist"""
+        await self._round_trip()
+        return {
+            id_: models.Sample(**self.documents[id_])
+            for id_ in ids
+            if id_ in self.documents
+        }
+
+    async def update_many(self, dtos: Sequence[models.Sample]) -> set[int]:
+        """Replace multiple samples if their versions are unchanged, returning the
+        positions of the ones that were not written"""
+        await self._round_trip()
+        conflicts = set()
+        for position, dto in enumerate(dtos):
+            try:
+                self._write_versioned(dto)
+            except (ResourceNotFoundError, VersionConflictError):
+                conflicts.add(position)
+        return conflicts
+
+    async def find_event_pending(self, *, limit: int) -> list[models.Sample]:
+        """Get samples whose update is still to be published"""
+        await self._round_trip()
+        pending = [
+            models.Sample(**document)
+            for document in self.documents.values()
+            if document.get(EVENT_PENDING_FIELD)
+        ]
+        return pending[:limit]
+
+    async def clear_event_pending(self, samples: Sequence[models.Sample]) -> None:
+        """Mark the updates as published unless the samples were updated again"""
+        await self._round_trip()
+        for sample in samples:
+            document = self.documents.get(sample.sample_id)
+            if document is not None and document.get("version", 0) == sample.version:
+                document.pop(EVENT_PENDING_FIELD, None)
+
+    async def iter_ids(self) -> AsyncIterator[str]:
+        """Stream the IDs of all samples"""
+        await self._round_trip()
+        for id_ in list(self.documents):
+            yield id_
+
+    async def upsert(self, dto: models.Sample) -> None:
+        """Insert or replace a sample"""
+        await self._round_trip()
+        self.documents[dto.sample_id] = json.loads(dto.json())
+
+    async def delete(self, *, id_: str) -> None:
+        """Delete a sample"""
+        await self._round_trip()
+        if self.documents.pop(id_, None) is None:
+            raise ResourceNotFoundError(id_=id_)
+
+    async def find_one(self, *, mapping: Mapping[str, Any]) -> models.Sample:
+        """Find the only sample matching the mapping"""
+        hits = [hit async for hit in self.find_all(mapping=mapping)]
+        if not hits:
+            raise NoHitsFoundError(mapping=mapping)
+        if len(hits) > 1:
+            raise MultipleHitsFoundError(mapping=mapping)
+        return hits[0]
+
+    async def find_all(
+        self, *, mapping: Mapping[str, Any]
+    ) -> AsyncIterator[models.Sample]:
+        """Find all samples matching the mapping"""
+        await self._round_trip()
+        for document in list(self.documents.values()):
+            if all(document.get(key) == value for key, value in mapping.items()):
+                yield models.Sample(**document)
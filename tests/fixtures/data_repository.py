@@ -0,0 +1,50 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Builds a DataRepository on top of in-memory stand-ins for MongoDB and Kafka"""
+
+from typing import Any, Optional
+
+from hexkit.providers.testing.eventpub import InMemEventPublisher
+
+from cm.adapters.outbound.akafka import EventPubTranslator
+from cm.core.authorizer import Authorizer, AuthorizerInterface
+from cm.core.data_repository import DataRepository
+from tests.fixtures.config import DEFAULT_CONFIG
+from tests.fixtures.dao import InMemSampleDao
+
+VALID_SAMPLE = {
+    "patient_pseudonym": "Jonathan K.",
+    "submitter_email": "test@test.com",
+    "collection_date": "2023-01-15T11:18+02:00",
+}
+
+
+def make_data_repository(
+    *,
+    authorizer: Optional[AuthorizerInterface] = None,
+    sample_dao: Optional[InMemSampleDao] = None,
+    event_publisher: Optional[InMemEventPublisher] = None,
+    **kwargs: Any,
+) -> DataRepository:
+    """Any further keyword arguments are passed on to the DataRepository"""
+    return DataRepository(
+        sample_dao=sample_dao or InMemSampleDao(),
+        authorizer=authorizer or Authorizer(),
+        event_publisher=EventPubTranslator(
+            config=DEFAULT_CONFIG, provider=event_publisher or InMemEventPublisher()
+        ),
+        **kwargs,
+    )
@@ -0,0 +1,107 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-memory stand-ins for records and consumers of the aiokafka library"""
+
+import asyncio
+from typing import Any, NamedTuple, Optional
+
+from aiokafka import TopicPartition
+
+from tests.fixtures.config import DEFAULT_CONFIG
+
+
+class FakeRecord(NamedTuple):
+    """A record as returned by the AIOKafkaConsumer"""
+
+    topic: str
+    partition: int
+    offset: int
+    key: str
+    # decoded, unless the consumer has no value deserializer:
+    value: Any
+    headers: list[tuple[str, bytes]]
+
+
+class FakeConsumer:
+    """Returns the queued records in polls of the given size and records the
+    committed position. All partitions of the update topic are assigned, unless
+    the assignment is changed."""
+
+    def __init__(self, records: list[FakeRecord], *, poll_size: int = 2):
+        self.records = records
+        self.poll_size = poll_size
+        self.position = 0
+        self.committed = 0
+        self.commits: list[dict[TopicPartition, int]] = []
+        self.assigned: Optional[set[TopicPartition]] = None
+
+    async def getmany(
+        self, *, timeout_ms: int, max_records: Optional[int] = None
+    ) -> dict[TopicPartition, list[FakeRecord]]:
+        """Return the next records, grouped by partition. Waits for the timeout if
+        there are none."""
+        count = min(self.poll_size, max_records or self.poll_size)
+        records = self.records[self.position : self.position + count]
+        self.position += len(records)
+        if not records:
+            await asyncio.sleep(timeout_ms / 1000)
+
+        polled: dict[TopicPartition, list[FakeRecord]] = {}
+        for record in records:
+            partition = TopicPartition(record.topic, record.partition)
+            polled.setdefault(partition, []).append(record)
+        return polled
+
+    async def __anext__(self) -> FakeRecord:
+        """Return the next record"""
+        if self.position == len(self.records):
+            raise StopAsyncIteration
+        self.position += 1
+        return self.records[self.position - 1]
+
+    def assignment(self) -> set[TopicPartition]:
+        """The assigned partitions, by default those of all queued records"""
+        if self.assigned is not None:
+            return set(self.assigned)
+        return {
+            TopicPartition(record.topic, record.partition) for record in self.records
+        }
+
+    async def commit(self, offsets: Optional[dict[Any, int]] = None) -> None:
+        """Commit the given offsets or the current position"""
+        if offsets is None:
+            self.committed = self.position
+        else:
+            self.commits.append(offsets)
+            self.committed = max(offsets.values())
+
+
+def make_update_record(
+    offset: int, sample_id: str, test_result: str, *, partition: int = 0
+) -> FakeRecord:
+    """Returns a record of an update_sample event"""
+    return FakeRecord(
+        topic=DEFAULT_CONFIG.update_sample_event_topic,
+        partition=partition,
+        offset=offset,
+        key=sample_id,
+        value={
+            "sample_id": sample_id,
+            "status": "completed",
+            "test_result": test_result,
+        },
+        headers=[("type", DEFAULT_CONFIG.update_sample_event_type.encode("ascii"))],
+    )
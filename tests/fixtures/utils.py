@@ -28,6 +28,16 @@ VALID_DATE_STRING = "2023-01-15T11:18+02:00"
 VALID_NAME = "Jonathan K."
 
 
+class FakeClock:
+    """A clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
 class Parametrizer:
     """Hosts static methods to assist in test creation."""
 
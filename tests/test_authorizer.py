@@ -0,0 +1,119 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests the Authorizer in its different execution modes"""
+import asyncio
+
+import pytest
+
+from cm.core.authorizer import Authorizer, AuthorizerConfig
+from cm.core.hashing import TokenHashingConfig
+from cm.core.metrics import MetricsCollector
+
+PEPPER = "a-long-random-secret"
+
+
+@pytest.mark.parametrize("auth_executor", ["inline", "thread", "process"])
+@pytest.mark.asyncio
+async def test_hash_and_check(auth_executor):
+    """Hashing and verification give the same results in every mode"""
+    config = AuthorizerConfig(auth_executor=auth_executor, auth_max_workers=2)
+    async with Authorizer.construct(
+        config=config, metrics=MetricsCollector()
+    ) as authorizer:
+        token = authorizer.generate_token(length=16)
+        token_hashed = await authorizer.hash_token(token=token)
+
+        assert await authorizer.check_token(
+            token_plain=token, token_hashed=token_hashed
+        )
+        assert not await authorizer.check_token(
+            token_plain="wrong", token_hashed=token_hashed
+        )
+
+
+@pytest.mark.asyncio
+async def test_queue_depth_metric():
+    """Operations exceeding the pool size are reported as queued"""
+    metrics = MetricsCollector()
+    config = AuthorizerConfig(auth_executor="thread", auth_max_workers=1)
+    async with Authorizer.construct(config=config, metrics=metrics) as authorizer:
+        tasks = [
+            asyncio.create_task(authorizer.hash_token(token="abc")) for _ in range(3)
+        ]
+        await asyncio.sleep(0)
+
+        snapshot = metrics.snapshot()
+        assert snapshot["auth_pool_in_flight"] == 3
+        assert snapshot["auth_pool_queue_depth"] == 2
+
+        await asyncio.gather(*tasks)
+        assert metrics.snapshot()["auth_pool_queue_depth"] == 0
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        TokenHashingConfig(token_hash_algorithm="bcrypt", bcrypt_rounds=4),
+        TokenHashingConfig(
+            token_hash_algorithm="hmac-sha256", token_hash_pepper=PEPPER
+        ),
+        TokenHashingConfig(token_hash_algorithm="scrypt", scrypt_cost=2**4),
+    ],
+)
+@pytest.mark.asyncio
+async def test_hashing_backends(config: TokenHashingConfig):
+    """Every backend encodes its algorithm in the hash and verifies its own hashes"""
+    authorizer = Authorizer(config=config)
+    token_hashed = await authorizer.hash_token(token="abc")
+
+    assert token_hashed != "abc"
+    assert await authorizer.check_token(token_plain="abc", token_hashed=token_hashed)
+    assert not await authorizer.check_token(
+        token_plain="abd", token_hashed=token_hashed
+    )
+    assert not authorizer.needs_rehash(token_hashed=token_hashed)
+
+
+@pytest.mark.asyncio
+async def test_needs_rehash():
+    """Hashes from other backends or with a different cost need to be re-hashed, but
+    can still be verified"""
+    old_authorizer = Authorizer(config=TokenHashingConfig(bcrypt_rounds=4))
+    token_hashed = await old_authorizer.hash_token(token="abc")
+
+    for config in [
+        TokenHashingConfig(bcrypt_rounds=5),
+        TokenHashingConfig(token_hash_algorithm="scrypt", token_hash_pepper=PEPPER),
+    ]:
+        authorizer = Authorizer(config=config)
+        assert authorizer.needs_rehash(token_hashed=token_hashed)
+        assert await authorizer.check_token(
+            token_plain="abc", token_hashed=token_hashed
+        )
+
+
+def test_pepper_required():
+    """The HMAC-based backend can't be configured without a pepper"""
+    with pytest.raises(ValueError):
+        TokenHashingConfig(token_hash_algorithm="hmac-sha256")
+
+
+@pytest.mark.parametrize("scrypt_cost", [3, 1000, 2**14 + 2])
+def test_scrypt_cost_power_of_two(scrypt_cost: int):
+    """The scrypt cost must be a power of two"""
+    with pytest.raises(ValueError):
+        TokenHashingConfig(scrypt_cost=scrypt_cost)
+    assert TokenHashingConfig(scrypt_cost=2**10).scrypt_cost == 2**10
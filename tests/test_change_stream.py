@@ -0,0 +1,195 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests publishing sample updates from the change stream of the database"""
+
+from contextlib import asynccontextmanager
+from typing import Any, Optional
+
+import pytest
+from hexkit.providers.testing.eventpub import InMemEventPublisher
+
+from cm.adapters.outbound.akafka import EventPubTranslator
+from cm.adapters.outbound.change_stream import ChangeStreamRelay
+from tests.fixtures.config import DEFAULT_CONFIG
+from tests.fixtures.data_repository import VALID_SAMPLE
+
+
+def make_change(
+    sample_id: str, deleted: bool = False, updated_fields: Optional[list[str]] = None
+) -> dict[str, Any]:
+    """Returns a change event for an update of a sample's test result, or of the
+    given fields"""
+    document = {
+        "_id": sample_id,
+        "access_token_hash": "hash",
+        "status": "completed",
+        "test_result": "positive",
+        "version": 1,
+        **VALID_SAMPLE,
+    }
+    return {
+        "_id": {"_data": sample_id},
+        "operationType": "update",
+        "updateDescription": {
+            "updatedFields": {
+                field: document[field]
+                for field in updated_fields or ["status", "test_result", "version"]
+                if field in document
+            }
+        },
+        "fullDocument": None if deleted else document,
+    }
+
+
+def matches(change: dict[str, Any], condition: dict[str, Any]) -> bool:
+    """Evaluates the $or, equality and $exists conditions of a $match stage"""
+    if "$or" in condition:
+        return any(matches(change, alternative) for alternative in condition["$or"])
+    for path, expected in condition.items():
+        value: Any = change
+        for key in path.split("."):
+            value = value.get(key, {}) if isinstance(value, dict) else {}
+        if isinstance(expected, dict) and "$exists" in expected:
+            if (value != {}) != expected["$exists"]:
+                return False
+        elif value != expected:
+            return False
+    return True
+
+
+class FakeChangeStream:
+    """Returns the queued changes and ends once they are exhausted"""
+
+    def __init__(self, changes: list[dict[str, Any]]):
+        self.changes = changes
+        self.resume_token: Optional[dict[str, Any]] = None
+        self.alive = True
+
+    async def try_next(self) -> Optional[dict[str, Any]]:
+        """Returns the next change, or None if there is none"""
+        if not self.changes:
+            self.alive = False
+            return None
+        change = self.changes.pop(0)
+        self.resume_token = change["_id"]
+        return change
+
+
+class FakeCollection:
+    """Opens the change stream and records the options it was watched with"""
+
+    def __init__(self, stream: FakeChangeStream):
+        self.stream = stream
+        self.options: dict[str, Any] = {}
+
+    @asynccontextmanager
+    async def watch(self, pipeline, **options):
+        """Watch the collection, filtering the changes like the $match stages of the
+        pipeline would"""
+        self.options = options
+        for stage in pipeline:
+            self.stream.changes = [
+                change
+                for change in self.stream.changes
+                if matches(change, stage["$match"])
+            ]
+        yield self.stream
+
+
+class InMemResumeTokenStore:
+    """Keeps the resume token in memory"""
+
+    def __init__(self, token: Optional[dict[str, Any]] = None):
+        self.token = token
+
+    async def load(self) -> Optional[dict[str, Any]]:
+        """Returns the saved token"""
+        return self.token
+
+    async def save(self, token: dict[str, Any]) -> None:
+        """Saves the token"""
+        self.token = token
+
+
+def make_relay(
+    stream: FakeChangeStream, token_store: InMemResumeTokenStore
+) -> tuple[ChangeStreamRelay, FakeCollection, InMemEventPublisher]:
+    """Returns a relay watching the stream, the collection providing the stream,
+    and the publisher the relay publishes to"""
+    collection = FakeCollection(stream)
+    event_publisher = InMemEventPublisher()
+    relay = ChangeStreamRelay(
+        collection=collection,
+        token_store=token_store,
+        publisher=EventPubTranslator(config=DEFAULT_CONFIG, provider=event_publisher),
+        batch_size=2,
+        max_await_ms=10,
+        retry_interval_seconds=0,
+    )
+    return relay, collection, event_publisher
+
+
+@pytest.mark.asyncio
+async def test_changes_are_relayed_in_batches():
+    """Changes are published in batches, after each of which the token is saved"""
+    stream = FakeChangeStream(
+        [make_change("a"), make_change("b"), make_change("c", deleted=True)]
+    )
+    token_store = InMemResumeTokenStore()
+    relay, _, event_publisher = make_relay(stream, token_store)
+
+    assert await relay.relay(stream) == 2
+    assert token_store.token == {"_data": "b"}
+    assert await relay.relay(stream) == 1
+    assert token_store.token == {"_data": "c"}
+    assert await relay.relay(stream) == 0
+
+    topic = event_publisher.event_store.topics[
+        DEFAULT_CONFIG.sample_updated_event_topic
+    ]
+    assert [event.key for event in topic] == ["a", "b"]
+    assert "access_token_hash" not in topic[0].payload
+    assert topic[0].payload["test_result"] == "positive"
+
+
+@pytest.mark.asyncio
+async def test_watching_resumes_after_saved_token():
+    """The change stream is resumed after the last saved token"""
+    stream = FakeChangeStream([make_change("a")])
+    token_store = InMemResumeTokenStore(token={"_data": "previous"})
+    relay, collection, _ = make_relay(stream, token_store)
+
+    await relay._watch()  # pylint: disable=protected-access
+
+    assert collection.options["resume_after"] == {"_data": "previous"}
+    assert collection.options["full_document"] == "updateLookup"
+    assert token_store.token == {"_data": "a"}
+
+
+@pytest.mark.asyncio
+async def test_token_only_change_is_not_relayed():
+    """Changes that don't touch the test data or the version are not relayed"""
+    stream = FakeChangeStream(
+        [make_change("a", updated_fields=["access_token_hash"]), make_change("b")]
+    )
+    relay, _, event_publisher = make_relay(stream, InMemResumeTokenStore())
+
+    await relay._watch()  # pylint: disable=protected-access
+
+    topic = event_publisher.event_store.topics[
+        DEFAULT_CONFIG.sample_updated_event_topic
+    ]
+    assert [event.key for event in topic] == ["b"]
@@ -0,0 +1,560 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the DataRepository, using in-memory stand-ins for MongoDB and Kafka"""
+
+from collections.abc import Sequence
+
+import pytest
+from hexkit.providers.testing.eventpub import InMemEventPublisher
+
+from cm.core import models
+from cm.core.authorizer import Authorizer
+from cm.core.hashing import TokenHashingConfig
+from cm.core.metrics import MetricsCollector
+from cm.core.retry import ConflictRetrier
+from cm.core.session import SessionTokenSigner
+from cm.core.token_cache import VerifiedTokenCache
+from cm.ports.outbound.dao import BulkInsertError, VersionConflictError
+from tests.fixtures.config import DEFAULT_CONFIG
+from tests.fixtures.dao import InMemSampleDao
+from tests.fixtures.data_repository import VALID_SAMPLE, make_data_repository
+
+
+@pytest.mark.asyncio
+async def test_polling_uses_token_cache():
+    """Repeated retrievals with the same token skip the hash verification"""
+    metrics = MetricsCollector()
+    token_cache = VerifiedTokenCache(max_entries=10, ttl_seconds=60, metrics=metrics)
+    data_repository = make_data_repository(token_cache=token_cache)
+
+    sample = await data_repository.create_sample(
+        sample_creation=models.SampleCreation(**VALID_SAMPLE)
+    )
+    for _ in range(3):
+        await data_repository.retrieve_sample(
+            sample_id=sample.sample_id, access_token=sample.access_token
+        )
+
+    with pytest.raises(data_repository.UnauthorizedRequestError):
+        await data_repository.retrieve_sample(
+            sample_id=sample.sample_id, access_token="wrong"
+        )
+
+    snapshot = metrics.snapshot()
+    assert snapshot["token_cache_hits"] == 3
+    assert snapshot["token_cache_misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_batch_creation_seeds_token_cache():
+    """Samples created in a batch can be polled without verifying the hash"""
+    metrics = MetricsCollector()
+    token_cache = VerifiedTokenCache(max_entries=10, ttl_seconds=60, metrics=metrics)
+    data_repository = make_data_repository(token_cache=token_cache)
+
+    results = await data_repository.create_samples(
+        sample_creations=[VALID_SAMPLE, VALID_SAMPLE]
+    )
+    for result in results:
+        assert result.sample_id is not None and result.access_token is not None
+        await data_repository.retrieve_sample(
+            sample_id=result.sample_id, access_token=result.access_token
+        )
+
+    snapshot = metrics.snapshot()
+    assert snapshot["token_cache_hits"] == 2
+    assert snapshot.get("token_cache_misses", 0) == 0
+
+
+@pytest.mark.asyncio
+async def test_rehash_on_verify():
+    """Hashes produced by a previously configured backend are migrated on retrieval"""
+    sample_dao = InMemSampleDao()
+    old_authorizer = Authorizer(config=TokenHashingConfig(bcrypt_rounds=4))
+    sample = await make_data_repository(
+        authorizer=old_authorizer, sample_dao=sample_dao
+    ).create_sample(sample_creation=models.SampleCreation(**VALID_SAMPLE))
+    assert sample.access_token_hash.startswith("$2b$")
+
+    new_authorizer = Authorizer(
+        config=TokenHashingConfig(
+            token_hash_algorithm="hmac-sha256", token_hash_pepper="secret"
+        )
+    )
+    data_repository = make_data_repository(
+        authorizer=new_authorizer, sample_dao=sample_dao
+    )
+    await data_repository.retrieve_sample(
+        sample_id=sample.sample_id, access_token=sample.access_token
+    )
+
+    stored = await sample_dao.get_by_id(sample.sample_id)
+    assert stored.access_token_hash.startswith("$hmac-sha256$")
+    await data_repository.retrieve_sample(
+        sample_id=sample.sample_id, access_token=sample.access_token
+    )
+
+
+@pytest.mark.asyncio
+async def test_retrieve_sample_fields():
+    """Only the requested fields and the sample_id are returned, never the hash"""
+    data_repository = make_data_repository()
+    sample = await data_repository.create_sample(
+        sample_creation=models.SampleCreation(**VALID_SAMPLE)
+    )
+
+    fields = await data_repository.retrieve_sample_fields(
+        sample_id=sample.sample_id,
+        access_token=sample.access_token,
+        fields={"status", "test_result"},
+    )
+
+    assert fields == {
+        "sample_id": sample.sample_id,
+        "status": "pending",
+        "test_result": "inconclusive",
+    }
+    with pytest.raises(data_repository.UnauthorizedRequestError):
+        await data_repository.retrieve_sample_fields(
+            sample_id=sample.sample_id, access_token="wrong", fields={"status"}
+        )
+    with pytest.raises(data_repository.SampleNotFoundError):
+        await data_repository.retrieve_sample_fields(
+            sample_id="unknown", access_token="wrong", fields={"status"}
+        )
+
+
+@pytest.mark.asyncio
+async def test_session_tokens():
+    """Session tokens grant access to the sample they were issued for"""
+    session_signer = SessionTokenSigner(secret=b"secret", ttl_seconds=60)
+    data_repository = make_data_repository(session_signer=session_signer)
+    sample = await data_repository.create_sample(
+        sample_creation=models.SampleCreation(**VALID_SAMPLE)
+    )
+    other_sample = await data_repository.create_sample(
+        sample_creation=models.SampleCreation(**VALID_SAMPLE)
+    )
+
+    session = await data_repository.create_session_token(
+        sample_id=sample.sample_id, access_token=sample.access_token
+    )
+    retrieved = await data_repository.retrieve_sample(
+        sample_id=sample.sample_id, access_token=session.session_token
+    )
+    assert retrieved.sample_id == sample.sample_id
+
+    with pytest.raises(data_repository.UnauthorizedRequestError):
+        await data_repository.retrieve_sample(
+            sample_id=other_sample.sample_id, access_token=session.session_token
+        )
+    with pytest.raises(data_repository.UnauthorizedRequestError):
+        await data_repository.create_session_token(
+            sample_id=sample.sample_id, access_token=session.session_token
+        )
+
+
+@pytest.mark.asyncio
+async def test_session_tokens_disabled():
+    """Without a signer, no session tokens are issued"""
+    data_repository = make_data_repository()
+    with pytest.raises(data_repository.SessionTokensDisabledError):
+        await data_repository.create_session_token(sample_id="abc", access_token="abc")
+
+
+def test_session_token_expiry():
+    """Session tokens are rejected once expired or tampered with"""
+    now = [1000.0]
+    signer = SessionTokenSigner(secret=b"secret", ttl_seconds=60, clock=lambda: now[0])
+    token, _ = signer.issue(sample_id="abc")
+
+    assert signer.verify(token=token, sample_id="abc")
+    tampered = token[:-1] + ("1" if token.endswith("0") else "0")
+    assert not signer.verify(token=tampered, sample_id="abc")
+    assert not signer.verify(token="st.garbage", sample_id="abc")
+
+    now[0] += 61
+    assert not signer.verify(token=token, sample_id="abc")
+
+
+@pytest.mark.asyncio
+async def test_create_samples():
+    """Batch creation reports invalid items and conflicts per item"""
+    sample_dao = InMemSampleDao()
+    data_repository = make_data_repository(sample_dao=sample_dao)
+    sample_ids = iter(["id1", "id2", "id1"])
+    data_repository._random_string = lambda num: next(  # type: ignore  # pylint: disable=protected-access
+        sample_ids
+    )
+
+    results = await data_repository.create_samples(
+        sample_creations=[
+            VALID_SAMPLE,
+            {**VALID_SAMPLE, "submitter_email": "invalid"},
+            VALID_SAMPLE,
+            VALID_SAMPLE,
+        ]
+    )
+
+    assert [result.index for result in results] == [0, 1, 2, 3]
+    assert [result.status for result in results] == [
+        models.BatchItemStatus.CREATED,
+        models.BatchItemStatus.INVALID,
+        models.BatchItemStatus.CREATED,
+        models.BatchItemStatus.CONFLICT,
+    ]
+    assert sample_dao.round_trips == 1
+    assert set(sample_dao.documents) == {"id1", "id2"}
+
+    created = results[2]
+    assert created.sample_id is not None and created.access_token is not None
+    retrieved = await data_repository.retrieve_sample(
+        sample_id=created.sample_id, access_token=created.access_token
+    )
+    assert retrieved.sample_id == "id2"
+
+
+class RejectingSampleDao(InMemSampleDao):
+    """Rejects samples with the given patient pseudonym in bulk inserts"""
+
+    def __init__(self, *, rejected_pseudonym: str):
+        super().__init__()
+        self.rejected_pseudonym = rejected_pseudonym
+
+    async def insert_many(self, dtos: Sequence[models.Sample]) -> set[int]:
+        """Insert the accepted samples, then report the rejected ones"""
+        failures = {
+            position: "Document failed validation"
+            for position, dto in enumerate(dtos)
+            if dto.patient_pseudonym == self.rejected_pseudonym
+        }
+        conflicts = await super().insert_many(
+            [dto for position, dto in enumerate(dtos) if position not in failures]
+        )
+        if not failures:
+            return conflicts
+        accepted = [
+            position for position in range(len(dtos)) if position not in failures
+        ]
+        conflicts = {accepted[position] for position in conflicts}
+        raise BulkInsertError(
+            inserted=set(accepted) - conflicts, conflicts=conflicts, failures=failures
+        )
+
+
+@pytest.mark.asyncio
+async def test_create_samples_with_failures():
+    """Items that failed to be inserted are reported, the others are created"""
+    sample_dao = RejectingSampleDao(rejected_pseudonym="Rejected Patient")
+    data_repository = make_data_repository(sample_dao=sample_dao)
+
+    results = await data_repository.create_samples(
+        sample_creations=[
+            VALID_SAMPLE,
+            {**VALID_SAMPLE, "patient_pseudonym": "Rejected Patient"},
+            VALID_SAMPLE,
+        ]
+    )
+
+    assert [result.status for result in results] == [
+        models.BatchItemStatus.CREATED,
+        models.BatchItemStatus.FAILED,
+        models.BatchItemStatus.CREATED,
+    ]
+    assert results[1].error == "Document failed validation"
+    assert results[1].sample_id is None
+    assert set(sample_dao.documents) == {results[0].sample_id, results[2].sample_id}
+
+
+@pytest.mark.asyncio
+async def test_update_samples():
+    """Batch updates use one read and one write and report results per item"""
+    sample_dao = InMemSampleDao()
+    event_publisher = InMemEventPublisher()
+    data_repository = make_data_repository(
+        sample_dao=sample_dao, event_publisher=event_publisher
+    )
+    first, second = [
+        await data_repository.create_sample(
+            sample_creation=models.SampleCreation(**VALID_SAMPLE)
+        )
+        for _ in range(2)
+    ]
+    update = {"status": "completed", "test_result": "positive"}
+    sample_dao.round_trips = 0
+
+    results = await data_repository.update_samples(
+        updates=[
+            {
+                **update,
+                "sample_id": first.sample_id,
+                "access_token": first.access_token,
+            },
+            {**update, "sample_id": second.sample_id, "access_token": "wrong"},
+            {**update, "sample_id": "unknown", "access_token": first.access_token},
+            {**update, "sample_id": first.sample_id, "status": "invalid"},
+        ]
+    )
+
+    assert [result.status for result in results] == [
+        models.BatchItemStatus.UPDATED,
+        models.BatchItemStatus.UNAUTHORIZED,
+        models.BatchItemStatus.NOT_FOUND,
+        models.BatchItemStatus.INVALID,
+    ]
+    assert sample_dao.round_trips == 2
+
+    topic = DEFAULT_CONFIG.sample_updated_event_topic
+    events = event_publisher.event_store.topics[topic]
+    assert [event.key for event in events] == [first.sample_id]
+
+    retrieved = await data_repository.retrieve_sample(
+        sample_id=first.sample_id, access_token=first.access_token
+    )
+    assert retrieved.test_result == models.SampleTestResult.POSITIVE
+
+
+@pytest.mark.asyncio
+async def test_internal_update_single_round_trip():
+    """Internal updates are applied with one atomic operation"""
+    sample_dao = InMemSampleDao()
+    event_publisher = InMemEventPublisher()
+    data_repository = make_data_repository(
+        sample_dao=sample_dao, event_publisher=event_publisher
+    )
+    sample = await data_repository.create_sample(
+        sample_creation=models.SampleCreation(**VALID_SAMPLE)
+    )
+    sample_dao.round_trips = 0
+
+    await data_repository.update_sample(
+        updates=models.SampleUpdate(
+            sample_id=sample.sample_id, status="completed", test_result="negative"
+        ),
+        is_external=False,
+    )
+
+    assert sample_dao.round_trips == 1
+    topic = DEFAULT_CONFIG.sample_updated_event_topic
+    event = event_publisher.event_store.get(topic)
+    assert event.payload["status"] == "completed"
+    assert event.payload["test_result"] == "negative"
+    assert event.payload["patient_pseudonym"] == VALID_SAMPLE["patient_pseudonym"]
+
+    with pytest.raises(data_repository.SampleNotFoundError):
+        await data_repository.update_sample(
+            updates=models.SampleUpdate(
+                sample_id="unknown", status="completed", test_result="negative"
+            ),
+            is_external=False,
+        )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("is_external", [True, False])
+async def test_unchanged_update_is_skipped(is_external: bool):
+    """Updates that don't change the sample are neither written nor published"""
+    sample_dao = InMemSampleDao()
+    event_publisher = InMemEventPublisher()
+    data_repository = make_data_repository(
+        sample_dao=sample_dao, event_publisher=event_publisher
+    )
+    sample = await data_repository.create_sample(
+        sample_creation=models.SampleCreation(**VALID_SAMPLE)
+    )
+    updates = models.SampleUpdate(
+        sample_id=sample.sample_id, status="completed", test_result="negative"
+    )
+
+    for _ in range(2):
+        await data_repository.update_sample(
+            updates=updates, access_token=sample.access_token, is_external=is_external
+        )
+        await data_repository.update_samples(
+            updates=[{**updates.dict(), "access_token": sample.access_token}],
+            is_external=is_external,
+        )
+
+    stored = await sample_dao.get_by_id(sample.sample_id)
+    assert stored.version == 1
+    topic = event_publisher.event_store.topics[
+        DEFAULT_CONFIG.sample_updated_event_topic
+    ]
+    assert len(topic) == 1
+
+
+@pytest.mark.asyncio
+async def test_unchanged_update_with_token_rehash_is_skipped():
+    """Migrating the token hash doesn't make an unchanged update a change"""
+    sample_dao = InMemSampleDao()
+    old_data_repository = make_data_repository(
+        authorizer=Authorizer(config=TokenHashingConfig(bcrypt_rounds=4)),
+        sample_dao=sample_dao,
+    )
+    samples = [
+        await old_data_repository.create_sample(
+            sample_creation=models.SampleCreation(**VALID_SAMPLE)
+        )
+        for _ in range(2)
+    ]
+    event_publisher = InMemEventPublisher()
+    data_repository = make_data_repository(
+        authorizer=Authorizer(
+            config=TokenHashingConfig(
+                token_hash_algorithm="hmac-sha256", token_hash_pepper="secret"
+            )
+        ),
+        sample_dao=sample_dao,
+        event_publisher=event_publisher,
+    )
+
+    await data_repository.update_sample(
+        updates=models.SampleUpdate(
+            sample_id=samples[0].sample_id, status="pending", test_result="inconclusive"
+        ),
+        access_token=samples[0].access_token,
+    )
+    results = await data_repository.update_samples(
+        updates=[
+            {
+                "sample_id": samples[1].sample_id,
+                "status": "pending",
+                "test_result": "inconclusive",
+                "access_token": samples[1].access_token,
+            }
+        ]
+    )
+
+    assert results[0].status == models.BatchItemStatus.UPDATED
+    for sample in samples:
+        stored = await sample_dao.get_by_id(sample.sample_id)
+        assert stored.access_token_hash.startswith("$hmac-sha256$")
+        assert stored.version == 0
+    assert not event_publisher.event_store.topics[
+        DEFAULT_CONFIG.sample_updated_event_topic
+    ]
+
+
+@pytest.mark.asyncio
+async def test_update_retries_on_version_conflict():
+    """A concurrent modification between read and write causes a retry, not a lost
+    update"""
+    sample_dao = InMemSampleDao()
+    metrics = MetricsCollector()
+    data_repository = make_data_repository(
+        sample_dao=sample_dao,
+        update_retrier=ConflictRetrier(base_delay=0, metrics=metrics),
+    )
+    sample = await data_repository.create_sample(
+        sample_creation=models.SampleCreation(**VALID_SAMPLE)
+    )
+
+    get_by_id = sample_dao.get_by_id
+
+    async def racing_get_by_id(id_: str) -> models.Sample:
+        """Read the sample, then let an event update it before returning"""
+        sample_dao.get_by_id = get_by_id  # type: ignore
+        read = await get_by_id(id_)
+        await data_repository.update_sample(
+            updates=models.SampleUpdate(
+                sample_id=id_, status="failed", test_result="inconclusive"
+            ),
+            is_external=False,
+        )
+        return read
+
+    sample_dao.get_by_id = racing_get_by_id  # type: ignore
+    await data_repository.update_sample(
+        updates=models.SampleUpdate(
+            sample_id=sample.sample_id, status="completed", test_result="positive"
+        ),
+        access_token=sample.access_token,
+    )
+
+    stored = await sample_dao.get_by_id(sample.sample_id)
+    assert stored.test_result == models.SampleTestResult.POSITIVE
+    assert stored.version == 2
+    snapshot = metrics.snapshot()
+    assert snapshot["update_conflicts"] == 1
+    assert snapshot["update_retries"] == 1
+
+
+@pytest.mark.asyncio
+async def test_update_conflict_retries_exhausted():
+    """Updates give up after the configured number of attempts"""
+    sample_dao = InMemSampleDao()
+    data_repository = make_data_repository(
+        sample_dao=sample_dao,
+        update_retrier=ConflictRetrier(max_attempts=3, base_delay=0),
+    )
+    sample = await data_repository.create_sample(
+        sample_creation=models.SampleCreation(**VALID_SAMPLE)
+    )
+
+    async def conflicting_update(dto: models.Sample) -> models.Sample:
+        raise VersionConflictError(id_=dto.sample_id)
+
+    sample_dao.update_versioned = conflicting_update  # type: ignore
+    with pytest.raises(data_repository.UpdateConflictError):
+        await data_repository.update_sample(
+            updates=models.SampleUpdate(
+                sample_id=sample.sample_id, status="completed", test_result="positive"
+            ),
+            access_token=sample.access_token,
+        )
+
+
+@pytest.mark.asyncio
+async def test_update_samples_retries_conflicts():
+    """Samples modified during a batch update are updated again individually"""
+    sample_dao = InMemSampleDao()
+    data_repository = make_data_repository(
+        sample_dao=sample_dao, update_retrier=ConflictRetrier(base_delay=0)
+    )
+    sample = await data_repository.create_sample(
+        sample_creation=models.SampleCreation(**VALID_SAMPLE)
+    )
+
+    get_many = sample_dao.get_many
+
+    async def racing_get_many(ids):
+        """Read the samples, then let an event update them before returning"""
+        sample_dao.get_many = get_many  # type: ignore
+        read = await get_many(ids)
+        for id_ in ids:
+            await sample_dao.update_test_data(
+                models.SampleUpdate(
+                    sample_id=id_, status="failed", test_result="positive"
+                )
+            )
+        return read
+
+    sample_dao.get_many = racing_get_many  # type: ignore
+    results = await data_repository.update_samples(
+        updates=[
+            {
+                "sample_id": sample.sample_id,
+                "access_token": sample.access_token,
+                "status": "completed",
+                "test_result": "negative",
+            }
+        ]
+    )
+
+    assert results[0].status == models.BatchItemStatus.UPDATED
+    stored = await sample_dao.get_by_id(sample.sample_id)
+    assert stored.test_result == models.SampleTestResult.NEGATIVE
+    assert stored.version == 2
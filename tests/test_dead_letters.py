@@ -0,0 +1,319 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests retrying failing events, sending them to the dead-letter topic, and
+replaying them"""
+
+from typing import Optional
+
+import pytest
+from hexkit.providers.testing.eventpub import InMemEventPublisher
+
+from cm.adapters.inbound.akafka import EventSubTranslator
+from cm.adapters.inbound.dead_letters import (
+    DeadLetter,
+    DeadLetterQueue,
+    DeadLetterReplayer,
+    ReplayResult,
+)
+from cm.adapters.inbound.kafka_consumer import ConsumedEvent, KafkaBatchEventSubscriber
+from cm.adapters.serialization import dumps
+from cm.core import models
+from cm.core.data_repository import DataRepository
+from cm.core.metrics import MetricsCollector
+from tests.fixtures.config import DEFAULT_CONFIG
+from tests.fixtures.data_repository import VALID_SAMPLE, make_data_repository
+from tests.fixtures.kafka import FakeConsumer, FakeRecord, make_update_record
+
+DLQ_CONFIG = DEFAULT_CONFIG.copy(
+    update={
+        "event_dead_letter_topic": "sample_events_dlq",
+        "event_max_attempts": 3,
+        "event_retry_backoff_ms": 0,
+    }
+)
+
+
+class FlakyDataRepository(DataRepository):
+    """Fails to update samples the given number of times before succeeding"""
+
+    def __init__(self, *, failures: int, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+        self.calls = 0
+
+    async def update_sample(self, *, updates, access_token="", is_external=True):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ConnectionError("database unavailable")
+        return await super().update_sample(
+            updates=updates, access_token=access_token, is_external=is_external
+        )
+
+    async def update_samples(self, *, updates, is_external=True):
+        raise ConnectionError("database unavailable")
+
+
+def make_translator(
+    data_repository: DataRepository, dead_letter_topic: Optional[str] = "dlq"
+) -> tuple[EventSubTranslator, InMemEventPublisher]:
+    """Returns a translator with a dead-letter queue and the publisher it uses"""
+    publisher = InMemEventPublisher()
+    config = DLQ_CONFIG.copy(update={"event_dead_letter_topic": dead_letter_topic})
+    translator = EventSubTranslator(
+        config=config,
+        data_repository=data_repository,
+        dead_letters=DeadLetterQueue(config=config, provider=publisher),
+    )
+    return translator, publisher
+
+
+class ConflictingDataRepository(FlakyDataRepository):
+    """Reports a version conflict for every update of a bulk update"""
+
+    async def update_samples(self, *, updates, is_external=True):
+        return [
+            models.SampleBatchUpdateResult(
+                index=index,
+                sample_id=update["sample_id"],
+                status=models.BatchItemStatus.CONFLICT,
+            )
+            for index, update in enumerate(updates)
+        ]
+
+
+def make_flaky_data_repository(
+    failures: int, repository_cls: type[FlakyDataRepository] = FlakyDataRepository
+) -> FlakyDataRepository:
+    """Returns a FlakyDataRepository on top of in-memory stand-ins"""
+    template = make_data_repository()
+    return repository_cls(
+        failures=failures,
+        sample_dao=template._sample_dao,  # pylint: disable=protected-access
+        authorizer=template._authorizer,  # pylint: disable=protected-access
+        event_publisher=template._event_publisher,  # pylint: disable=protected-access
+    )
+
+
+async def consume_update(translator: EventSubTranslator, sample_id: str) -> None:
+    """Let the translator consume a single update event"""
+    await translator.consume(
+        payload={
+            "sample_id": sample_id,
+            "status": "completed",
+            "test_result": "positive",
+        },
+        type_=DEFAULT_CONFIG.update_sample_event_type,
+        topic=DEFAULT_CONFIG.update_sample_event_topic,
+    )
+
+
+@pytest.mark.asyncio
+async def test_permanent_failure_is_dead_lettered_right_away():
+    """An update of an unknown sample is not retried"""
+    translator, publisher = make_translator(make_data_repository())
+
+    await consume_update(translator, "unknown")
+
+    (event,) = publisher.event_store.topics["dlq"]
+    dead_letter = DeadLetter(**event.payload)
+    assert event.type_ == DEFAULT_CONFIG.update_sample_event_type
+    assert event.key == "unknown"
+    assert dead_letter.original_topic == DEFAULT_CONFIG.update_sample_event_topic
+    assert dead_letter.error_type == "SampleNotFoundError"
+    assert dead_letter.attempts == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("failures, dead_lettered", [(2, 0), (3, 1)])
+async def test_transient_failures_are_retried(failures: int, dead_lettered: int):
+    """An event is only dead-lettered once all attempts have failed"""
+    data_repository = make_flaky_data_repository(failures)
+    sample = await data_repository.create_sample(
+        sample_creation=models.SampleCreation(**VALID_SAMPLE)
+    )
+    translator, publisher = make_translator(data_repository)
+
+    await consume_update(translator, sample.sample_id)
+
+    assert data_repository.calls == min(failures + 1, 3)
+    assert len(publisher.event_store.topics["dlq"]) == dead_lettered
+
+
+@pytest.mark.asyncio
+async def test_failures_are_raised_without_dead_letter_topic():
+    """Without a dead-letter topic, the consumer fails as before"""
+    data_repository = make_flaky_data_repository(failures=5)
+    translator, _ = make_translator(data_repository, dead_letter_topic=None)
+
+    with pytest.raises(ConnectionError):
+        await consume_update(translator, "any")
+    assert data_repository.calls == 3
+
+
+@pytest.mark.asyncio
+async def test_batch_consumption_dead_letters_failed_items():
+    """Updates of a batch that can't be applied are dead-lettered, the others are
+    applied and all offsets are committed"""
+    data_repository = make_data_repository()
+    sample = await data_repository.create_sample(
+        sample_creation=models.SampleCreation(**VALID_SAMPLE)
+    )
+    translator, publisher = make_translator(data_repository)
+    consumer = FakeConsumer(
+        [
+            make_update_record(0, sample.sample_id, "positive"),
+            make_update_record(1, "unknown", "negative"),
+        ]
+    )
+    subscriber = KafkaBatchEventSubscriber(
+        consumer=consumer, translator=translator, max_size=10, max_wait_seconds=0.01
+    )
+
+    await subscriber.run(forever=False)
+
+    assert consumer.committed == 2
+    (event,) = publisher.event_store.topics["dlq"]
+    assert event.key == "unknown"
+    assert DeadLetter(**event.payload).error_type == "not_found"
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_falls_back_to_single_events():
+    """If the bulk write fails, each event is retried on its own"""
+    data_repository = make_flaky_data_repository(failures=1)
+    sample = await data_repository.create_sample(
+        sample_creation=models.SampleCreation(**VALID_SAMPLE)
+    )
+    translator, publisher = make_translator(data_repository)
+    event = ConsumedEvent(
+        topic=DEFAULT_CONFIG.update_sample_event_topic,
+        partition=0,
+        offset=0,
+        key=sample.sample_id,
+        type_=DEFAULT_CONFIG.update_sample_event_type,
+        payload={
+            "sample_id": sample.sample_id,
+            "status": "completed",
+            "test_result": "positive",
+        },
+    )
+
+    await translator.consume_batch([event])
+
+    assert data_repository.calls == 2
+    assert not publisher.event_store.topics["dlq"]
+
+
+@pytest.mark.asyncio
+async def test_conflicts_in_batch_are_retried():
+    """Version conflicts of a bulk update are retried one by one, not dead-lettered"""
+    data_repository = make_flaky_data_repository(
+        failures=0, repository_cls=ConflictingDataRepository
+    )
+    sample = await data_repository.create_sample(
+        sample_creation=models.SampleCreation(**VALID_SAMPLE)
+    )
+    translator, publisher = make_translator(data_repository)
+    consumer = FakeConsumer([make_update_record(0, sample.sample_id, "positive")])
+
+    await KafkaBatchEventSubscriber(
+        consumer=consumer, translator=translator, max_size=10, max_wait_seconds=0.01
+    ).run(forever=False)
+
+    assert data_repository.calls == 1
+    assert consumer.committed == 1
+    assert not publisher.event_store.topics["dlq"]
+    stored = await data_repository.retrieve_sample(
+        sample_id=sample.sample_id, access_token=sample.access_token
+    )
+    assert stored.test_result == models.SampleTestResult.POSITIVE
+
+
+def make_dead_letter(offset: int) -> DeadLetter:
+    """Returns a dead letter of an update_sample event"""
+    return DeadLetter(
+        original_topic="sample_events",
+        original_type="update_sample",
+        original_key=f"sample-{offset}",
+        payload={"sample_id": f"sample-{offset}"},
+        error_type="ConnectionError",
+        error="database unavailable",
+        attempts=3,
+        failed_at="2023-01-15T11:18+02:00",
+    )
+
+
+def make_dead_letter_record(
+    offset: int, value: bytes, *, typed: bool = True
+) -> FakeRecord:
+    """Returns a record of the dead-letter topic with the raw value"""
+    return FakeRecord(
+        topic="dlq",
+        partition=0,
+        offset=offset,
+        key=f"sample-{offset}",
+        value=value,
+        headers=[("type", b"update_sample")] if typed else [],
+    )
+
+
+@pytest.mark.asyncio
+async def test_replay():
+    """Dead letters are republished to their original topic in bulk and committed"""
+    consumer = FakeConsumer(
+        [
+            make_dead_letter_record(offset, dumps(make_dead_letter(offset)))
+            for offset in range(5)
+        ]
+    )
+    publisher = InMemEventPublisher()
+    replayer = DeadLetterReplayer(
+        consumer=consumer, provider=publisher, idle_timeout_ms=10
+    )
+
+    assert await replayer.run(max_events=3) == ReplayResult(replayed=3, skipped=0)
+    assert consumer.committed == 3
+    assert await replayer.run() == ReplayResult(replayed=2, skipped=0)
+    assert consumer.committed == 5
+
+    replayed = publisher.event_store.topics["sample_events"]
+    assert [event.key for event in replayed] == [f"sample-{i}" for i in range(5)]
+    assert replayed[0].payload == {"sample_id": "sample-0"}
+
+
+@pytest.mark.asyncio
+async def test_replay_skips_malformed_dead_letters():
+    """Records that are not valid dead letters are skipped and counted"""
+    valid = dumps(make_dead_letter(0))
+    consumer = FakeConsumer(
+        [
+            make_dead_letter_record(0, b"{not json"),
+            make_dead_letter_record(1, dumps({"payload": {}})),
+            make_dead_letter_record(2, valid, typed=False),
+            make_dead_letter_record(3, valid),
+        ],
+        poll_size=4,
+    )
+    publisher = InMemEventPublisher()
+    metrics = MetricsCollector()
+    replayer = DeadLetterReplayer(
+        consumer=consumer, provider=publisher, idle_timeout_ms=10, metrics=metrics
+    )
+
+    assert await replayer.run() == ReplayResult(replayed=1, skipped=3)
+    assert consumer.committed == 4
+    assert len(publisher.event_store.topics["sample_events"]) == 1
+    assert metrics.snapshot()["dead_letters_skipped"] == 3
@@ -0,0 +1,156 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests skipping events that were already processed"""
+
+from collections.abc import Collection, Mapping
+
+import pytest
+from hexkit.providers.testing.eventpub import InMemEventPublisher
+
+from cm.adapters.inbound.akafka import EventSubTranslator
+from cm.adapters.inbound.dedup import EventDeduplicator, EventIdentity
+from cm.adapters.inbound.kafka_consumer import (
+    KafkaBatchEventSubscriber,
+    KafkaConcurrentEventSubscriber,
+    KafkaSingleEventSubscriber,
+)
+from cm.core import models
+from tests.fixtures.config import DEFAULT_CONFIG
+from tests.fixtures.dao import InMemSampleDao
+from tests.fixtures.data_repository import VALID_SAMPLE, make_data_repository
+from tests.fixtures.kafka import FakeConsumer, make_update_record
+
+
+class InMemProcessedEventStore:
+    """Keeps the fingerprints of processed events in a dict"""
+
+    def __init__(self):
+        self.fingerprints: dict[str, str] = {}
+
+    async def get_many(self, keys: Collection[str]) -> dict[str, str]:
+        """Get the stored fingerprints of the given keys"""
+        return {key: self.fingerprints[key] for key in keys if key in self.fingerprints}
+
+    async def put_many(self, fingerprints: Mapping[str, str]) -> None:
+        """Store the fingerprints"""
+        self.fingerprints.update(fingerprints)
+
+
+@pytest.mark.asyncio
+async def test_redelivered_event_is_skipped():
+    """Events consumed one at a time or concurrently are identified by their offsets,
+    so an update that repeats the previous one is still applied"""
+    sample_dao = InMemSampleDao()
+    data_repository = make_data_repository(sample_dao=sample_dao)
+    sample = await data_repository.create_sample(
+        sample_creation=models.SampleCreation(**VALID_SAMPLE)
+    )
+    translator = EventSubTranslator(
+        config=DEFAULT_CONFIG,
+        data_repository=data_repository,
+        deduplicator=EventDeduplicator(window_size=10),
+    )
+    records = [
+        make_update_record(0, sample.sample_id, "positive"),
+        make_update_record(0, sample.sample_id, "positive"),
+        make_update_record(1, sample.sample_id, "positive"),
+    ]
+    single_subscriber = KafkaSingleEventSubscriber(
+        consumer=FakeConsumer(records), translator=translator
+    )
+    for _ in records[:2]:
+        await single_subscriber.run(forever=False)
+    stored = await sample_dao.get_by_id(sample.sample_id)
+    assert stored.test_result == models.SampleTestResult.POSITIVE
+
+    # the sample is changed in the meantime, e.g. through the REST API:
+    await sample_dao.update(
+        stored.copy(update={"test_result": models.SampleTestResult.NEGATIVE})
+    )
+    await single_subscriber.run(forever=False)
+    stored = await sample_dao.get_by_id(sample.sample_id)
+    assert stored.test_result == models.SampleTestResult.POSITIVE
+
+    # a redelivery of the records, now consumed concurrently, changes nothing:
+    await sample_dao.update(
+        stored.copy(update={"test_result": models.SampleTestResult.NEGATIVE})
+    )
+    await KafkaConcurrentEventSubscriber(
+        consumer=FakeConsumer([records[0], records[2]]),
+        translator=translator,
+        workers=2,
+        queue_size=2,
+    ).run(forever=False)
+    stored = await sample_dao.get_by_id(sample.sample_id)
+    assert stored.test_result == models.SampleTestResult.NEGATIVE
+
+
+@pytest.mark.asyncio
+async def test_redelivered_batch_is_skipped():
+    """Events of a batch are identified by their offsets"""
+    sample_dao = InMemSampleDao()
+    event_publisher = InMemEventPublisher()
+    data_repository = make_data_repository(
+        sample_dao=sample_dao, event_publisher=event_publisher
+    )
+    sample = await data_repository.create_sample(
+        sample_creation=models.SampleCreation(**VALID_SAMPLE)
+    )
+    translator = EventSubTranslator(
+        config=DEFAULT_CONFIG,
+        data_repository=data_repository,
+        deduplicator=EventDeduplicator(window_size=10),
+    )
+    records = [
+        make_update_record(0, sample.sample_id, "positive"),
+        make_update_record(1, sample.sample_id, "negative"),
+    ]
+    for redelivered in (records, records + [make_update_record(2, "unknown", "")]):
+        await KafkaBatchEventSubscriber(
+            consumer=FakeConsumer(redelivered),
+            translator=translator,
+            max_size=10,
+            max_wait_seconds=0.01,
+        ).run(forever=False)
+
+    topic = event_publisher.event_store.topics[
+        DEFAULT_CONFIG.sample_updated_event_topic
+    ]
+    assert len(topic) == 1
+
+
+@pytest.mark.asyncio
+async def test_window_is_bounded():
+    """The least recently processed events are forgotten"""
+    deduplicator = EventDeduplicator(window_size=2)
+    identities = [EventIdentity(key=str(key), fingerprint="") for key in range(3)]
+
+    await deduplicator.remember(identities)
+
+    assert await deduplicator.seen(identities) == [False, True, True]
+
+
+@pytest.mark.asyncio
+async def test_persistent_store():
+    """Events processed by another instance or before a restart are skipped"""
+    store = InMemProcessedEventStore()
+    identity = EventIdentity(key="sample_events/0/1", fingerprint="")
+
+    await EventDeduplicator(window_size=10, store=store).remember([identity])
+
+    assert await EventDeduplicator(window_size=10, store=store).seen([identity]) == [
+        True
+    ]
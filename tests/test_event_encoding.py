@@ -0,0 +1,174 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests the encodings of published events"""
+
+from typing import Any
+
+import pytest
+from aiokafka import ConsumerRecord
+
+from cm.adapters.inbound.kafka_consumer import decode_record, decode_record_value
+from cm.adapters.outbound.kafka_producer import (
+    EVENT_SCHEMA_VERSION,
+    EventEncodingConfig,
+    KafkaEncodingEventPublisher,
+)
+from cm.adapters.serialization import (
+    JSON_CONTENT_TYPE,
+    MSGPACK_CONTENT_TYPE,
+    EventDecodingError,
+    decode_event,
+    encode_event,
+    to_jsonable,
+)
+from cm.core import models
+from tests.fixtures.data_repository import VALID_SAMPLE
+
+PAYLOAD = to_jsonable(
+    models.SampleNoAuth(
+        **VALID_SAMPLE,
+        sample_id="sample",
+        status="completed",
+        test_result="negative",
+        test_date="2023-01-16T08:30:15+01:00",
+    )
+)
+
+
+class FakeProducer:
+    """Records the configuration and the sent events, serialized like by Kafka"""
+
+    instance: "FakeProducer"
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.sent: list[dict[str, Any]] = []
+        FakeProducer.instance = self
+
+    async def start(self):
+        """Nothing to start"""
+
+    async def stop(self):
+        """Nothing to stop"""
+
+    async def send_and_wait(self, topic, *, key, value, headers):
+        """Record the serialized event"""
+        self.sent.append(
+            {
+                "topic": topic,
+                "key": self.kwargs["key_serializer"](key),
+                "value": self.kwargs["value_serializer"](value),
+                "headers": dict(headers),
+            }
+        )
+
+
+def test_json_round_trip():
+    """JSON-encoded events are decoded, also without a content type"""
+    assert decode_event(encode_event(PAYLOAD)) == PAYLOAD
+    assert decode_event(b' {"a": 1}', content_type=JSON_CONTENT_TYPE) == {"a": 1}
+
+
+def test_msgpack_round_trip():
+    """msgpack-encoded events are decoded by their content type and smaller than
+    JSON"""
+    pytest.importorskip("msgpack")
+
+    encoded = encode_event(PAYLOAD, encoding="msgpack")
+
+    assert decode_event(encoded, content_type=MSGPACK_CONTENT_TYPE) == PAYLOAD
+    assert len(encoded) < len(encode_event(PAYLOAD))
+    # without a content type, events are expected to be JSON:
+    with pytest.raises(ValueError):
+        decode_event(encoded)
+
+
+def make_record(value: bytes, headers: dict[str, str]) -> ConsumerRecord:
+    """Returns a record with the raw value and the given headers"""
+    return ConsumerRecord(
+        topic="samples",
+        partition=0,
+        offset=0,
+        timestamp=0,
+        timestamp_type=0,
+        key="sample",
+        value=value,
+        checksum=0,
+        serialized_key_size=6,
+        serialized_value_size=len(value),
+        headers=tuple(
+            (name, header.encode("ascii")) for name, header in headers.items()
+        ),
+    )
+
+
+def test_decode_record():
+    """Records are decoded according to their headers, and skipped if they have an
+    unknown content type or schema version"""
+    value = encode_event(PAYLOAD)
+    current = {"content-type": JSON_CONTENT_TYPE, "schema-version": "1"}
+    missing: dict[str, str] = {}
+
+    for headers in [current, missing]:
+        record = decode_record(make_record(value, headers))
+        assert record is not None
+        assert record.value == PAYLOAD
+
+    for headers in [
+        {**current, "schema-version": "2"},
+        {**current, "content-type": "application/xml"},
+    ]:
+        with pytest.raises(EventDecodingError):
+            decode_record_value(make_record(value, headers))
+        assert decode_record(make_record(value, headers)) is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "encoding, content_type",
+    [("json", b"application/json"), ("msgpack", b"application/msgpack")],
+)
+async def test_publisher(encoding: str, content_type: bytes):
+    """Events are encoded and compressed as configured and carry the content type
+    and the schema version in their headers"""
+    if encoding == "msgpack":
+        pytest.importorskip("msgpack")
+    config = EventEncodingConfig(
+        service_name="cm",
+        service_instance_id="1",
+        kafka_servers=["kafka:9092"],
+        event_encoding=encoding,
+        event_compression="gzip",
+    )
+
+    async with KafkaEncodingEventPublisher.construct(
+        config=config, kafka_producer_cls=FakeProducer
+    ) as publisher:
+        await publisher.publish(
+            payload=PAYLOAD, type_="sample_updated", key="sample", topic="samples"
+        )
+
+    producer = FakeProducer.instance
+    assert producer.kwargs["compression_type"] == "gzip"
+    assert len(producer.sent) == 1
+    event = producer.sent[0]
+    assert event["key"] == b"sample"
+    assert decode_event(event["value"], content_type=content_type.decode()) == PAYLOAD
+    assert event["headers"] == {
+        "type": b"sample_updated",
+        "content-type": content_type,
+        "schema-version": EVENT_SCHEMA_VERSION.encode("ascii"),
+    }
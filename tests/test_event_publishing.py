@@ -0,0 +1,223 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests publishing events through a buffer"""
+
+import asyncio
+from collections.abc import Sequence
+from typing import Literal, Optional
+
+import pytest
+
+from cm.adapters.outbound.akafka import BufferedEventPublisher
+from cm.core import models
+from cm.core.metrics import MetricsCollector
+from cm.ports.outbound.event_pub import EventBufferFullError
+from tests.fixtures.data_repository import VALID_SAMPLE, make_data_repository
+
+
+class RecordingPublisher:
+    """Records the published batches. Publishing waits for the gate if given, and
+    the given number of attempts fail."""
+
+    def __init__(self, gate: Optional[asyncio.Event] = None, failures: int = 0):
+        self.batches: list[list[str]] = []
+        self.gate = gate
+        self.failures = failures
+
+    async def publish_sample_updated(
+        self, *, sample_no_auth: models.SampleNoAuth
+    ) -> None:
+        """Publish a single event"""
+        await self.publish_samples_updated(samples_no_auth=[sample_no_auth])
+
+    async def publish_samples_updated(
+        self, *, samples_no_auth: Sequence[models.SampleNoAuth]
+    ) -> None:
+        """Record the IDs of a batch of samples"""
+        if self.gate is not None:
+            await self.gate.wait()
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("broker not available")
+        self.batches.append([sample.sample_id for sample in samples_no_auth])
+
+
+def make_sample(sample_id: str) -> models.SampleNoAuth:
+    """Returns a sample with the given ID"""
+    return models.SampleNoAuth(
+        sample_id=sample_id, status="completed", test_result="negative", **VALID_SAMPLE
+    )
+
+
+def make_buffered_publisher(
+    publisher: RecordingPublisher,
+    *,
+    max_size: int = 100,
+    batch_size: int = 3,
+    overflow_policy: Literal["block", "drop_oldest", "error"] = "block",
+    max_attempts: int = 5,
+    metrics: Optional[MetricsCollector] = None,
+) -> BufferedEventPublisher:
+    """Returns a started BufferedEventPublisher"""
+    buffered_publisher = BufferedEventPublisher(
+        publisher=publisher,
+        max_size=max_size,
+        batch_size=batch_size,
+        linger_seconds=0.01,
+        overflow_policy=overflow_policy,
+        max_attempts=max_attempts,
+        retry_backoff_seconds=0.001,
+        metrics=metrics,
+    )
+    buffered_publisher.start()
+    return buffered_publisher
+
+
+@pytest.mark.asyncio
+async def test_events_are_published_in_batches():
+    """Queued events are batched up to the batch size and flushed on stop"""
+    publisher = RecordingPublisher()
+    metrics = MetricsCollector()
+    buffered_publisher = make_buffered_publisher(publisher, metrics=metrics)
+
+    await buffered_publisher.publish_samples_updated(
+        samples_no_auth=[make_sample(str(number)) for number in range(5)]
+    )
+    assert not publisher.batches
+    await buffered_publisher.stop()
+
+    assert publisher.batches == [["0", "1", "2"], ["3", "4"]]
+    snapshot = metrics.snapshot()
+    assert snapshot["event_buffer_flushes"] == 2
+    assert snapshot["event_buffer_events_flushed"] == 5
+    assert snapshot["event_buffer_depth"] == 0
+
+
+@pytest.mark.asyncio
+async def test_drop_oldest():
+    """When the buffer is full, the oldest queued event makes room"""
+    gate = asyncio.Event()
+    publisher = RecordingPublisher(gate=gate)
+    metrics = MetricsCollector()
+    buffered_publisher = make_buffered_publisher(
+        publisher,
+        max_size=2,
+        batch_size=1,
+        overflow_policy="drop_oldest",
+        metrics=metrics,
+    )
+
+    await buffered_publisher.publish_sample_updated(sample_no_auth=make_sample("0"))
+    # wait for the flusher to take the first event and block on the gate:
+    await asyncio.sleep(0.05)
+    for sample_id in "123":
+        await buffered_publisher.publish_sample_updated(
+            sample_no_auth=make_sample(sample_id)
+        )
+    gate.set()
+    await buffered_publisher.stop()
+
+    assert publisher.batches == [["0"], ["2"], ["3"]]
+    assert metrics.snapshot()["event_buffer_events_dropped"] == 1
+
+
+@pytest.mark.asyncio
+async def test_stop_with_drop_oldest():
+    """Events queued while stopping don't make the publisher miss the stop"""
+    gate = asyncio.Event()
+    publisher = RecordingPublisher(gate=gate)
+    buffered_publisher = make_buffered_publisher(
+        publisher, max_size=1, batch_size=1, overflow_policy="drop_oldest"
+    )
+
+    await buffered_publisher.publish_sample_updated(sample_no_auth=make_sample("0"))
+    await asyncio.sleep(0.05)
+    stopping = asyncio.create_task(buffered_publisher.stop())
+    await asyncio.sleep(0)
+    # an update that completes during the shutdown fills the buffer:
+    await buffered_publisher.publish_sample_updated(sample_no_auth=make_sample("1"))
+    gate.set()
+    await asyncio.wait_for(stopping, timeout=1)
+
+    assert publisher.batches == [["0"], ["1"]]
+
+
+@pytest.mark.asyncio
+async def test_error_when_full():
+    """With the 'error' policy, updates fail once the buffer is full, although they
+    are stored. Their events are lost and counted."""
+    gate = asyncio.Event()
+    publisher = RecordingPublisher(gate=gate)
+    metrics = MetricsCollector()
+    buffered_publisher = make_buffered_publisher(
+        publisher, max_size=1, batch_size=1, overflow_policy="error", metrics=metrics
+    )
+    data_repository = make_data_repository()
+    data_repository._event_publisher = (  # pylint: disable=protected-access
+        buffered_publisher
+    )
+    sample = await data_repository.create_sample(
+        sample_creation=models.SampleCreation(**VALID_SAMPLE)
+    )
+    await buffered_publisher.publish_sample_updated(sample_no_auth=make_sample("0"))
+    await asyncio.sleep(0.05)
+    await buffered_publisher.publish_sample_updated(sample_no_auth=make_sample("1"))
+
+    with pytest.raises(EventBufferFullError):
+        await buffered_publisher.publish_sample_updated(sample_no_auth=make_sample("2"))
+    with pytest.raises(data_repository.PublishingBacklogError):
+        await data_repository.update_sample(
+            updates=models.SampleUpdate(
+                sample_id=sample.sample_id, status="completed", test_result="negative"
+            ),
+            is_external=False,
+        )
+
+    gate.set()
+    await buffered_publisher.stop()
+    stored = await data_repository.retrieve_sample(
+        sample_id=sample.sample_id, access_token=sample.access_token
+    )
+    assert stored.status == models.SampleStatus.COMPLETED
+    assert publisher.batches == [["0"], ["1"]]
+    assert metrics.snapshot()["event_buffer_events_rejected"] == 2
+
+
+@pytest.mark.asyncio
+async def test_failed_batches_are_retried():
+    """A batch that fails is published again, and only dropped after the last
+    attempt"""
+    publisher = RecordingPublisher(failures=2)
+    metrics = MetricsCollector()
+    buffered_publisher = make_buffered_publisher(
+        publisher, batch_size=2, max_attempts=3, metrics=metrics
+    )
+
+    await buffered_publisher.publish_samples_updated(
+        samples_no_auth=[make_sample("0"), make_sample("1")]
+    )
+    await buffered_publisher.stop()
+    assert publisher.batches == [["0", "1"]]
+    assert metrics.snapshot()["event_buffer_flush_retries"] == 2
+
+    publisher.failures = 3
+    buffered_publisher.start()
+    await buffered_publisher.publish_sample_updated(sample_no_auth=make_sample("2"))
+    await buffered_publisher.stop()
+    assert publisher.batches == [["0", "1"]]
+    snapshot = metrics.snapshot()
+    assert snapshot["event_buffer_flush_retries"] == 4
+    assert snapshot["event_buffer_events_failed"] == 1
@@ -0,0 +1,79 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests the filter of existing sample IDs"""
+
+import pytest
+
+from cm.core import models
+from cm.core.id_filter import BloomFilter, SampleIdFilter
+from cm.core.metrics import MetricsCollector
+from tests.fixtures.dao import InMemSampleDao
+from tests.fixtures.data_repository import VALID_SAMPLE, make_data_repository
+
+
+def test_bloom_filter():
+    """Added items are always found, others mostly not"""
+    bloom_filter = BloomFilter(capacity=1000, false_positive_rate=0.01)
+    for number in range(1000):
+        bloom_filter.add(f"known{number}")
+
+    assert all(f"known{number}" in bloom_filter for number in range(1000))
+    false_positives = sum(f"unknown{number}" in bloom_filter for number in range(10000))
+    assert false_positives < 300
+    assert bloom_filter.false_positive_rate() == pytest.approx(0.01, rel=0.2)
+
+
+@pytest.mark.asyncio
+async def test_rebuild_resizes():
+    """Rebuilding sizes the filter for the number of samples in the database"""
+    sample_dao = InMemSampleDao()
+    sample_dao.documents.update({f"id{number}": {} for number in range(5000)})
+    sample_id_filter = SampleIdFilter(sample_dao=sample_dao, false_positive_rate=0.01)
+
+    assert sample_id_filter.might_exist("unknown")
+    await sample_id_filter.rebuild()
+
+    assert all(sample_id_filter.might_exist(f"id{number}") for number in range(5000))
+    assert not sample_id_filter.might_exist("unknown")
+    # pylint: disable=protected-access
+    assert sample_id_filter._filter is not None
+    assert sample_id_filter._filter.false_positive_rate() <= 0.01
+
+
+@pytest.mark.asyncio
+async def test_unknown_ids_skip_database():
+    """Unknown IDs are rejected without a round trip, new samples are found"""
+    sample_dao = InMemSampleDao()
+    metrics = MetricsCollector()
+    sample_id_filter = SampleIdFilter(sample_dao=sample_dao, metrics=metrics)
+    await sample_id_filter.rebuild()
+    data_repository = make_data_repository(
+        sample_dao=sample_dao, sample_id_filter=sample_id_filter
+    )
+
+    sample = await data_repository.create_sample(
+        sample_creation=models.SampleCreation(**VALID_SAMPLE)
+    )
+    sample_dao.round_trips = 0
+
+    with pytest.raises(data_repository.SampleNotFoundError):
+        await data_repository.retrieve_sample(sample_id="unknown", access_token="x")
+    assert sample_dao.round_trips == 0
+
+    await data_repository.retrieve_sample(
+        sample_id=sample.sample_id, access_token=sample.access_token
+    )
+    assert metrics.snapshot()["sample_id_filter_rejections"] == 1
@@ -0,0 +1,236 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests consuming events in batches and concurrently"""
+
+import asyncio
+
+import pytest
+from aiokafka import TopicPartition
+from hexkit.providers.testing.eventpub import InMemEventPublisher
+
+from cm.adapters.inbound.akafka import EventSubTranslator
+from cm.adapters.inbound.kafka_consumer import (
+    DrainingRebalanceListener,
+    KafkaBatchEventSubscriber,
+    KafkaConcurrentEventSubscriber,
+)
+from cm.core import models
+from tests.fixtures.config import DEFAULT_CONFIG
+from tests.fixtures.dao import InMemSampleDao
+from tests.fixtures.data_repository import VALID_SAMPLE, make_data_repository
+from tests.fixtures.kafka import FakeConsumer, make_update_record
+
+
+@pytest.mark.asyncio
+async def test_batch_consumption():
+    """Updates are collected from multiple polls, collapsed per sample, written at
+    once, and committed afterwards"""
+    sample_dao = InMemSampleDao()
+    event_publisher = InMemEventPublisher()
+    data_repository = make_data_repository(
+        sample_dao=sample_dao, event_publisher=event_publisher
+    )
+    first, second = [
+        await data_repository.create_sample(
+            sample_creation=models.SampleCreation(**VALID_SAMPLE)
+        )
+        for _ in range(2)
+    ]
+    consumer = FakeConsumer(
+        [
+            make_update_record(0, first.sample_id, "positive"),
+            make_update_record(1, second.sample_id, "negative"),
+            make_update_record(2, first.sample_id, "negative"),
+            make_update_record(3, "unknown", "negative"),
+        ]
+    )
+    subscriber = KafkaBatchEventSubscriber(
+        consumer=consumer,
+        translator=EventSubTranslator(
+            config=DEFAULT_CONFIG, data_repository=data_repository
+        ),
+        max_size=10,
+        max_wait_seconds=0.01,
+    )
+    sample_dao.round_trips = 0
+
+    await subscriber.run(forever=False)
+
+    assert consumer.committed == 4
+    assert sample_dao.round_trips == 2
+    stored = await sample_dao.get_by_id(first.sample_id)
+    assert stored.test_result == models.SampleTestResult.NEGATIVE
+    topic = event_publisher.event_store.topics[
+        DEFAULT_CONFIG.sample_updated_event_topic
+    ]
+    assert len(topic) == 2
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_not_committed():
+    """Offsets of a batch that could not be processed are not committed"""
+    sample_dao = InMemSampleDao()
+
+    async def failing_get_many(ids):
+        raise RuntimeError("database unavailable")
+
+    sample_dao.get_many = failing_get_many  # type: ignore
+    consumer = FakeConsumer([make_update_record(0, "some-id", "positive")])
+    subscriber = KafkaBatchEventSubscriber(
+        consumer=consumer,
+        translator=EventSubTranslator(
+            config=DEFAULT_CONFIG,
+            data_repository=make_data_repository(sample_dao=sample_dao),
+        ),
+        max_size=10,
+        max_wait_seconds=0.01,
+    )
+
+    with pytest.raises(RuntimeError):
+        await subscriber.run(forever=False)
+    assert consumer.committed == 0
+
+
+class RecordingTranslator(EventSubTranslator):
+    """Records the order of the consumed events and fails for the given sample"""
+
+    def __init__(self, *, failing_sample_id: str = ""):
+        super().__init__(config=DEFAULT_CONFIG, data_repository=make_data_repository())
+        self.consumed: list[tuple[str, str]] = []
+        self.failing_sample_id = failing_sample_id
+
+    async def _update_sample(self, *, sample_updates: models.SampleUpdate):
+        # yield to the other workers between events:
+        await asyncio.sleep(0.001)
+        if sample_updates.sample_id == self.failing_sample_id:
+            raise RuntimeError("processing failed")
+        self.consumed.append((sample_updates.sample_id, sample_updates.test_result))
+
+
+@pytest.mark.asyncio
+async def test_concurrent_consumption_keeps_order_per_sample():
+    """Events of the same sample are processed in order, all offsets are committed"""
+    records = [
+        make_update_record(offset, f"s{offset % 3}", result)
+        for offset, result in enumerate(["positive", "negative", "inconclusive"] * 4)
+    ]
+    consumer = FakeConsumer(records, poll_size=len(records))
+    translator = RecordingTranslator()
+    subscriber = KafkaConcurrentEventSubscriber(
+        consumer=consumer, translator=translator, workers=3, queue_size=2
+    )
+
+    await subscriber.run(forever=False)
+
+    assert consumer.committed == len(records)
+    for sample_id in ("s0", "s1", "s2"):
+        assert [
+            result
+            for consumed_id, result in translator.consumed
+            if consumed_id == sample_id
+        ] == [
+            record.value["test_result"] for record in records if record.key == sample_id
+        ]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_consumption_commits_in_order():
+    """Offsets after a failed event are not committed, even if already processed"""
+    records = [
+        make_update_record(0, "a", "positive"),
+        make_update_record(1, "b", "positive"),
+        make_update_record(2, "c", "positive"),
+    ]
+    consumer = FakeConsumer(records, poll_size=3)
+    translator = RecordingTranslator(failing_sample_id="b")
+    subscriber = KafkaConcurrentEventSubscriber(
+        consumer=consumer, translator=translator, workers=3, queue_size=1
+    )
+
+    with pytest.raises(RuntimeError):
+        await subscriber.run(forever=False)
+    assert consumer.committed == 0
+
+
+class GatedTranslator(RecordingTranslator):
+    """Holds back the events of the given sample until the gate is opened"""
+
+    def __init__(self, *, gated_sample_id: str):
+        super().__init__()
+        self.gate = asyncio.Event()
+        self.gated_sample_id = gated_sample_id
+
+    async def _update_sample(self, *, sample_updates: models.SampleUpdate):
+        if sample_updates.sample_id == self.gated_sample_id:
+            await self.gate.wait()
+        await super()._update_sample(sample_updates=sample_updates)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_consumption_drains_revoked_partitions():
+    """Revoked partitions are processed and committed before the rebalance goes on,
+    and only assigned partitions are committed afterwards"""
+    kept = TopicPartition(DEFAULT_CONFIG.update_sample_event_topic, 0)
+    revoked = TopicPartition(DEFAULT_CONFIG.update_sample_event_topic, 1)
+    consumer = FakeConsumer(
+        [
+            make_update_record(0, "a", "positive", partition=0),
+            make_update_record(0, "b", "positive", partition=1),
+            make_update_record(1, "b", "negative", partition=1),
+        ],
+        poll_size=3,
+    )
+    consumer.assigned = {kept, revoked}
+    translator = GatedTranslator(gated_sample_id="b")
+    subscriber = KafkaConcurrentEventSubscriber(
+        consumer=consumer,
+        translator=translator,
+        workers=2,
+        queue_size=10,
+        commit_interval_seconds=0.01,
+    )
+    listener = DrainingRebalanceListener(subscriber)
+    running = asyncio.create_task(subscriber.run())
+    await asyncio.sleep(0.05)
+
+    draining = asyncio.create_task(listener.on_partitions_revoked({revoked}))
+    await asyncio.sleep(0.05)
+    assert not draining.done()
+    translator.gate.set()
+    await asyncio.wait_for(draining, timeout=1)
+
+    assert ("b", "negative") in translator.consumed
+    assert {revoked: 2} in consumer.commits
+
+    # records of the revoked partition that were already polled are dropped:
+    consumer.assigned = {kept}
+    consumer.records += [
+        make_update_record(2, "b", "inconclusive", partition=1),
+        make_update_record(1, "a", "negative", partition=0),
+    ]
+    await asyncio.sleep(0.05)
+    running.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await running
+
+    assert ("a", "negative") in translator.consumed
+    assert ("b", "inconclusive") not in translator.consumed
+    assert consumer.commits[-1] == {kept: 2}
+    assert all(
+        partition == kept
+        for offsets in consumer.commits[consumer.commits.index({revoked: 2}) + 1 :]
+        for partition in offsets
+    )
@@ -0,0 +1,91 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests the batching of concurrent sample lookups"""
+
+import asyncio
+from typing import Optional
+
+import pytest
+
+from cm.adapters.outbound.dao import BatchingSampleDao
+from cm.core import models
+from cm.core.metrics import MetricsCollector
+from cm.ports.outbound.dao import ResourceNotFoundError
+from tests.fixtures.dao import InMemSampleDao
+from tests.fixtures.data_repository import VALID_SAMPLE
+
+
+async def make_batching_dao(
+    *,
+    window_seconds: float = 0.001,
+    max_batch_size: int = 10,
+    metrics: Optional[MetricsCollector] = None,
+) -> tuple[BatchingSampleDao, InMemSampleDao]:
+    """Returns a batching DAO in front of an in-memory DAO holding the samples s1
+    to s3"""
+    sample_dao = InMemSampleDao()
+    await sample_dao.insert_many(
+        [
+            models.Sample(**VALID_SAMPLE, sample_id=f"s{number}", access_token_hash="h")
+            for number in (1, 2, 3)
+        ]
+    )
+    sample_dao.round_trips = 0
+    batching_dao = BatchingSampleDao(
+        sample_dao=sample_dao,
+        window_seconds=window_seconds,
+        max_batch_size=max_batch_size,
+        metrics=metrics,
+    )
+    return batching_dao, sample_dao
+
+
+@pytest.mark.asyncio
+async def test_concurrent_lookups_batched():
+    """Concurrent lookups are resolved with one query, each caller gets its result"""
+    metrics = MetricsCollector()
+    batching_dao, sample_dao = await make_batching_dao(metrics=metrics)
+
+    results = await asyncio.gather(
+        *(batching_dao.get_by_id(id_) for id_ in ("s1", "s2", "s1", "unknown")),
+        return_exceptions=True,
+    )
+
+    assert sample_dao.round_trips == 1
+    first, second, third, missing = results
+    assert isinstance(first, models.Sample) and first.sample_id == "s1"
+    assert isinstance(second, models.Sample) and second.sample_id == "s2"
+    assert third == first and third is not first
+    assert isinstance(missing, ResourceNotFoundError)
+    snapshot = metrics.snapshot()
+    assert snapshot["sample_lookup_batches"] == 1
+    assert snapshot["sample_lookups_batched"] == 4
+
+
+@pytest.mark.asyncio
+async def test_full_batch_not_delayed():
+    """A batch is queried as soon as it reaches the maximum size"""
+    batching_dao, sample_dao = await make_batching_dao(
+        window_seconds=60, max_batch_size=2
+    )
+
+    results = await asyncio.wait_for(
+        asyncio.gather(batching_dao.get_by_id("s1"), batching_dao.get_by_id("s2")),
+        timeout=1,
+    )
+
+    assert [sample.sample_id for sample in results] == ["s1", "s2"]
+    assert sample_dao.round_trips == 1
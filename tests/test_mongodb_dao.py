@@ -0,0 +1,224 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the MongoDB-based DAOs against a MongoDB test container"""
+# pylint: disable=unused-import, redefined-outer-name
+
+import pytest
+from hexkit.providers.mongodb.testutils import (  # noqa: F401
+    MongoDbFixture,
+    mongodb_fixture,
+)
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from cm.adapters.outbound.dao import SampleDaoFactory
+from cm.core import models
+from cm.ports.outbound.dao import (
+    BulkInsertError,
+    ResourceNotFoundError,
+    VersionConflictError,
+)
+from tests.fixtures.data_repository import VALID_SAMPLE
+
+
+def make_sample(sample_id: str, **values) -> models.Sample:
+    """A sample with the given ID and, optionally, other values than the defaults"""
+    return models.Sample(
+        **{**VALID_SAMPLE, "access_token_hash": "hash", **values}, sample_id=sample_id
+    )
+
+
+@pytest.fixture
+def dao_factory(mongodb_fixture: MongoDbFixture) -> SampleDaoFactory:  # noqa: F811
+    """A factory for the DAOs of this service, connected to the test container"""
+    return SampleDaoFactory(config=mongodb_fixture.config)
+
+
+@pytest.mark.asyncio
+async def test_update_test_data(dao_factory: SampleDaoFactory):
+    """Test data is $set with a version bump, unless it is unchanged"""
+    sample_dao = await dao_factory.get_sample_dao(name="samples")
+    await sample_dao.insert(make_sample("id1"))
+    updates = models.SampleUpdate(
+        sample_id="id1",
+        status=models.SampleStatus.COMPLETED,
+        test_result=models.SampleTestResult.NEGATIVE,
+        test_date="2023-02-03T11:01-07:00",
+    )
+
+    updated = await sample_dao.update_test_data(updates)
+    assert updated is not None
+    assert updated.status == models.SampleStatus.COMPLETED
+    assert updated.test_date == updates.test_date
+    assert updated.version == 1
+
+    assert await sample_dao.update_test_data(updates) is None
+    assert (await sample_dao.get_by_id("id1")).version == 1
+
+    with pytest.raises(ResourceNotFoundError):
+        await sample_dao.update_test_data(updates.copy(update={"sample_id": "id2"}))
+
+
+@pytest.mark.asyncio
+async def test_update_versioned(dao_factory: SampleDaoFactory):
+    """Samples are only replaced if their stored version is unchanged"""
+    sample_dao = await dao_factory.get_sample_dao(name="samples")
+    sample = make_sample("id1")
+    await sample_dao.insert(sample)
+
+    sample.status = models.SampleStatus.COMPLETED
+    stored = await sample_dao.update_versioned(sample)
+    assert stored.version == 1
+    assert (await sample_dao.get_by_id("id1")) == stored
+
+    # the sample still has the version it was read with:
+    with pytest.raises(VersionConflictError):
+        await sample_dao.update_versioned(sample)
+    with pytest.raises(ResourceNotFoundError):
+        await sample_dao.update_versioned(make_sample("id2"))
+
+
+@pytest.mark.asyncio
+async def test_insert_and_update_many(dao_factory: SampleDaoFactory):
+    """Bulk writes report the positions of the samples that were not written"""
+    sample_dao = await dao_factory.get_sample_dao(name="samples")
+    first, second = make_sample("id1"), make_sample("id2")
+
+    assert await sample_dao.insert_many([first, second, make_sample("id1")]) == {2}
+    assert set(await sample_dao.get_many(["id1", "id2", "id3"])) == {"id1", "id2"}
+
+    first.status = second.status = models.SampleStatus.FAILED
+    stale = second.copy(update={"version": 5})
+    assert await sample_dao.update_many([first, stale, make_sample("id3")]) == {1, 2}
+
+    stored = await sample_dao.get_many(["id1", "id2"])
+    assert stored["id1"].status == models.SampleStatus.FAILED
+    assert stored["id1"].version == 1
+    assert stored["id2"].status == models.SampleStatus.PENDING
+    assert stored["id2"].version == 0
+
+
+@pytest.mark.asyncio
+async def test_insert_many_with_failures(
+    mongodb_fixture: MongoDbFixture, dao_factory: SampleDaoFactory  # noqa: F811
+):
+    """Samples rejected by the database are reported along with the inserted ones"""
+    config = mongodb_fixture.config
+    client = AsyncIOMotorClient(config.db_connection_str.get_secret_value())
+    await client[config.db_name].create_collection(
+        "validated_samples",
+        validator={
+            "$jsonSchema": {
+                "properties": {
+                    "patient_pseudonym": {"bsonType": "string", "maxLength": 20}
+                }
+            }
+        },
+    )
+    sample_dao = await dao_factory.get_sample_dao(name="validated_samples")
+    await sample_dao.insert(make_sample("id1"))
+
+    with pytest.raises(BulkInsertError) as error:
+        await sample_dao.insert_many(
+            [
+                make_sample("id1"),
+                make_sample("id2", patient_pseudonym="a much too long pseudonym"),
+                make_sample("id3"),
+            ]
+        )
+    assert error.value.inserted == {2}
+    assert error.value.conflicts == {0}
+    assert set(error.value.failures) == {1}
+    assert set(await sample_dao.get_many(["id1", "id2", "id3"])) == {"id1", "id3"}
+
+
+@pytest.mark.asyncio
+async def test_get_fields(dao_factory: SampleDaoFactory):
+    """Only the requested fields and the ID are read"""
+    sample_dao = await dao_factory.get_sample_dao(name="samples")
+    await sample_dao.insert(make_sample("id1"))
+
+    assert await sample_dao.get_fields("id1", {"status", "access_token_hash"}) == {
+        "sample_id": "id1",
+        "status": "pending",
+        "access_token_hash": "hash",
+    }
+    with pytest.raises(ResourceNotFoundError):
+        await sample_dao.get_fields("id2", {"status"})
+
+
+@pytest.mark.asyncio
+async def test_update_token_hash(dao_factory: SampleDaoFactory):
+    """Only the token hash is replaced, and only if it is the expected one"""
+    sample_dao = await dao_factory.get_sample_dao(name="samples")
+    await sample_dao.insert(make_sample("id1"))
+
+    assert await sample_dao.update_token_hash(
+        id_="id1", access_token_hash="new", previous_hash="hash"
+    )
+    assert not await sample_dao.update_token_hash(
+        id_="id1", access_token_hash="newer", previous_hash="hash"
+    )
+
+    stored = await sample_dao.get_by_id("id1")
+    assert stored.access_token_hash == "new"
+    assert stored.version == 0
+
+
+@pytest.mark.asyncio
+async def test_outbox(dao_factory: SampleDaoFactory):
+    """Updates, but not token rehashes, are flagged until they were published"""
+    outbox = await dao_factory.get_sample_outbox(name="samples")
+    sample = make_sample("id1")
+    await outbox.insert(sample)
+    assert await outbox.find_event_pending(limit=10) == []
+
+    sample.status = models.SampleStatus.COMPLETED
+    first_update = await outbox.update_versioned(sample)
+    second_update = await outbox.update_test_data(
+        models.SampleUpdate(
+            sample_id="id1",
+            status=models.SampleStatus.COMPLETED,
+            test_result=models.SampleTestResult.POSITIVE,
+        )
+    )
+    assert second_update is not None
+    assert await outbox.find_event_pending(limit=10) == [second_update]
+
+    # publishing an outdated version leaves the latest update pending:
+    await outbox.clear_event_pending([first_update])
+    assert await outbox.find_event_pending(limit=10) == [second_update]
+    await outbox.clear_event_pending([second_update])
+    assert await outbox.find_event_pending(limit=10) == []
+
+    await outbox.update_token_hash(
+        id_="id1", access_token_hash="new", previous_hash="hash"
+    )
+    assert await outbox.find_event_pending(limit=10) == []
+
+
+@pytest.mark.asyncio
+async def test_processed_event_store(dao_factory: SampleDaoFactory):
+    """Fingerprints are upserted and expire through a TTL index"""
+    store = await dao_factory.get_processed_event_store(
+        name="processed", ttl_seconds=60
+    )
+
+    await store.put_many({"key1": "a", "key2": "b"})
+    await store.put_many({"key1": "c"})
+    assert await store.get_many(["key1", "key2", "key3"]) == {"key1": "c", "key2": "b"}
+
+    indexes = await dao_factory.get_collection(name="processed").index_information()
+    assert any(index.get("expireAfterSeconds") == 60 for index in indexes.values())
@@ -0,0 +1,174 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests publishing sample updates through the outbox"""
+
+import pytest
+from hexkit.providers.testing.eventpub import InMemEventPublisher
+
+from cm.adapters.outbound.akafka import EventPubTranslator, RelayedEventPublisher
+from cm.adapters.outbound.outbox import OutboxRelay
+from cm.core import models
+from cm.core.authorizer import Authorizer
+from cm.core.hashing import TokenHashingConfig
+from tests.fixtures.config import DEFAULT_CONFIG
+from tests.fixtures.dao import InMemSampleDao
+from tests.fixtures.data_repository import VALID_SAMPLE, make_data_repository
+
+
+def make_update(sample_id: str, test_result: str) -> models.SampleUpdate:
+    """Returns an update of the sample"""
+    return models.SampleUpdate(
+        sample_id=sample_id, status="completed", test_result=test_result
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("is_external", [True, False])
+async def test_updates_are_relayed(is_external: bool):
+    """Updates are only published by the relay, with the latest state of a sample"""
+    sample_dao = InMemSampleDao(record_events=True)
+    data_repository = make_data_repository(sample_dao=sample_dao)
+    data_repository._event_publisher = (  # pylint: disable=protected-access
+        RelayedEventPublisher()
+    )
+    samples = [
+        await data_repository.create_sample(
+            sample_creation=models.SampleCreation(**VALID_SAMPLE)
+        )
+        for _ in range(3)
+    ]
+    event_publisher = InMemEventPublisher()
+    relay = OutboxRelay(
+        outbox=sample_dao,
+        publisher=EventPubTranslator(config=DEFAULT_CONFIG, provider=event_publisher),
+        batch_size=2,
+        poll_interval_seconds=0.01,
+    )
+    assert await relay.relay() == 0
+
+    for sample in samples:
+        for test_result in ("positive", "negative"):
+            await data_repository.update_sample(
+                updates=make_update(sample.sample_id, test_result),
+                access_token=sample.access_token,
+                is_external=is_external,
+            )
+    topic = event_publisher.event_store.topics[
+        DEFAULT_CONFIG.sample_updated_event_topic
+    ]
+    assert not topic
+
+    assert await relay.relay() == 2
+    assert await relay.relay() == 1
+    assert await relay.relay() == 0
+    assert sorted(event.key for event in topic) == sorted(
+        sample.sample_id for sample in samples
+    )
+    assert {event.payload["test_result"] for event in topic} == {"negative"}
+
+
+@pytest.mark.asyncio
+async def test_token_rehash_is_not_relayed():
+    """Migrating the token hash on retrieval is not an update of the sample"""
+    sample_dao = InMemSampleDao(record_events=True)
+    sample = await make_data_repository(
+        authorizer=Authorizer(config=TokenHashingConfig(bcrypt_rounds=4)),
+        sample_dao=sample_dao,
+    ).create_sample(sample_creation=models.SampleCreation(**VALID_SAMPLE))
+    data_repository = make_data_repository(
+        authorizer=Authorizer(
+            config=TokenHashingConfig(
+                token_hash_algorithm="hmac-sha256", token_hash_pepper="secret"
+            )
+        ),
+        sample_dao=sample_dao,
+    )
+    relay = OutboxRelay(
+        outbox=sample_dao,
+        publisher=EventPubTranslator(
+            config=DEFAULT_CONFIG, provider=InMemEventPublisher()
+        ),
+        batch_size=10,
+        poll_interval_seconds=0,
+    )
+
+    await data_repository.retrieve_sample(
+        sample_id=sample.sample_id, access_token=sample.access_token
+    )
+
+    stored = await sample_dao.get_by_id(sample.sample_id)
+    assert stored.access_token_hash.startswith("$hmac-sha256$")
+    assert stored.version == 0
+    assert await relay.relay() == 0
+
+
+@pytest.mark.asyncio
+async def test_update_during_relay_stays_pending():
+    """A sample updated after the relay read it is relayed again"""
+    sample_dao = InMemSampleDao(record_events=True)
+    data_repository = make_data_repository(sample_dao=sample_dao)
+    sample = await data_repository.create_sample(
+        sample_creation=models.SampleCreation(**VALID_SAMPLE)
+    )
+    await sample_dao.update_test_data(make_update(sample.sample_id, "positive"))
+
+    (pending,) = await sample_dao.find_event_pending(limit=10)
+    await sample_dao.update_test_data(make_update(sample.sample_id, "negative"))
+    await sample_dao.clear_event_pending([pending])
+
+    (pending,) = await sample_dao.find_event_pending(limit=10)
+    assert pending.test_result == models.SampleTestResult.NEGATIVE
+    await sample_dao.clear_event_pending([pending])
+    assert not await sample_dao.find_event_pending(limit=10)
+
+
+@pytest.mark.asyncio
+async def test_failed_publishing_is_retried():
+    """Updates stay in the outbox until they were published"""
+
+    class FailingPublisher:
+        """Fails to publish the first time"""
+
+        def __init__(self):
+            self.attempts = 0
+
+        async def publish_sample_updated(self, *, sample_no_auth):
+            """Not used"""
+            raise NotImplementedError()
+
+        async def publish_samples_updated(
+            self, *, samples_no_auth
+        ):  # pylint: disable=unused-argument
+            """Fail on the first attempt"""
+            self.attempts += 1
+            if self.attempts == 1:
+                raise ConnectionError("broker unavailable")
+
+    sample_dao = InMemSampleDao(record_events=True)
+    data_repository = make_data_repository(sample_dao=sample_dao)
+    sample = await data_repository.create_sample(
+        sample_creation=models.SampleCreation(**VALID_SAMPLE)
+    )
+    await sample_dao.update_test_data(make_update(sample.sample_id, "positive"))
+    publisher = FailingPublisher()
+    relay = OutboxRelay(
+        outbox=sample_dao, publisher=publisher, batch_size=10, poll_interval_seconds=0
+    )
+
+    with pytest.raises(ConnectionError):
+        await relay.relay()
+    assert await relay.relay() == 1
+    assert publisher.attempts == 2
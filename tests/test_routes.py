@@ -0,0 +1,205 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the REST API, using in-memory stand-ins for MongoDB and Kafka"""
+
+import pytest
+from pydantic import SecretStr
+
+from cm.adapters.inbound.fastapi_.routes import (
+    MAX_BATCH_SIZE,
+    MSG_METRICS_DISABLED,
+    MSG_SESSION_TOKENS_DISABLED,
+    SAMPLE_FIELDS,
+)
+from cm.core import models
+from cm.core.metrics import MetricsCollector
+from cm.core.session import SessionTokenSigner
+from tests.benchmarks.utils import rest_client
+from tests.fixtures.config import DEFAULT_CONFIG
+from tests.fixtures.data_repository import VALID_SAMPLE, make_data_repository
+
+SAMPLE_KEYS = {
+    "patient_pseudonym",
+    "submitter_email",
+    "collection_date",
+    "status",
+    "test_result",
+    "test_date",
+    "sample_id",
+}
+
+
+@pytest.mark.asyncio
+async def test_internal_fields_are_not_returned():
+    """Responses contain neither the version nor, except on creation, the token hash"""
+    async with rest_client(
+        data_repository=make_data_repository(), metrics=MetricsCollector()
+    ) as client:
+        response = await client.post("/samples", json=VALID_SAMPLE)
+        assert response.status_code == 201
+        created = response.json()
+        assert set(created) == SAMPLE_KEYS | {"access_token", "access_token_hash"}
+
+        headers = {"Authorization": f"Bearer {created['access_token']}"}
+        response = await client.get(f"/samples/{created['sample_id']}", headers=headers)
+        assert response.status_code == 200
+        assert set(response.json()) == SAMPLE_KEYS
+
+        response = await client.post("/samples:batch", json=[VALID_SAMPLE])
+        assert response.status_code == 200
+        assert set(response.json()[0]) == {
+            "index",
+            "status",
+            "sample_id",
+            "access_token",
+            "error",
+        }
+
+
+@pytest.mark.asyncio
+async def test_fields_projection():
+    """Only known public fields can be requested, and at least one of them"""
+    async with rest_client(
+        data_repository=make_data_repository(), metrics=MetricsCollector()
+    ) as client:
+        created = (await client.post("/samples", json=VALID_SAMPLE)).json()
+        url = f"/samples/{created['sample_id']}"
+        headers = {"Authorization": f"Bearer {created['access_token']}"}
+
+        response = await client.get(
+            url, params={"fields": "status,test_result"}, headers=headers
+        )
+        assert response.status_code == 200
+        assert set(response.json()) == {"sample_id", "status", "test_result"}
+
+        for fields in ["unknown", "status,access_token_hash", "version", "", " , "]:
+            response = await client.get(url, params={"fields": fields}, headers=headers)
+            assert response.status_code == 422, fields
+
+
+def test_projection_model_covers_fields():
+    """Every field that can be requested is documented in the projection model"""
+    assert set(models.SampleProjection.__fields__) == SAMPLE_FIELDS
+
+
+@pytest.mark.asyncio
+async def test_session_endpoint():
+    """Session tokens are issued for valid access tokens only"""
+    data_repository = make_data_repository(
+        session_signer=SessionTokenSigner(secret=b"secret", ttl_seconds=60)
+    )
+    async with rest_client(
+        data_repository=data_repository, metrics=MetricsCollector()
+    ) as client:
+        created = (await client.post("/samples", json=VALID_SAMPLE)).json()
+        url = f"/samples/{created['sample_id']}/session"
+
+        response = await client.post(
+            url, headers={"Authorization": f"Bearer {created['access_token']}"}
+        )
+        assert response.status_code == 201
+        session_token = response.json()["session_token"]
+        response = await client.get(
+            f"/samples/{created['sample_id']}",
+            headers={"Authorization": f"Bearer {session_token}"},
+        )
+        assert response.status_code == 200
+
+        response = await client.post(url, headers={"Authorization": "Bearer wrong"})
+        assert response.status_code == 403
+        response = await client.post(
+            "/samples/unknown/session",
+            headers={"Authorization": f"Bearer {created['access_token']}"},
+        )
+        assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_session_endpoint_disabled():
+    """Without a session signer, the session endpoint is not found"""
+    async with rest_client(
+        data_repository=make_data_repository(), metrics=MetricsCollector()
+    ) as client:
+        created = (await client.post("/samples", json=VALID_SAMPLE)).json()
+        response = await client.post(
+            f"/samples/{created['sample_id']}/session",
+            headers={"Authorization": f"Bearer {created['access_token']}"},
+        )
+        assert response.status_code == 404
+        assert response.json()["detail"] == MSG_SESSION_TOKENS_DISABLED
+
+
+@pytest.mark.asyncio
+async def test_batch_routes():
+    """Batches are validated per item, within the size limits of the whole batch"""
+    async with rest_client(
+        data_repository=make_data_repository(), metrics=MetricsCollector()
+    ) as client:
+        response = await client.post(
+            "/samples:batch", json=[VALID_SAMPLE, {"submitter_email": "invalid"}]
+        )
+        assert response.status_code == 200
+        created, invalid = response.json()
+        assert created["status"] == models.BatchItemStatus.CREATED
+        assert invalid["status"] == models.BatchItemStatus.INVALID
+
+        update = {
+            "sample_id": created["sample_id"],
+            "access_token": created["access_token"],
+            "status": models.SampleStatus.COMPLETED,
+            "test_result": models.SampleTestResult.NEGATIVE,
+        }
+        response = await client.patch(
+            "/samples:batch", json=[update, {**update, "access_token": "wrong"}]
+        )
+        assert response.status_code == 200
+        assert [result["status"] for result in response.json()] == [
+            models.BatchItemStatus.UPDATED,
+            models.BatchItemStatus.UNAUTHORIZED,
+        ]
+
+        for method, item in [("POST", VALID_SAMPLE), ("PATCH", update)]:
+            for body in [[], [item] * (MAX_BATCH_SIZE + 1), item]:
+                response = await client.request(method, "/samples:batch", json=body)
+                assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint():
+    """Metrics are only reported to requests bearing the configured metrics token"""
+    async with rest_client(
+        data_repository=make_data_repository(), metrics=MetricsCollector()
+    ) as client:
+        response = await client.get("/metrics")
+        assert response.status_code == 404
+        assert response.json()["detail"] == MSG_METRICS_DISABLED
+
+    metrics = MetricsCollector()
+    metrics.increment("requests")
+    config = DEFAULT_CONFIG.copy(update={"metrics_token": SecretStr("secret")})
+    async with rest_client(
+        data_repository=make_data_repository(), metrics=metrics, config=config
+    ) as client:
+        missing: dict[str, str] = {}
+        for headers in [missing, {"Authorization": "Bearer wrong"}]:
+            response = await client.get("/metrics", headers=headers)
+            assert response.status_code == 403
+
+        response = await client.get(
+            "/metrics", headers={"Authorization": "Bearer secret"}
+        )
+        assert response.status_code == 200
+        assert response.json() == {"requests": 1}
@@ -0,0 +1,200 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests the read-through cache in front of the Sample DAO"""
+
+import asyncio
+import time
+from typing import Callable, Optional
+
+import pytest
+
+from cm.adapters.inbound.akafka import (
+    LatestOffsetConsumer,
+    SampleCacheInvalidationTranslator,
+)
+from cm.adapters.outbound.cache import CachingSampleDao
+from cm.core import models
+from cm.core.metrics import MetricsCollector
+from cm.core.sample_record import SampleRecord
+from tests.fixtures.config import DEFAULT_CONFIG
+from tests.fixtures.dao import InMemSampleDao
+from tests.fixtures.data_repository import VALID_SAMPLE
+from tests.fixtures.utils import FakeClock
+
+
+def make_sample(sample_id: str) -> models.Sample:
+    """Returns a sample with the given ID"""
+    return models.Sample(**VALID_SAMPLE, sample_id=sample_id, access_token_hash="h")
+
+
+async def make_cache(
+    *,
+    max_entries: int = 10,
+    max_bytes: int = 1 << 20,
+    metrics: Optional[MetricsCollector] = None,
+    clock: Callable[[], float] = time.monotonic,
+) -> tuple[CachingSampleDao, InMemSampleDao]:
+    """Returns a cache in front of an in-memory DAO holding the samples s1 to s3"""
+    sample_dao = InMemSampleDao()
+    await sample_dao.insert_many([make_sample(f"s{number}") for number in (1, 2, 3)])
+    cache = CachingSampleDao(
+        sample_dao=sample_dao,
+        max_entries=max_entries,
+        max_bytes=max_bytes,
+        ttl_seconds=60,
+        metrics=metrics,
+        clock=clock,
+    )
+    sample_dao.round_trips = 0
+    return cache, sample_dao
+
+
+@pytest.mark.asyncio
+async def test_read_through():
+    """Repeated reads are served from memory, as copies"""
+    metrics = MetricsCollector()
+    cache, sample_dao = await make_cache(metrics=metrics)
+
+    first = await cache.get_by_id("s1")
+    first.status = models.SampleStatus.FAILED
+    second = await cache.get_by_id("s1")
+    samples = await cache.get_many(["s1", "s2"])
+
+    assert second.status == models.SampleStatus.PENDING
+    assert set(samples) == {"s1", "s2"}
+    assert sample_dao.round_trips == 2
+    snapshot = metrics.snapshot()
+    assert snapshot["sample_cache_hits"] == 2
+    assert snapshot["sample_cache_misses"] == 2
+    assert snapshot["sample_cache_entries"] == 2
+
+
+@pytest.mark.asyncio
+async def test_limits_and_expiry():
+    """Entries are evicted by count, by size, and after their TTL"""
+    clock = FakeClock()
+    cache, sample_dao = await make_cache(max_entries=2, clock=clock)
+    for sample_id in ("s1", "s2", "s3"):
+        await cache.get_by_id(sample_id)
+    await cache.get_by_id("s1")
+    assert sample_dao.round_trips == 4
+
+    size = SampleRecord.from_sample(await sample_dao.get_by_id("s1")).nbytes
+    cache, sample_dao = await make_cache(max_bytes=size, clock=clock)
+    await cache.get_by_id("s1")
+    await cache.get_by_id("s2")
+    await cache.get_by_id("s2")
+    assert sample_dao.round_trips == 2
+
+    clock.now += 61
+    await cache.get_by_id("s2")
+    assert sample_dao.round_trips == 3
+
+
+@pytest.mark.asyncio
+async def test_writes_and_events_evict():
+    """Samples written through the cache or by other instances are read again"""
+    cache, sample_dao = await make_cache()
+    translator = SampleCacheInvalidationTranslator(
+        config=DEFAULT_CONFIG, sample_cache=cache
+    )
+    await cache.get_by_id("s1")
+
+    await cache.update_test_data(
+        models.SampleUpdate(sample_id="s1", status="completed", test_result="positive")
+    )
+    assert (await cache.get_by_id("s1")).status == models.SampleStatus.COMPLETED
+
+    # another instance updates the sample directly:
+    await sample_dao.update_test_data(
+        models.SampleUpdate(sample_id="s1", status="failed", test_result="positive")
+    )
+    assert (await cache.get_by_id("s1")).status == models.SampleStatus.COMPLETED
+    await translator.consume(
+        payload={"sample_id": "s1"},
+        type_=DEFAULT_CONFIG.sample_updated_event_type,
+        topic=DEFAULT_CONFIG.sample_updated_event_topic,
+    )
+    assert (await cache.get_by_id("s1")).status == models.SampleStatus.FAILED
+
+
+@pytest.mark.asyncio
+async def test_read_during_eviction_not_cached():
+    """A read that raced with an eviction doesn't put a possibly stale sample back"""
+    cache, sample_dao = await make_cache()
+    get_by_id = sample_dao.get_by_id
+
+    async def racing_get_by_id(id_: str) -> models.Sample:
+        read = await get_by_id(id_)
+        cache.evict(sample_id=id_)
+        return read
+
+    sample_dao.get_by_id = racing_get_by_id  # type: ignore
+    await cache.get_by_id("s1")
+    sample_dao.get_by_id = get_by_id  # type: ignore
+    await cache.get_by_id("s1")
+    assert sample_dao.round_trips == 2
+
+
+@pytest.mark.asyncio
+async def test_concurrent_reads_coalesced():
+    """Concurrent misses for one sample share a read, even with the cache disabled"""
+    metrics = MetricsCollector()
+    cache, sample_dao = await make_cache(max_entries=0, metrics=metrics)
+    sample_dao.latency = 0.01
+
+    samples = await asyncio.gather(*(cache.get_by_id("s1") for _ in range(3)))
+
+    assert sample_dao.round_trips == 1
+    assert samples[0] == samples[1] and samples[0] is not samples[1]
+    assert metrics.snapshot()["sample_reads_coalesced"] == 2
+
+
+@pytest.mark.asyncio
+async def test_get_fields():
+    """Fields are taken from the cached sample, and read with a projection on a miss,
+    which doesn't populate the cache"""
+    for max_entries in (10, 0):
+        cache, sample_dao = await make_cache(max_entries=max_entries)
+
+        for _ in range(2):
+            fields = await cache.get_fields("s1", {"status"})
+            assert fields == {"sample_id": "s1", "status": "pending"}
+        assert sample_dao.round_trips == 2
+
+        await cache.get_by_id("s1")
+        fields = await cache.get_fields("s1", {"status"})
+        assert fields == {"sample_id": "s1", "status": "pending"}
+        assert sample_dao.round_trips == (3 if max_entries else 4)
+
+
+@pytest.mark.asyncio
+async def test_invalidation_consumer_has_no_group():
+    """Invalidation events are consumed from the end of the topic without a consumer
+    group, so restarts leave no groups behind on the broker"""
+    consumer = LatestOffsetConsumer(
+        DEFAULT_CONFIG.sample_updated_event_topic,
+        bootstrap_servers="localhost",
+        group_id=DEFAULT_CONFIG.service_name,
+        auto_offset_reset="earliest",
+    )
+    try:
+        # pylint: disable=protected-access
+        assert consumer._group_id is None
+        assert not consumer._enable_auto_commit
+        assert consumer._auto_offset_reset == "latest"
+    finally:
+        await consumer.stop()
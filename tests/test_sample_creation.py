@@ -63,3 +63,24 @@ def test_sample_creation_dates(collection_date):
         submitter_email=EmailStr(VALID_EMAIL),
         collection_date=collection_date,
     )
+
+
+def test_from_validated():
+    """Models constructed from validated data equal the validated models and don't
+    take over fields they don't define"""
+    creation = models.SampleCreation(
+        patient_pseudonym=VALID_NAME,
+        submitter_email=EmailStr(VALID_EMAIL),
+        collection_date=VALID_DATE_STRING,
+    )
+
+    sample = models.from_validated(
+        models.Sample, creation, sample_id="sample", access_token_hash="hash"
+    )
+    no_auth = models.from_validated(models.SampleNoAuth, sample)
+
+    assert sample == models.Sample(
+        **creation.dict(), sample_id="sample", access_token_hash="hash"
+    )
+    assert no_auth == models.SampleNoAuth(**sample.dict())
+    assert "access_token_hash" not in no_auth.__dict__
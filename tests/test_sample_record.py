@@ -0,0 +1,45 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests the compact representation of samples"""
+
+import pytest
+
+from cm.core import models
+from cm.core.sample_record import SampleRecord
+from tests.fixtures.data_repository import VALID_SAMPLE
+
+
+@pytest.mark.parametrize(
+    "test_date", ["2023-01-16T08:30:15.123456+01:00", models.NO_TEST_DATE]
+)
+def test_round_trip(test_date):
+    """Samples are restored from their records without loss"""
+    sample = models.Sample(
+        **VALID_SAMPLE,
+        sample_id="sample",
+        access_token_hash="hash",
+        status="failed",
+        test_result="positive",
+        test_date=test_date,
+        version=7,
+    )
+
+    record = SampleRecord.from_sample(sample)
+    restored = record.to_sample()
+
+    assert restored == sample
+    assert restored.__dict__ == sample.__dict__
+    assert restored is not record.to_sample()
@@ -0,0 +1,66 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests that the fast serialization gives the same results as pydantic"""
+
+import json
+
+from cm.adapters.serialization import FastJSONResponse, dumps, loads, to_jsonable
+from cm.core import models
+from tests.fixtures.data_repository import VALID_SAMPLE
+
+SAMPLE = models.SampleAuthDetails(
+    **VALID_SAMPLE,
+    sample_id="sample",
+    access_token_hash="hash",
+    access_token="token",
+    test_date="2023-01-16T08:30:15.123+01:00",
+)
+
+
+def test_same_as_pydantic():
+    """Models, including missing values, are encoded like .json() does"""
+    results = [
+        models.SampleBatchCreationResult(
+            index=0,
+            status=models.BatchItemStatus.CREATED,
+            sample_id="sample",
+            access_token="token",
+        ),
+        models.SampleBatchCreationResult(
+            index=1, status=models.BatchItemStatus.INVALID, error="invalid"
+        ),
+    ]
+
+    assert to_jsonable(SAMPLE) == json.loads(SAMPLE.json())
+    # the default test date has no fraction of seconds:
+    sample_no_auth = models.SampleNoAuth(
+        sample_id="sample", status="pending", test_result="positive", **VALID_SAMPLE
+    )
+    assert to_jsonable(sample_no_auth) == json.loads(sample_no_auth.json())
+    assert loads(dumps(to_jsonable(SAMPLE))) == to_jsonable(SAMPLE)
+    for result in results:
+        assert loads(dumps(result)) == json.loads(result.json())
+    assert loads(FastJSONResponse(results).body) == [
+        json.loads(result.json()) for result in results
+    ]
+
+
+def test_include():
+    """Only the included fields are returned"""
+    assert to_jsonable(SAMPLE, include={"status", "test_date"}) == {
+        "status": "pending",
+        "test_date": "2023-01-16T07:30:15.123000+00:00",
+    }
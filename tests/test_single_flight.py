@@ -0,0 +1,106 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests the coalescing of concurrent calls"""
+
+import asyncio
+
+import pytest
+
+from cm.core.authorizer import Authorizer
+from cm.core.metrics import MetricsCollector
+from cm.core.single_flight import SingleFlight
+
+
+class SlowCall:
+    """Counts its calls, each of which takes a moment"""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def __call__(self) -> int:
+        self.calls += 1
+        number = self.calls
+        await asyncio.sleep(0.01)
+        return number
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_coalesced():
+    """Concurrent callers with the same key share one call"""
+    metrics = MetricsCollector()
+    single_flight: SingleFlight[str, int] = SingleFlight(
+        counter_name="coalesced", metrics=metrics
+    )
+    call = SlowCall()
+
+    results = await asyncio.gather(
+        *(single_flight.run("key", call) for _ in range(5)),
+        single_flight.run("other", call),
+    )
+
+    assert results[:5] == [results[0]] * 5
+    assert call.calls == 2
+    assert metrics.snapshot()["coalesced"] == 4
+
+    # finished calls are not reused:
+    await single_flight.run("key", call)
+    assert call.calls == 3
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller():
+    """Cancelling the caller that started the call doesn't affect the others"""
+    single_flight: SingleFlight[str, int] = SingleFlight(counter_name="coalesced")
+    call = SlowCall()
+
+    first = asyncio.create_task(single_flight.run("key", call))
+    second = asyncio.create_task(single_flight.run("key", call))
+    await asyncio.sleep(0)
+    first.cancel()
+
+    assert await second == 1
+
+
+@pytest.mark.asyncio
+async def test_forget():
+    """Callers after forget start a new call"""
+    single_flight: SingleFlight[str, int] = SingleFlight(counter_name="coalesced")
+    call = SlowCall()
+
+    first = asyncio.create_task(single_flight.run("key", call))
+    await asyncio.sleep(0)
+    single_flight.forget("key")
+    second = asyncio.create_task(single_flight.run("key", call))
+
+    assert {await first, await second} == {1, 2}
+
+
+@pytest.mark.asyncio
+async def test_token_checks_coalesced():
+    """Identical verifications in flight run only once"""
+    metrics = MetricsCollector()
+    authorizer = Authorizer(metrics=metrics)
+    token_hashed = await authorizer.hash_token(token="token")
+
+    results = await asyncio.gather(
+        *(
+            authorizer.check_token(token_plain=token, token_hashed=token_hashed)
+            for token in ("token", "token", "token", "wrong")
+        )
+    )
+
+    assert results == [True, True, True, False]
+    assert metrics.snapshot()["token_checks_coalesced"] == 2
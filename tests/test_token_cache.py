@@ -0,0 +1,88 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests the cache of verified tokens"""
+
+from cm.core.metrics import MetricsCollector
+from cm.core.token_cache import VerifiedTokenCache
+from tests.fixtures.utils import FakeClock
+
+
+def test_hit_and_miss():
+    """Only the token that was verified for the sample is a hit"""
+    metrics = MetricsCollector()
+    cache = VerifiedTokenCache(max_entries=10, ttl_seconds=60, metrics=metrics)
+    cache.add(sample_id="s1", token="token", token_hashed="hash")
+
+    assert cache.is_verified(sample_id="s1", token="token", token_hashed="hash")
+    assert not cache.is_verified(sample_id="s1", token="other", token_hashed="hash")
+    assert not cache.is_verified(sample_id="s2", token="token", token_hashed="hash")
+
+    snapshot = metrics.snapshot()
+    assert snapshot["token_cache_hits"] == 1
+    assert snapshot["token_cache_misses"] == 2
+
+
+def test_plaintext_not_stored():
+    """The cache keys don't contain the plaintext token"""
+    cache = VerifiedTokenCache(max_entries=10, ttl_seconds=60)
+    cache.add(sample_id="s1", token="token", token_hashed="hash")
+
+    # pylint: disable=protected-access
+    for sample_id, digest in cache._entries:
+        assert sample_id == "s1"
+        assert b"token" not in digest
+
+
+def test_expiry():
+    """Entries are no longer hits after their TTL"""
+    clock = FakeClock()
+    cache = VerifiedTokenCache(max_entries=10, ttl_seconds=60, clock=clock)
+    cache.add(sample_id="s1", token="token", token_hashed="hash")
+
+    clock.now = 59
+    assert cache.is_verified(sample_id="s1", token="token", token_hashed="hash")
+    clock.now = 61
+    assert not cache.is_verified(sample_id="s1", token="token", token_hashed="hash")
+
+
+def test_changed_hash():
+    """A changed access_token_hash invalidates the entry"""
+    cache = VerifiedTokenCache(max_entries=10, ttl_seconds=60)
+    cache.add(sample_id="s1", token="token", token_hashed="hash")
+
+    assert not cache.is_verified(sample_id="s1", token="token", token_hashed="new")
+    assert not cache.is_verified(sample_id="s1", token="token", token_hashed="hash")
+
+
+def test_lru_eviction():
+    """The least recently used entry is evicted first"""
+    cache = VerifiedTokenCache(max_entries=2, ttl_seconds=60)
+    cache.add(sample_id="s1", token="token", token_hashed="hash")
+    cache.add(sample_id="s2", token="token", token_hashed="hash")
+    assert cache.is_verified(sample_id="s1", token="token", token_hashed="hash")
+
+    cache.add(sample_id="s3", token="token", token_hashed="hash")
+
+    assert cache.is_verified(sample_id="s1", token="token", token_hashed="hash")
+    assert not cache.is_verified(sample_id="s2", token="token", token_hashed="hash")
+    assert cache.is_verified(sample_id="s3", token="token", token_hashed="hash")
+
+
+def test_disabled():
+    """With a size of zero, nothing is cached"""
+    cache = VerifiedTokenCache(max_entries=0, ttl_seconds=60)
+    cache.add(sample_id="s1", token="token", token_hashed="hash")
+    assert not cache.is_verified(sample_id="s1", token="token", token_hashed="hash")
@@ -0,0 +1,90 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests the pool of pre-hashed access tokens"""
+
+import asyncio
+
+import pytest
+
+from cm.core.authorizer import Authorizer, AuthorizerConfig
+from cm.core.hashing import TokenHashingConfig
+from cm.core.metrics import MetricsCollector
+from cm.core.token_pool import TokenPool, TokenPoolConfig
+
+AUTHORIZER = Authorizer(config=TokenHashingConfig(bcrypt_rounds=4))
+
+
+async def wait_for_depth(metrics: MetricsCollector, depth: int):
+    """Wait until the pool has been filled to the given depth"""
+    while metrics.snapshot()["token_pool_depth"] < depth:
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_pool_is_refilled():
+    """The pool fills up to its size and refills after pairs are taken"""
+    metrics = MetricsCollector()
+    config = TokenPoolConfig(token_pool_size=3)
+    async with TokenPool.construct(
+        config=config,
+        authorizer_config=AuthorizerConfig(),
+        authorizer=AUTHORIZER,
+        metrics=metrics,
+    ) as token_pool:
+        await asyncio.wait_for(wait_for_depth(metrics, 3), timeout=10)
+
+        token, token_hashed = await token_pool.get_token_pair()
+        assert await AUTHORIZER.check_token(
+            token_plain=token, token_hashed=token_hashed
+        )
+
+        await asyncio.wait_for(wait_for_depth(metrics, 3), timeout=10)
+        snapshot = metrics.snapshot()
+        assert snapshot["token_pool_refilled"] == 4
+        assert snapshot["token_pool_refill_rate"] > 0
+        assert "token_pool_fallbacks" not in snapshot
+
+
+@pytest.mark.asyncio
+async def test_fallback_when_empty():
+    """An empty pool produces pairs on demand and counts the fallback"""
+    metrics = MetricsCollector()
+    token_pool = TokenPool(authorizer=AUTHORIZER, size=3, metrics=metrics)
+
+    token, token_hashed = await token_pool.get_token_pair()
+
+    assert await AUTHORIZER.check_token(token_plain=token, token_hashed=token_hashed)
+    assert metrics.snapshot()["token_pool_fallbacks"] == 1
+
+
+@pytest.mark.asyncio
+async def test_disabled_with_inline_hashing():
+    """The pool is not refilled if hashing would block the event loop"""
+    metrics = MetricsCollector()
+    async with TokenPool.construct(
+        config=TokenPoolConfig(token_pool_size=3),
+        authorizer_config=AuthorizerConfig(auth_executor="inline"),
+        authorizer=AUTHORIZER,
+        metrics=metrics,
+    ) as token_pool:
+        await asyncio.sleep(0.05)
+        assert metrics.snapshot()["token_pool_depth"] == 0
+
+        token, token_hashed = await token_pool.get_token_pair()
+        assert await AUTHORIZER.check_token(
+            token_plain=token, token_hashed=token_hashed
+        )
+        assert "token_pool_refilled" not in metrics.snapshot()